@@ -11,11 +11,11 @@ __version__ = "0.0.0"
 
 import asyncio
 import time
-from asyncio import Semaphore, futures
+from asyncio import futures
 from collections import namedtuple
 from datetime import timedelta
 from re import I
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 from aiohttp import ClientSession
 from termcolor import colored
@@ -30,11 +30,19 @@ from .constants import (
     weekly_keys,
     yearly_keys,
 )
-from .utils.AsyncUtils import aparse_yahoo_prices, store_yahoo_financial_data, store_yahoo_prices
-from .utils.DataBroker import DataBrokerMongoDb
+from .utils.ArchiveUtils import ResponseArchive
+from .utils.AsyncUtils import (
+    aparse_yahoo_prices,
+    save_yahoo_prices,
+    store_yahoo_financial_data,
+    store_yahoo_prices,
+)
+from .utils.CheckpointUtils import Checkpoint
+from .utils.DataBroker import BufferedDataBroker, DataBroker
 from .utils.DateTimeUtils import validate_date
 from .utils.LoggingUtils import logger
-from .utils.UrlUtils import generate_combinations, generate_price_params, generate_price_urls
+from .utils.SpoolUtils import Spool, SpoolFlusher
+from .utils.UrlUtils import PLAN_PRIORITIES, generate_price_params, plan_combinations
 
 
 class InvalidPeriodError(Exception):
@@ -66,9 +74,14 @@ class InvalidIntervalError(Exception):
 
 
 class YahooPrices:
-    """Class for downloading price, cleaning, storing price data."""
+    """Class for downloading price, cleaning, storing price data.
+
+    download() keeps the parsed prices in data. With save=True it also saves
+    them into the database dbname through the databroker, only then a
+    checkpoint and a spool can be used.
+    """
 
-    def __init__(self, tickers: List[str], databroker: DataBrokerMongoDb, *args, **kwargs):
+    def __init__(self, tickers: List[str], databroker: DataBroker, *args, **kwargs):
         self._tickers = tickers
         self._databroker = databroker
         self._data = None
@@ -83,6 +96,42 @@ class YahooPrices:
         self._start = kwargs.get("start", None)
         self._end = kwargs.get("end", None)
 
+        # INCREMENTAL PARSING OF THE CHART RESPONSES (LARGE RANGES)
+        self._stream = kwargs.get("stream", False)
+
+        # OPTIONAL ARCHIVE OF THE RAW RESPONSES (PATH OR ResponseArchive)
+        self._archive = kwargs.get("archive", None)
+        if isinstance(self._archive, str):
+            self._archive = ResponseArchive(self._archive)
+
+        # SAVE THE DOWNLOADED PRICES TO THE DATABASE dbname
+        self._save = kwargs.get("save", False)
+        self._dbname = kwargs.get("dbname", "FinData")
+
+        # OPTIONAL CHECKPOINT OF THE SAVED (url, params) COMBINATIONS (PATH OR Checkpoint).
+        # THE KEYS LEAVE OUT period2, ONLY RESUME AN INTERRUPTED RUN OF THE SAME PLAN WITH
+        # resume=True, OTHERWISE A LATER INCREMENTAL RUN WOULD SKIP EVERYTHING
+        self._checkpoint = kwargs.get("checkpoint", None)
+        self._checkpoint_path = None
+        if isinstance(self._checkpoint, str):
+            self._checkpoint_path = self._checkpoint
+            self._checkpoint = Checkpoint(self._checkpoint, kwargs.get("resume", False))
+
+        # OPTIONAL DURABLE SPOOL OF THE SAVES (PATH OR Spool), DRAINED INTO THE
+        # DATABROKER BY A SpoolFlusher WHILE THE DOWNLOAD RUNS
+        self._spool = kwargs.get("spool", None)
+        if isinstance(self._spool, str):
+            self._spool = Spool(self._spool)
+
+        # FIXED NUMBER OF DOWNLOAD WORKERS (AT MOST ONE OPEN REQUEST EACH, 1000 AS THE
+        # FORMER SEMAPHORE) AND THE ORDER THEY TAKE THE REQUESTS IN
+        self._workers = kwargs.get("workers", 1000)
+        self._priority = kwargs.get("priority", ("watchlist",))
+        self._watchlist = kwargs.get("watchlist", [])
+
+        # COMBINATIONS SAVED TO A WRITE BUFFER, MARKED AFTER THE FLUSH
+        self._unflushed: List[Tuple[str, dict]] = []
+
         # VERIFY INPUT DATA
         self._input_validation()
 
@@ -103,7 +152,8 @@ class YahooPrices:
         # if self._financialperiod not in self.FINPERIOD.keys():
         #   raise InvalidPeriodError("Invalid period for financial data!")
 
-        if not isinstance(self._databroker, DataBrokerMongoDb):
+        # ANY BROKER IMPLEMENTING THE DataBroker PROTOCOL
+        if not isinstance(self._databroker, DataBroker):
             raise TypeError
 
         if self._start:
@@ -112,6 +162,12 @@ class YahooPrices:
         if self._end:
             validate_date(self._end)
 
+        if any(p not in PLAN_PRIORITIES for p in self._priority):
+            raise ValueError(f"Invalid priority {self._priority}")
+
+        if not self._save and (self._checkpoint is not None or self._spool is not None):
+            raise ValueError("A checkpoint or a spool requires save=True")
+
     @property
     def data(self):
         return self._data
@@ -120,33 +176,123 @@ class YahooPrices:
     def data(self, value):
         self._data = value
 
+    def _last_dates(self, price_params: List[dict]) -> Dict[str, str]:
+        """
+        Private method to get the oldest last stored date per symbol over the
+        requested intervals from the coverage catalog, for the "stalest" priority.
+        """
+        if not hasattr(self._databroker, "get_catalog"):
+            return {}
+
+        intervals = {p["interval"] for p in price_params}
+        last: Dict[str, str] = {}
+        for entry in self._databroker.get_catalog(self._dbname, symbols=self._tickers):
+            if entry["collection"] in intervals and entry.get("last") is not None:
+                last[entry["symbol"]] = min(last.get(entry["symbol"], entry["last"]), entry["last"])
+        return last
+
     async def _download(self):
-        # GENERATE URLS AND PARAMETER DICTS FOR PRICE DATA
-        price_urls = generate_price_urls(self._tickers)
+        # GENERATE PARAMETER DICTS FOR PRICE DATA
         price_params = generate_price_params(self._period, self._interval, self._start, self._end)
 
-        # GENERATE THE URL-PARAMETER TUPLE COMBINATIONS
-        # FOR BOTH PRICE AND FINANCIAL DATA
-        pricecombinations = generate_combinations(price_urls, price_params)
+        # LAZY PLAN OF THE URL-PARAMETER TUPLE COMBINATIONS IN PRIORITY ORDER
+        last_dates = self._last_dates(price_params) if "stalest" in self._priority else None
+        plan = plan_combinations(
+            self._tickers, price_params, self._priority, self._watchlist, last_dates
+        )
+
+        if self._checkpoint is not None:
+            plan = (tup for tup in plan if tup not in self._checkpoint)
 
-        sem = Semaphore(1000)
+        results: Dict[int, tuple] = {}
+        units = enumerate(plan)
 
-        pricetasks = []
+        async def _worker(session: ClientSession):
+            # WORKERS SHARE THE PLAN, EACH TAKES THE NEXT UNIT WHEN IT IS FREE
+            for i, tup in units:
+                if self._save:
+                    results[i] = await self._download_saved(tup, session)
+                else:
+                    results[i] = await aparse_yahoo_prices(
+                        None, tup, session, stream=self._stream, archive=self._archive
+                    )
 
         async with ClientSession() as session:
-            for tup in pricecombinations:
-                task = asyncio.ensure_future(aparse_yahoo_prices(sem, tup, session))
-                pricetasks.append(task)
+            await asyncio.gather(*[_worker(session) for _ in range(self._workers)])
+
+        return [results[i] for i in sorted(results)]
 
-            res = await asyncio.gather(*pricetasks)
+    async def _download_saved(self, tup: Tuple[str, dict], session):
+        """
+        Private method to download a combination, save it through the
+        databroker and mark it completed in the checkpoint if any. Failed
+        downloads are not marked, a resumed run retries them. Saves to a
+        BufferedDataBroker are marked once the buffer is flushed, saves to
+        the spool right away as it is durable.
+        """
+        res = await aparse_yahoo_prices(
+            None, tup, session, stream=self._stream, archive=self._archive
+        )
+        interval, prices, div, split = res
+        if prices is not None:
+            ok = save_yahoo_prices(
+                self._databroker,
+                self._dbname,
+                tup[0].split("/")[-1],
+                interval,
+                prices,
+                div,
+                split,
+                spool=self._spool,
+            )
+            # FAILED SAVES ARE NOT MARKED, A RESUMED RUN RETRIES THEM
+            if not ok or self._checkpoint is None:
+                return res
+            if isinstance(self._databroker, BufferedDataBroker) and self._spool is None:
+                self._unflushed.append(tup)
+            else:
+                self._checkpoint.mark(tup)
         return res
 
     def download(self):
+        # A CHECKPOINT OPENED FROM A PATH IS CLOSED AFTER EACH DOWNLOAD, A FURTHER
+        # DOWNLOAD OF THE SAME RUN REOPENS IT WITH THE UNITS COMPLETED SO FAR
+        if self._checkpoint_path is not None and self._checkpoint.closed:
+            self._checkpoint = Checkpoint(self._checkpoint_path, resume=True)
+
+        flusher = None
+        if self._spool is not None:
+            flusher = SpoolFlusher(self._spool, self._databroker).start()
+
         loop = asyncio.get_event_loop()
         future = asyncio.ensure_future(self._download())
-        res = loop.run_until_complete(future)
+        try:
+            res = loop.run_until_complete(future)
+        finally:
+            if flusher is not None:
+                try:
+                    flusher.stop()
+                except Exception:
+                    logger.exception(
+                        colored("Failed draining the spool, records stay spooled", "red")
+                    )
         self.data = res
 
+        # NOTHING MAY STAY BEHIND IN A WRITE BUFFER AFTER THE DOWNLOAD, THE BUFFERED
+        # COMBINATIONS ARE NOT MARKED IF A FLUSH FAILED
+        if isinstance(self._databroker, BufferedDataBroker):
+            failed = self._databroker.counts["failed"]
+            self._databroker.flush()
+            if self._databroker.counts["failed"] > failed:
+                self._unflushed = []
+
+        for tup in self._unflushed:
+            self._checkpoint.mark(tup)
+        self._unflushed = []
+
+        if self._checkpoint_path is not None:
+            self._checkpoint.close()
+
     def __repr__(self):
         return "<tickers> : {}, <period>: {}, <interval>: {}, <start>: {}, <end>: {}".format(
             self._tickers,
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.tradingstrategies.Screener
+=================================================================
+
+A module containing a parallel screener of a ticker universe for the
+mean-reversion strategy of StatisticalTrading.
+
+The universe is split into batches of symbols. The main process streams
+the close prices of one batch at a time from a DataBroker, limited to
+the window of the strategy with the help of the coverage catalog, and
+hands the batches to a pool of worker processes. Each worker evaluates
+the Hurst exponent, the linear fit and the price levels of its batch
+in one vectorized pass (strategy_mean_reverting_batch). Loading and
+evaluation overlap, the DataBroker stays in the main process.
+
+Usage:
+
+    python -m priceana.tradingstrategies.Screener AAPL MSFT ... --mongo mongodb://localhost:27017
+
+"""
+import argparse
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd
+from termcolor import colored
+
+from priceana.tradingstrategies.StatisticalTrading import (
+    HURST_LAGS,
+    strategy_mean_reverting_batch,
+)
+from priceana.utils.DataBroker import DataBroker
+from priceana.utils.LoggingUtils import logger
+
+# STAGES OF THE TIMINGS OF A SCREEN
+SCREEN_STAGES = ["load", "evaluate", "rank", "total"]
+
+
+def _time_field(interval: str) -> str:
+    """
+    Private method to get the time field of the prices of an interval,
+    datetime for intraday prices as stored by save_yahoo_prices.
+    """
+    if "h" in interval or ("m" in interval and "mo" not in interval):
+        return "datetime"
+    return "date"
+
+
+def _window_start(
+    databroker: DataBroker, dbname: str, interval: str, symbols: List[str], months: int
+) -> Optional[str]:
+    """
+    Private method to get the first date to load for a batch of symbols:
+    the earliest last date of the symbols in the coverage catalog minus
+    the months of the window. None (load all) without a complete catalog.
+    """
+    if not hasattr(databroker, "get_catalog"):
+        return None
+
+    catalog = databroker.get_catalog(dbname, interval, symbols)
+    lasts = [entry.get("last") for entry in catalog]
+    if len(lasts) < len(set(symbols)) or any(last is None for last in lasts):
+        return None
+
+    start = min(pd.Timestamp(last) for last in lasts) - pd.offsets.DateOffset(months=months)
+    return (start - pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def load_ohlcv_batches(
+    universe: Sequence[str],
+    databroker: DataBroker,
+    dbname: str = "FinData",
+    interval: str = "1d",
+    months: int = 5,
+    batch_size: int = 250,
+    timings: Optional[Dict[str, float]] = None,
+) -> Iterator[Dict[str, pd.DataFrame]]:
+    """
+    Method to stream the close prices of a universe, one batch of symbols
+    per database query.
+
+    Args:
+        - universe (Sequence[str]): symbols
+        - databroker (DataBroker): broker to load the prices with
+        - dbname (str): name of the database of the prices
+        - interval (str): price time-series interval, used as collection name
+        - months (int): months of the window, only these are loaded if the
+            broker keeps a coverage catalog
+        - batch_size (int): symbols per query
+        - timings (Optional[Dict[str, float]]): the seconds spent loading are
+            added to timings["load"]
+
+    Returns:
+        Iterator[Dict[str, pd.DataFrame]]: symbol -> frame with date and
+            close per batch, symbols without prices are left out
+    """
+    timefield = _time_field(interval)
+    symbols = list(dict.fromkeys(universe))
+
+    for i in range(0, len(symbols), batch_size):
+        t0 = time.perf_counter()
+        batch = symbols[i : i + batch_size]
+
+        query: dict = {"symbol": {"$in": batch}}
+        start = _window_start(databroker, dbname, interval, batch, months)
+        if start is not None:
+            query[timefield] = {"$gte": start}
+        selection = {"symbol": True, timefield: True, "close": True}
+
+        if hasattr(databroker, "load_frame"):
+            frame = databroker.load_frame(dbname, interval, query, selection)
+        else:
+            frame = pd.DataFrame(databroker.load(dbname, interval, query, selection))
+
+        ohlcvs = {}
+        if not frame.empty:
+            # ONE DATE CONVERSION PER BATCH, NOT PER SYMBOL
+            frame = frame.rename(columns={timefield: "date"}).dropna(subset=["date", "close"])
+            frame["date"] = pd.to_datetime(frame["date"])
+            frame = frame.sort_values(["symbol", "date"])
+            for symbol, ohlcv in frame.groupby("symbol", sort=False):
+                ohlcvs[symbol] = ohlcv[["date", "close"]].reset_index(drop=True)
+
+        if timings is not None:
+            timings["load"] = timings.get("load", 0.0) + time.perf_counter() - t0
+        yield ohlcvs
+
+
+def _evaluate(
+    ohlcvs: Dict[str, pd.DataFrame], months: int, lags: Sequence[int]
+) -> Tuple[pd.DataFrame, float]:
+    """
+    Private method to evaluate a batch, run in a worker process.
+    """
+    t0 = time.perf_counter()
+    res = strategy_mean_reverting_batch(ohlcvs, months, lags)
+    return res, time.perf_counter() - t0
+
+
+def screen_mean_reverting(
+    universe: Sequence[str],
+    databroker: DataBroker,
+    dbname: str = "FinData",
+    interval: str = "1d",
+    months: int = 5,
+    batch_size: int = 250,
+    processes: Optional[int] = None,
+    lags: Sequence[int] = HURST_LAGS,
+    max_hurst: float = 0.5,
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+    Method to screen a universe for mean-reverting candidates with a pool
+    of worker processes.
+
+    Args:
+        - universe (Sequence[str]): symbols to screen
+        - databroker (DataBroker): broker to load the prices with, used in
+            the main process only
+        - dbname (str): name of the database of the prices
+        - interval (str): price time-series interval
+        - months (int): number of (last) months of the strategy window
+        - batch_size (int): symbols per query and per worker task
+        - processes (Optional[int]): number of worker processes,
+            defaults to the number of cores, 1 runs in-process
+        - lags (Sequence[int]): lags of the Hurst exponent
+        - max_hurst (float): candidates have a Hurst exponent below max_hurst
+
+    Returns:
+        pd.DataFrame: candidates ranked on the Hurst exponent (most mean
+            reverting first) with the columns of strategy_mean_reverting_batch
+            and the rank
+        Dict[str, float]: seconds per stage of SCREEN_STAGES, evaluate is the
+            sum over the workers, load overlaps with it
+    """
+    t0 = time.perf_counter()
+    timings = dict.fromkeys(SCREEN_STAGES, 0.0)
+
+    nbatches = -(-len(set(universe)) // batch_size)
+    processes = max(1, min(processes or os.cpu_count() or 1, nbatches))
+    batches = load_ohlcv_batches(
+        universe, databroker, dbname, interval, months, batch_size, timings
+    )
+    evaluate = partial(_evaluate, months=months, lags=lags)
+
+    if processes == 1:
+        results = [evaluate(ohlcvs) for ohlcvs in batches]
+    else:
+        # THE TASK FEEDER THREAD OF THE POOL LOADS THE NEXT BATCHES MEANWHILE
+        with Pool(processes) as pool:
+            results = list(pool.imap(evaluate, batches))
+
+    t1 = time.perf_counter()
+    timings["evaluate"] = sum(seconds for _, seconds in results)
+    frames = [res for res, _ in results if not res.empty]
+    table = pd.concat(frames) if frames else strategy_mean_reverting_batch({})
+
+    # RANK THE CANDIDATES WITH FINITE PRICE LEVELS
+    candidates = table[
+        table["mean_reverting"] & (table["hurst"] < max_hurst) & table["stoplossprice"].notna()
+    ]
+    candidates = candidates.sort_values("hurst", kind="mergesort")
+    candidates.insert(0, "rank", range(1, len(candidates) + 1))
+
+    timings["rank"] = time.perf_counter() - t1
+    timings["total"] = time.perf_counter() - t0
+
+    logger.info(
+        colored(
+            f"Screened {len(table)} of {len(set(universe))} symbols, "
+            f"{len(candidates)} candidates: { {k: round(v, 3) for k, v in timings.items()} }",
+            "green",
+        )
+    )
+    return candidates, timings
+
+
+def main():
+    from priceana.utils.IngestUtils import mongo_broker
+
+    parser = argparse.ArgumentParser(description="Screen symbols for mean reversion.")
+    parser.add_argument("tickers", nargs="+", help="yahoo symbols")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongodb uri")
+    parser.add_argument("--db", default="FinData", help="database name")
+    parser.add_argument("--interval", default="1d", help="price interval")
+    parser.add_argument("--months", type=int, default=5, help="months of the strategy window")
+    parser.add_argument("--batch-size", type=int, default=250, help="symbols per batch")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes")
+    parser.add_argument("--top", type=int, default=50, help="candidates to print")
+    args = parser.parse_args()
+
+    candidates, timings = screen_mean_reverting(
+        args.tickers,
+        mongo_broker(args.mongo),
+        args.db,
+        args.interval,
+        args.months,
+        args.batch_size,
+        args.processes,
+    )
+    print(candidates.head(args.top).to_string())
+    print(timings)
+
+
+if __name__ == "__main__":
+    main()
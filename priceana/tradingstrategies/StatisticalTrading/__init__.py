@@ -8,28 +8,34 @@ Module containing code for trading strategies based on
 statistical analysis.
 """
 
+from typing import Dict, List, Sequence, Tuple, Union
+
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
 from numpy import log, polyfit, sqrt, std, subtract
 from priceana.utils.LoggingUtils import logger
-from scipy.optimize import curve_fit
 from termcolor import colored
 
 
-def hurst(ts: np.array) -> float:
+# DEFAULT LAGS OF THE HURST EXPONENT
+HURST_LAGS = range(2, 20)
+
+# NAN HANDLING OF hurst_batch
+NAN_POLICIES = ["propagate", "omit", "raise"]
+
+
+def hurst(ts: np.array, lags: Sequence[int] = HURST_LAGS) -> float:
     """
     Returns the Hurst Exponent of the time series vector ts.
 
     Args:
         - ts : timeseries in numpy array format
+        - lags : lags of the differences
     """
-    # Create the range of lag values
-    lags = range(2, 20)
-
     # Calculate the array of the variances of the lagged differences
     tau = [sqrt(std(subtract(ts[lag:], ts[:-lag]))) for lag in lags]
-    print(tau)
+    logger.debug(tau)
+
     # Use a linear fit to estimate the Hurst Exponent
     poly = polyfit(log(lags), log(tau), 1)
 
@@ -37,6 +43,307 @@ def hurst(ts: np.array) -> float:
     return poly[0] * 2.0
 
 
+def _as_batch(series: Union[np.ndarray, List[np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns a batch of series as a 2D float array, ragged series padded
+    with NaN at the end, and the length of each series.
+
+    Args:
+        - series : 1D array, 2D array (series x time) or list of 1D arrays
+    """
+    if isinstance(series, np.ndarray) and series.ndim <= 2:
+        values = np.atleast_2d(np.asarray(series, dtype=float))
+        return values, np.full(len(values), values.shape[1])
+
+    arrays = [np.asarray(s, dtype=float) for s in series]
+    lengths = np.array([len(a) for a in arrays], dtype=int)
+    values = np.full((len(arrays), lengths.max(initial=0)), np.nan)
+    for i, a in enumerate(arrays):
+        values[i, : len(a)] = a
+    return values, lengths
+
+
+def _hurst_slope(logtau: np.ndarray, lags: np.ndarray) -> np.ndarray:
+    """
+    Returns the Hurst exponents of the log tau rows (series x lags), the
+    closed-form least squares slope against log(lags) times 2 (as polyfit).
+    NaN for rows with an undefined tau.
+
+    Args:
+        - logtau : log tau per series and lag
+        - lags : lags of the columns
+    """
+    x = np.log(lags) - np.log(lags).mean()
+    with np.errstate(invalid="ignore"):
+        slope = (logtau - logtau.mean(axis=1, keepdims=True)) @ x / (x @ x)
+    return np.where(np.isfinite(logtau).all(axis=1), 2.0 * slope, np.nan)
+
+
+def hurst_batch(
+    series: Union[np.ndarray, List[np.ndarray]],
+    lags: Sequence[int] = HURST_LAGS,
+    nan_policy: str = "propagate",
+) -> np.ndarray:
+    """
+    Returns the Hurst Exponents of a batch of time series, equal to hurst
+    per series. The lagged differences of all series are computed at once
+    per lag.
+
+    Args:
+        - series : 2D array (series x time), 1D array or list of 1D arrays of
+            different lengths
+        - lags : lags of the differences
+        - nan_policy : "propagate" gives NaN for series with NaN values, "omit"
+            ignores the differences with a NaN value, "raise" raises a ValueError
+
+    Returns:
+        - np.ndarray : Hurst exponent per series, NaN where undefined
+            (constant series or too short for the largest lag)
+    """
+    if nan_policy not in NAN_POLICIES:
+        raise ValueError(f"Invalid nan_policy {nan_policy}")
+
+    values, lengths = _as_batch(series)
+    lags = np.asarray(list(lags), dtype=int)
+
+    # NAN VALUES OF THE SERIES, NOT THE PADDING OF RAGGED ONES
+    hasnan = (np.isnan(values) & (np.arange(values.shape[1]) < lengths[:, None])).any(axis=1)
+    if nan_policy == "raise" and hasnan.any():
+        raise ValueError("Series contain NaN values")
+
+    dense = not np.isnan(values).any()
+
+    logtau = np.full((len(values), len(lags)), np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for j, lag in enumerate(lags):
+            if lag >= values.shape[1]:
+                continue
+            diff = values[:, lag:] - values[:, :-lag]
+            if dense:
+                # tau = sqrt(std) -> log tau = log(std) / 2
+                logtau[:, j] = np.log(diff.std(axis=1)) / 2.0
+                continue
+
+            valid = ~np.isnan(diff)
+            n = valid.sum(axis=1)
+            mean = np.where(valid, diff, 0.0).sum(axis=1) / n
+            var = np.where(valid, diff - mean[:, None], 0.0) ** 2
+            # tau = sqrt(std) -> log tau = log(var) / 4
+            logtau[:, j] = np.log(var.sum(axis=1) / n) / 4.0
+
+    res = _hurst_slope(logtau, lags)
+    if nan_policy == "propagate":
+        res[hasnan] = np.nan
+    return res
+
+
+def rolling_hurst(
+    series: Union[np.ndarray, List[np.ndarray]],
+    window: int,
+    lags: Sequence[int] = HURST_LAGS,
+) -> np.ndarray:
+    """
+    Returns the rolling Hurst Exponent of time series, at every time step
+    the hurst value of the window ending there. Per lag the sums of the
+    lagged differences and of their squares are updated as the window
+    slides (prefix sums), O(N) per lag instead of O(N * window).
+
+    Args:
+        - series : 1D array, 2D array (series x time) or list of 1D arrays
+        - window : number of values per window
+        - lags : lags of the differences, each at most window - 2
+
+    Returns:
+        - np.ndarray : Hurst exponents (series x time), NaN for the first
+            window - 1 steps and for windows with NaN values
+    """
+    lags = np.asarray(list(lags), dtype=int)
+    if lags.max() > window - 2:
+        raise ValueError(f"Window {window} too short for lag {lags.max()}")
+
+    values, _ = _as_batch(series)
+    nseries, length = values.shape
+    res = np.full((nseries, length), np.nan)
+    if length < window:
+        return res
+
+    x = np.log(lags) - np.log(lags).mean()
+    slope = np.zeros((nseries, length - window + 1))
+    valid = np.ones(slope.shape, dtype=bool)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for xj, lag in zip(x, lags):
+            diff = values[:, lag:] - values[:, :-lag]
+            isnan = np.isnan(diff)
+
+            # CENTER THE DIFFERENCES, LIMITS THE CANCELLATION IN E[d^2] - E[d]^2
+            diff = np.where(isnan, 0.0, diff)
+            diff -= diff.mean(axis=1, keepdims=True)
+
+            # WINDOW SUMS OF THE m DIFFERENCES IN EACH WINDOW
+            m = window - lag
+            sums = []
+            for v in (diff, diff**2, isnan):
+                c = np.zeros((nseries, v.shape[1] + 1))
+                np.cumsum(v, axis=1, out=c[:, 1:])
+                sums.append(c[:, m:] - c[:, :-m])
+            s1, s2, nnan = sums
+
+            var = np.maximum(s2 / m - (s1 / m) ** 2, 0.0)
+            logtau = np.log(var) / 4.0
+            valid &= np.isfinite(logtau) & (nnan < 0.5)
+
+            # x IS CENTERED - THE SLOPE IS SUM(x * log tau) / SUM(x^2)
+            slope += xj * np.where(np.isfinite(logtau), logtau, 0.0)
+
+    res[:, window - 1 :] = np.where(valid, 2.0 * slope / (x @ x), np.nan)
+    return res
+
+
+# COLUMNS OF THE PRICE LEVELS OF mean_reverting_levels, THE FITTED LINE SHIFTED BY
+# k STANDARD ERRORS OF BOTH SLOPE AND INTERCEPT
+MR_LEVELS = {
+    "stoplossprice": -2,
+    "buylimitorderprice": -1,
+    "sellpricehalf1": 0,
+    "sellpricehalf2": 1,
+}
+
+
+def _window_days(dates: pd.DatetimeIndex, months: int) -> np.ndarray:
+    """
+    Returns the days since the start of the window of the last months per
+    date, NaN for dates outside the window and for repeated calendar days
+    (the first row per day is kept).
+
+    Args:
+        - dates : dates, calendar days are local days for timezone aware dates
+        - months : number of (last) months to select
+    """
+    days = np.full(len(dates), np.nan)
+    if not len(dates):
+        return days
+
+    wall = dates.tz_localize(None) if dates.tz is not None else dates
+    _, first = np.unique(wall.values.astype("datetime64[D]"), return_index=True)
+
+    start = (dates.max() - pd.offsets.DateOffset(months=months)).to_datetime64()
+    instants = dates.values[first]
+    first = first[instants > start]
+    days[first] = (dates.values[first] - start) // np.timedelta64(1, "D")
+    return days
+
+
+def _mean_reverting_window(ohlcv: pd.DataFrame, months: int) -> pd.DataFrame:
+    """
+    Returns the last months of ohlcv, one row per calendar day, with the
+    formatted_date and the days_since the start of the window.
+
+    Args:
+        - ohlcv : prepared ohlcv data with a date column or index
+        - months : number of (last) months to select
+    """
+    ohlcv = ohlcv.reset_index()
+    dates = pd.DatetimeIndex(pd.to_datetime(ohlcv["date"]))
+    days = _window_days(dates, months)
+    window = ~np.isnan(days)
+
+    # INDEX OF THE ROWS AMONG THE ROWS OF THE FIRST PER CALENDAR DAY
+    ohlcv.index = np.cumsum(~dates.normalize().duplicated()) - 1
+
+    ohlcv_red = ohlcv[window].copy()
+    ohlcv_red["formatted_date"] = dates[window].to_series(index=ohlcv_red.index)
+    ohlcv_red["days_since"] = days[window]
+    return ohlcv_red
+
+
+def _window_arrays(ohlcv: pd.DataFrame, months: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the close prices and days_since of _mean_reverting_window
+    without building the frame.
+
+    Args:
+        - ohlcv : prepared ohlcv data with a date column or index
+        - months : number of (last) months to select
+    """
+    if "date" in ohlcv.columns:
+        dates = pd.DatetimeIndex(ohlcv["date"])
+    else:
+        dates = pd.DatetimeIndex(ohlcv.index.get_level_values("date"))
+
+    days = _window_days(dates, months)
+    window = ~np.isnan(days)
+    return ohlcv["close"].values[window], days[window]
+
+
+def linear_fit_batch(
+    x: Union[np.ndarray, List[np.ndarray]], y: Union[np.ndarray, List[np.ndarray]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the least squares fits y = A[0] * x + A[1] of a batch of series
+    in closed form, with the covariance as curve_fit estimates it (scaled by
+    the residual variance). Points with a NaN x or y are left out.
+
+    Args:
+        - x : 1D array, 2D array (series x time) or list of 1D arrays, a 1D
+            array is shared by all series
+        - y : 2D array (series x time), 1D array or list of 1D arrays
+
+    Returns:
+        - np.ndarray : slope and intercept per series (series x 2)
+        - np.ndarray : covariance of slope and intercept per series (series x 2 x 2),
+            NaN for less than 3 points
+    """
+    y, _ = _as_batch(y)
+    x, _ = _as_batch(x)
+    x = np.broadcast_to(x, y.shape)
+
+    valid = np.isfinite(x) & np.isfinite(y)
+    n = valid.sum(axis=1)
+    x, y = np.where(valid, x, 0.0), np.where(valid, y, 0.0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xmean = x.sum(axis=1) / n
+        ymean = y.sum(axis=1) / n
+        dx = np.where(valid, x - xmean[:, None], 0.0)
+        dy = np.where(valid, y - ymean[:, None], 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        slope = (dx * dy).sum(axis=1) / sxx
+        intercept = ymean - slope * xmean
+
+        # RESIDUAL VARIANCE WITH n - 2 DEGREES OF FREEDOM
+        ssr = (np.where(valid, dy - slope[:, None] * dx, 0.0) ** 2).sum(axis=1)
+        s2 = np.where(n > 2, ssr / (n - 2), np.nan)
+
+        B = np.empty((len(y), 2, 2))
+        B[:, 0, 0] = s2 / sxx
+        B[:, 0, 1] = B[:, 1, 0] = -xmean * s2 / sxx
+        B[:, 1, 1] = s2 * (1.0 / n + xmean**2 / sxx)
+
+    return np.stack([slope, intercept], axis=1), B
+
+
+def mean_reverting_levels(A: np.ndarray, B: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """
+    Returns the stop-loss, buy-limit and sell price levels of
+    strategy_mean_reverting for a batch of fits.
+
+    Args:
+        - A : slope and intercept per series (series x 2)
+        - B : covariance of the fit per series (series x 2 x 2)
+        - days : days_since at which to evaluate the levels per series
+
+    Returns:
+        - np.ndarray : levels per series in the order of MR_LEVELS (series x 4)
+    """
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    B = np.asarray(B, dtype=float).reshape(-1, 2, 2)
+    sigma = np.sqrt(np.diagonal(B, axis1=1, axis2=2))
+    k = np.array(list(MR_LEVELS.values()), dtype=float)
+    days = np.asarray(days, dtype=float).reshape(-1, 1)
+    return (A[:, :1] + k * sigma[:, :1]) * days + (A[:, 1:] + k * sigma[:, 1:])
+
+
 def strategy_mean_reverting(ohlcv, months=5, verbose=True, show=True):
     """
 
@@ -50,57 +357,26 @@ def strategy_mean_reverting(ohlcv, months=5, verbose=True, show=True):
     # H=0.5 The time series is a Geometric Brownian Motion
     # H>0.5 The time series is trending
     """
-    ohlcv = ohlcv.reset_index()
-    ohlcv["formatted_date"] = pd.to_datetime(ohlcv["date"])
-    ohlcv = ohlcv.set_index(pd.to_datetime(ohlcv["formatted_date"].dt.date))
-    ohlcv = ohlcv[~ohlcv.index.duplicated()]
-    ohlcv = ohlcv.reset_index(drop=True)
-    # select last three months
-
-    ohlcv_red = ohlcv[
-        ohlcv["formatted_date"]
-        > (ohlcv["formatted_date"].max() - pd.offsets.DateOffset(months=months))
-    ].copy()
-
-    print(ohlcv_red)
+    ohlcv_red = _mean_reverting_window(ohlcv, months)
+
+    logger.debug(ohlcv_red)
     h = hurst(ohlcv_red["close"].values)
     logger.info("Hurst:  {}".format(h))
 
     if h < 0.5:
+        # closed form least squares fit of the straight line close = A[0] * days_since + A[1]
+        A, B = linear_fit_batch(ohlcv_red["days_since"].values, ohlcv_red["close"].values)
+        A, B = A[0], B[0]
 
-        # define linear fit function
-        def f(x, A, B):  # this is your 'straight line' y=f(x)
-            return A * x + B
-
-        # create new column days_since three months for easier fitting
-        ohlcv_red["days_since"] = (
-            ohlcv_red["formatted_date"]
-            - (ohlcv_red["formatted_date"].max() - pd.offsets.DateOffset(months=months))
-        ).astype("timedelta64[D]")
-
-        # use scipy to fit
-        A, B = curve_fit(f, ohlcv_red["days_since"], ohlcv_red["close"])  # your data x, y to fit
-
-        # print scipy fitting if verbose
+        # print fitting if verbose
         if verbose:
             logger.info("a = {} +/- {}".format(A[0], B[0, 0] ** 0.5))
             logger.info("b = {} +/- {}".format(A[1], B[1, 1] ** 0.5))
-            logger.info("b = ", A[1], "+/-", B[1, 1] ** 0.5)
-
-        # use least square from statsmodel
-        sm.OLS(ohlcv_red["days_since"], ohlcv_red["close"])
 
         # calculate prices
-        stoplossprice = (A[0] - 2 * B[0, 0] ** 0.5) * ohlcv_red["days_since"].max() + (
-            A[1] - 2 * B[1, 1] ** 0.5
-        )
-        buylimitorderprice = (A[0] - B[0, 0] ** 0.5) * ohlcv_red["days_since"].max() + (
-            A[1] - B[1, 1] ** 0.5
-        )
-        sellpricehalf1 = (A[0]) * ohlcv_red["days_since"].max() + (A[1])
-        sellpricehalf2 = (A[0] + B[0, 0] ** 0.5) * ohlcv_red["days_since"].max() + (
-            A[1] + B[1, 1] ** 0.5
-        )
+        stoplossprice, buylimitorderprice, sellpricehalf1, sellpricehalf2 = mean_reverting_levels(
+            A, B, ohlcv_red["days_since"].max()
+        )[0]
 
         return (
             True,
@@ -125,6 +401,59 @@ def strategy_mean_reverting(ohlcv, months=5, verbose=True, show=True):
         return False
 
 
+def strategy_mean_reverting_batch(
+    ohlcvs: Dict[str, pd.DataFrame], months: int = 5, lags: Sequence[int] = HURST_LAGS
+) -> pd.DataFrame:
+    """
+    Returns the Hurst exponent, the linear fit and the price levels of
+    strategy_mean_reverting for many symbols at once. The windows are
+    selected per symbol, the Hurst exponents, fits and levels are computed
+    for all symbols in one vectorized pass.
+
+    Args:
+        - ohlcvs : prepared ohlcv data per symbol
+        - months : number of (last) months to select per symbol
+        - lags : lags of the Hurst exponent
+
+    Returns:
+        - pd.DataFrame : per symbol the hurst exponent, mean_reverting (hurst < 0.5),
+            the number of days, last close, slope, intercept and their
+            standard errors and the price levels of MR_LEVELS
+    """
+    symbols, closes, days = [], [], []
+    for symbol, ohlcv in ohlcvs.items():
+        close, days_since = _window_arrays(ohlcv, months)
+        symbols.append(symbol)
+        closes.append(close)
+        days.append(days_since)
+
+    columns = ["hurst", "mean_reverting", "days", "close", "slope", "intercept"]
+    columns += ["slope_err", "intercept_err", *MR_LEVELS]
+    if not symbols:
+        return pd.DataFrame(columns=columns)
+
+    h = hurst_batch(closes, lags)
+    A, B = linear_fit_batch(days, closes)
+    xmax = np.array([d.max() if len(d) else np.nan for d in days])
+    last = np.array([c[-1] if len(c) else np.nan for c in closes])
+
+    res = pd.DataFrame(
+        {
+            "hurst": h,
+            "mean_reverting": h < 0.5,
+            "days": xmax,
+            "close": last,
+            "slope": A[:, 0],
+            "intercept": A[:, 1],
+            "slope_err": np.sqrt(B[:, 0, 0]),
+            "intercept_err": np.sqrt(B[:, 1, 1]),
+        },
+        index=pd.Index(symbols, name="symbol"),
+    )
+    res[list(MR_LEVELS)] = mean_reverting_levels(A, B, xmax)
+    return res[columns]
+
+
 def mr_indicator(ohlcv_red, A, B):
     def f(x, A, B):  # this is your 'straight line' y=f(x)
         return A * x + B
@@ -140,22 +469,18 @@ def mr_indicator(ohlcv_red, A, B):
         ohlcv_red["days_since"], A[0] - 2 * B[0, 0] ** 0.5, A[1] - 2 * B[1, 1] ** 0.5
     )
 
-    diff_neg_sig_1 = (
-        ohlcv_red["close"] < ohlcv_red["neg_sig_1"]
-    )  # & (ohlcv_red['close'] > ohlcv_red['neg_sig_2'])
-    diff_neg_sig_2 = ohlcv_red["close"] < ohlcv_red["neg_sig_2"]
-    diff_pos_sig_1 = ohlcv_red["close"] > ohlcv_red["pos_sig_1"]
-    diff_pos_sig_2 = ohlcv_red["close"] > ohlcv_red["pos_sig_2"]
-
-    diff_neg_sig_1_forward = diff_neg_sig_1.shift(1)
-    diff_neg_sig_2_forward = diff_neg_sig_2.shift(1)
-    diff_pos_sig_1_forward = diff_pos_sig_1.shift(1)
-    diff_pos_sig_2_forward = diff_pos_sig_2.shift(1)
-
-    ohlcv_red["diff_neg_sig_1"] = diff_neg_sig_1 - diff_neg_sig_1_forward
-    ohlcv_red["diff_neg_sig_2"] = diff_neg_sig_2 - diff_neg_sig_2_forward
-    ohlcv_red["diff_pos_sig_1"] = diff_pos_sig_1 - diff_pos_sig_1_forward
-    ohlcv_red["diff_pos_sig_2"] = diff_pos_sig_2 - diff_pos_sig_2_forward
+    # CROSSINGS INTO (+1) AND OUT OF (-1) THE BANDS, NAN ON THE FIRST DAY
+    close = ohlcv_red["close"].to_numpy()
+    crossings = {
+        "diff_neg_sig_1": close < ohlcv_red["neg_sig_1"].to_numpy(),
+        "diff_neg_sig_2": close < ohlcv_red["neg_sig_2"].to_numpy(),
+        "diff_pos_sig_1": close > ohlcv_red["pos_sig_1"].to_numpy(),
+        "diff_pos_sig_2": close > ohlcv_red["pos_sig_2"].to_numpy(),
+    }
+    for name, above in crossings.items():
+        diff = _crossings(above[None, :])[0].astype(float)
+        diff[:1] = np.nan
+        ohlcv_red[name] = diff
 
     conditions = [
         ohlcv_red["diff_neg_sig_2"] == 1,
@@ -167,9 +492,38 @@ def mr_indicator(ohlcv_red, A, B):
 
     indlist = np.select(conditions, choices, default=0)
 
+    ohlcv_red["mr_ind"] = mr_positions(indlist)[0]
+
+    return ohlcv_red
+
+
+# POSITION STATES OF THE MEAN-REVERSION INDICATOR (RUNNING TOTAL 0, 0.5, 1)
+# AND THE SIGNALS (-1, -0.5, 0, 1) AS COLUMNS OF THE TRANSITION TABLES.
+# AT 0.5 A -1 SIGNAL IS IGNORED, THE total + v < 0 CHECK COMES FIRST
+_MR_SIGNALS = np.array([-1.0, -0.5, 0.0, 1.0])
+_MR_NEXT = np.array([[0, 0, 0, 2], [1, 0, 1, 1], [0, 1, 2, 2]])
+_MR_EMIT = np.array([[0.0, 0.0, 0.0, 1.0], [0.0, -0.5, 0.0, 0.0], [-1.0, -0.5, 0.0, 0.0]])
+
+# A MAP OF THE 3 STATES IS CODED AS m[0] * 9 + m[1] * 3 + m[2], _MR_COMPOSE[g * 27 + f]
+# IS THE CODE OF g o f AND _MR_STEP THE CODE OF THE MAP OF EACH SIGNAL
+_MR_MAPS = np.array(np.unravel_index(np.arange(27), (3, 3, 3))).T
+_MR_COMPOSE = np.array(
+    [np.ravel_multi_index(tuple(g[f]), (3, 3, 3)) for g in _MR_MAPS for f in _MR_MAPS],
+    dtype=np.int16,
+)
+_MR_STEP = np.array([np.ravel_multi_index(tuple(m), (3, 3, 3)) for m in _MR_NEXT.T], dtype=np.int16)
+
+
+def _mr_positions_loop(signals: np.ndarray) -> np.ndarray:
+    """
+    Returns the mr_ind values of one signal series, reference loop of mr_indicator.
+
+    Args:
+        - signals : signal values -1, -0.5, 0 or 1
+    """
     total = 0
     ind = []
-    for v in indlist:
+    for v in signals:
         if (total + v) < 0.0:
             ind.append(0)
         elif (total + v) > 1.0:
@@ -180,7 +534,83 @@ def mr_indicator(ohlcv_red, A, B):
         else:
             total += v
             ind.append(v)
+    return np.array(ind, dtype=float)
 
-    ohlcv_red["mr_ind"] = ind
 
-    return ohlcv_red
+def mr_positions(signals: np.ndarray) -> np.ndarray:
+    """
+    Returns the mr_ind values of the mr_indicator position state machine for
+    many signal series at once. The state machine has three states (running
+    total 0, 0.5 and 1), the state before every step is the composition of
+    the transitions before it, computed as a parallel prefix scan of the
+    transition maps in log2(time) vectorized steps.
+
+    Args:
+        - signals : signal values -1, -0.5, 0 or 1, 1D or 2D (series x time)
+
+    Returns:
+        - np.ndarray : mr_ind values (series x time)
+    """
+    signals = np.atleast_2d(np.asarray(signals, dtype=float))
+    inputs = np.searchsorted(_MR_SIGNALS, signals)
+    if not np.array_equal(_MR_SIGNALS[np.minimum(inputs, 3)], signals):
+        raise ValueError("Signals must be -1, -0.5, 0 or 1")
+
+    # INCLUSIVE PREFIX COMPOSITION, maps[t] BECOMES step t o ... o step 0
+    maps = _MR_STEP[inputs]
+    shift = 1
+    while shift < maps.shape[1]:
+        maps[:, shift:] = _MR_COMPOSE[maps[:, shift:] * 27 + maps[:, :-shift]]
+        shift *= 2
+
+    # STATE BEFORE EVERY STEP, STARTING FROM A ZERO TOTAL
+    before = np.zeros(inputs.shape, dtype=np.intp)
+    before[:, 1:] = _MR_MAPS[maps[:, :-1], 0]
+    return _MR_EMIT[before, inputs]
+
+
+def _crossings(above: np.ndarray) -> np.ndarray:
+    """
+    Returns +1 where a condition turns true, -1 where it turns false and 0
+    elsewhere (first step 0), as the difference with the shifted condition.
+
+    Args:
+        - above : boolean conditions (series x time)
+    """
+    res = np.zeros(above.shape, dtype=np.int8)
+    res[:, 1:] = above[:, 1:].astype(np.int8) - above[:, :-1]
+    return res
+
+
+def mr_indicator_batch(
+    close: np.ndarray, days_since: np.ndarray, A: np.ndarray, B: np.ndarray
+) -> np.ndarray:
+    """
+    Returns the mr_ind column of mr_indicator for many symbols at once, on
+    close prices aligned in one array.
+
+    Args:
+        - close : close prices (series x time)
+        - days_since : days of the fit per step, (time) or (series x time)
+        - A : fitted slope and intercept per series (series x 2)
+        - B : covariance of the fit per series (series x 2 x 2)
+
+    Returns:
+        - np.ndarray : mr_ind values (series x time)
+    """
+    close = np.atleast_2d(np.asarray(close, dtype=float))
+    x = np.broadcast_to(np.asarray(days_since, dtype=float), close.shape)
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    sigma = np.sqrt(np.diagonal(np.asarray(B, dtype=float).reshape(-1, 2, 2), axis1=1, axis2=2))
+
+    def line(k: float) -> np.ndarray:
+        return (A[:, :1] + k * sigma[:, :1]) * x + (A[:, 1:] + k * sigma[:, 1:])
+
+    conditions = [
+        _crossings(close < line(-2)) == 1,
+        _crossings(close < line(-1)) == -1,
+        _crossings(close > line(0)) == -1,
+        _crossings(close > line(1)) == -1,
+    ]
+    signals = np.select(conditions, [-1, 1, -0.5, -0.5], default=0)
+    return mr_positions(signals)
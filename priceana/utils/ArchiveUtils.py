@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.ArchiveUtils
+=================================================================
+
+A module containing the raw response archive.
+
+Raw yahoo responses are stored gzip compressed and partitioned
+as <root>/<endpoint>/<symbol>/<YYYY-MM-DD>/<key>.json.gz, where
+endpoint is "chart" or "quoteSummary" and key is a hash of the
+request parameters. The first line of each file is a JSON header
+with the url, parameters and fetch time, the rest is the body as
+received.
+
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import datetime as dt
+from typing import Iterator, List, Optional, Tuple
+
+
+class _ArchiveWriter:
+    """
+    File object writing one archived response. The file is written
+    under a temporary name and only renamed into place on a clean close.
+    """
+
+    def __init__(self, path: str, header: dict):
+        self._path = path
+        # UNIQUE PER WRITER, SEVERAL WRITERS OF ONE PROCESS MAY WRITE THE SAME PATH
+        self._tmppath = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fh = gzip.open(self._tmppath, "wb")
+        self._fh.write(json.dumps(header).encode() + b"\n")
+
+    def write(self, chunk: bytes) -> None:
+        self._fh.write(chunk)
+
+    def close(self, ok: bool = True) -> None:
+        """
+        Close the file, rename it into place if ok, remove it otherwise.
+
+        Args:
+            - ok (bool): the response was written completely
+        """
+        self._fh.close()
+        if ok:
+            os.replace(self._tmppath, self._path)
+        else:
+            os.remove(self._tmppath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(exc_type is None)
+
+
+class ResponseArchive:
+    """
+    Archive of raw yahoo responses, partitioned by endpoint, symbol and date.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @staticmethod
+    def _split_url(url: str) -> Tuple[str, str]:
+        """(endpoint, symbol) from a chart or quoteSummary url."""
+        endpoint, symbol = url.rstrip("/").split("/")[-2:]
+        return endpoint, symbol
+
+    @staticmethod
+    def _params_key(params: dict) -> str:
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+    def path(self, url: str, params: dict, date: Optional[str] = None) -> str:
+        """
+        Public method to get the archive path of a response.
+
+        Args:
+            - url (str): request url
+            - params (dict): request parameters
+            - date (Optional[str]): fetch date (YYYY-MM-DD), defaults to today
+
+        Returns:
+            str: path of the archived response
+        """
+        endpoint, symbol = self._split_url(url)
+        if date is None:
+            date = dt.today().strftime("%Y-%m-%d")
+        return os.path.join(
+            self.root, endpoint, symbol, date, f"{self._params_key(params)}.json.gz"
+        )
+
+    def open_writer(self, url: str, params: dict) -> _ArchiveWriter:
+        """
+        Public method to open a writer for a raw response body.
+
+        Args:
+            - url (str): request url
+            - params (dict): request parameters
+
+        Returns:
+            _ArchiveWriter: context manager, write the body chunks to it
+        """
+        header = {"url": url, "params": params, "fetched": int(time.time())}
+        return _ArchiveWriter(self.path(url, params), header)
+
+    def write(self, url: str, params: dict, body: bytes) -> None:
+        """
+        Public method to archive a complete raw response body.
+
+        Args:
+            - url (str): request url
+            - params (dict): request parameters
+            - body (bytes): raw response body
+        """
+        with self.open_writer(url, params) as fh:
+            fh.write(body)
+
+    def iter_paths(
+        self,
+        endpoint: Optional[str] = None,
+        symbols: Optional[List[str]] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> Iterator[str]:
+        """
+        Public method to list the archived responses.
+
+        Args:
+            - endpoint (Optional[str]): only this endpoint ("chart" or "quoteSummary")
+            - symbols (Optional[List[str]]): only these symbols
+            - start (Optional[str]): first fetch date (YYYY-MM-DD) to include
+            - end (Optional[str]): last fetch date (YYYY-MM-DD) to include
+
+        Returns:
+            Iterator[str]: paths of the archived responses, sorted
+        """
+
+        def listdir(path: str) -> List[str]:
+            return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+        endpoints = [endpoint] if endpoint else listdir(self.root)
+        for ep in endpoints:
+            for symbol in symbols or listdir(os.path.join(self.root, ep)):
+                for date in listdir(os.path.join(self.root, ep, symbol)):
+                    if (start and date < start) or (end and date > end):
+                        continue
+                    folder = os.path.join(self.root, ep, symbol, date)
+                    for fn in listdir(folder):
+                        if fn.endswith(".json.gz"):
+                            yield os.path.join(folder, fn)
+
+    @staticmethod
+    def load(path: str) -> Tuple[dict, dict]:
+        """
+        Public method to read an archived response.
+
+        Args:
+            - path (str): path of the archived response
+
+        Returns:
+            Tuple[dict, dict]: (header, decoded json response), the header
+                holds url, params, fetched and the fetch date
+        """
+        with gzip.open(path, "rb") as fh:
+            header = json.loads(fh.readline())
+            body = json.loads(fh.read())
+
+        header["date"] = os.path.basename(os.path.dirname(path))
+        return header, body
@@ -8,11 +8,12 @@ A module containing methods for getting data asynchronuously.
 
 """
 
-import itertools
+import asyncio
 import time
 from asyncio import Semaphore
+from contextlib import asynccontextmanager
 from datetime import datetime as dt
-from typing import Generator, List, Tuple, Union
+from typing import AsyncIterator, Generator, List, Optional, Tuple, Union
 
 import pandas as pd
 from aiohttp import ClientError, ClientSession
@@ -23,17 +24,76 @@ from pymongo import ASCENDING
 from termcolor import colored
 from tqdm import tqdm
 
-from .DataBroker import DataBrokerMongoDb
+from .ArchiveUtils import ResponseArchive
+from .DataBroker import DataBroker, DataBrokerMongoDb
 from .LoggingUtils import logger
 from .ParseUtils import (
     generate_database_indices_dict,
+    parse_financial_records,
     parse_prices,
     parse_raw_fmt,
-    parse_to_multiindex,
 )
+from .PriceStoreUtils import PriceStore
+from .SchemaUtils import quote_summary_schemas
+from .SpoolUtils import Spool
+from .StreamUtils import parse_chart_stream
 
+# COLLECTION HOLDING THE EXCHANGE TIMEZONE PER SYMBOL
+TIMEZONE_COLLECTION = "ExchangeTimezones"
 
-async def fetch(url: str, params: dict, session: ClientSession) -> dict:
+# SIZE OF THE CHUNKS READ FROM THE SOCKET IN STREAMING MODE
+STREAM_CHUNK_SIZE = 65536
+
+
+@asynccontextmanager
+async def _archive_writer(archive: ResponseArchive, url: str, params: dict):
+    """
+    Private method to open an archive writer without blocking the event loop,
+    the file I/O runs in the default executor. The response is only kept if
+    the block completes.
+
+    Args:
+        - archive (ResponseArchive): archive to write the raw response to
+        - url (str): request url
+        - params (dict): request parameters
+
+    Returns:
+        async context manager yielding the archive writer
+    """
+    loop = asyncio.get_event_loop()
+    writer = await loop.run_in_executor(None, archive.open_writer, url, params)
+    ok = False
+    try:
+        yield writer
+        ok = True
+    finally:
+        await loop.run_in_executor(None, writer.close, ok)
+
+
+async def _tee_chunks(chunks: AsyncIterator[bytes], writer) -> AsyncIterator[bytes]:
+    """
+    Private method to pass body chunks through while writing them to the archive.
+
+    Args:
+        - chunks (AsyncIterator[bytes]): response body chunks
+        - writer: archive writer
+
+    Returns:
+        AsyncIterator[bytes]: the same chunks
+    """
+    loop = asyncio.get_event_loop()
+    async for chunk in chunks:
+        await loop.run_in_executor(None, writer.write, chunk)
+        yield chunk
+
+
+async def fetch(
+    url: str,
+    params: dict,
+    session: ClientSession,
+    stream: bool = False,
+    archive: Optional[ResponseArchive] = None,
+) -> dict:
     """
     Asynchronous fetching of urls.
 
@@ -41,6 +101,10 @@ async def fetch(url: str, params: dict, session: ClientSession) -> dict:
         - url (str): url to fetch
         - params (dict): parameters to pass to the request
         - session (ClientSession): aiohttp client session
+        - stream (bool): incrementally parse a chart response, reading the
+            timestamp and OHLCV arrays straight into NumPy arrays
+        - archive (Optional[ResponseArchive]): archive to write the raw
+            response to (only successful responses are archived)
 
     Returns:
         dict : json response from url
@@ -66,32 +130,60 @@ async def fetch(url: str, params: dict, session: ClientSession) -> dict:
                     color,
                 )
             )
+        if archive is not None and response.status == 200:
+            # KEEP THE RAW RESPONSE FOR OFFLINE REPROCESSING
+            async with _archive_writer(archive, url, params) as writer:
+                if stream:
+                    chunks = response.content.iter_chunked(STREAM_CHUNK_SIZE)
+                    return await parse_chart_stream(_tee_chunks(chunks, writer))
+                body = await response.read()
+                await asyncio.get_event_loop().run_in_executor(None, writer.write, body)
+
+        elif stream:
+            return await parse_chart_stream(response.content.iter_chunked(STREAM_CHUNK_SIZE))
+
         json = await response.json()
         return json
 
 
-async def bound_fetch(sem: Semaphore, url: str, params: dict, session: ClientSession) -> dict:
+async def bound_fetch(
+    sem: Optional[Semaphore],
+    url: str,
+    params: dict,
+    session: ClientSession,
+    stream: bool = False,
+    archive: Optional[ResponseArchive] = None,
+) -> dict:
     """
     Method to restrict the open files (request) in async fetch.
 
     REF: https://pawelmhm.github.io/asyncio/python/aiohttp/2016/04/22/asyncio-aiohttp.html
 
     Args:
-        - sem (Semaphore): internal counter
+        - sem (Optional[Semaphore]): internal counter, None if the caller limits
+            the open requests itself (e.g. a fixed number of workers)
             REF: https://docs.python.org/3/library/asyncio-sync.html#asyncio.Semaphore
         - url (str): url to fetch
         - params (dict): parameters to pass to the request
         - session (ClientSession): aiohttp client session
+        - stream (bool): incrementally parse a chart response
+        - archive (Optional[ResponseArchive]): archive to write the raw response to
 
     Returns:
         dict : json response from url
     """
+    if sem is None:
+        return await fetch(url, params, session, stream, archive)
     async with sem:
-        return await fetch(url, params, session)
+        return await fetch(url, params, session, stream, archive)
 
 
 async def aparse_yahoo_prices(
-    sem: Semaphore, tup: Tuple[str, dict], session: ClientSession
+    sem: Optional[Semaphore],
+    tup: Tuple[str, dict],
+    session: ClientSession,
+    stream: bool = False,
+    archive: Optional[ResponseArchive] = None,
 ) -> Tuple[
     Union[str, None],
     Union[pd.DataFrame, None],
@@ -102,10 +194,12 @@ async def aparse_yahoo_prices(
     Method to get and clean the yahoo price data.
 
     Args:
-        - sem (Semaphore): internal counter
+        - sem (Optional[Semaphore]): internal counter, see bound_fetch
             REF: https://docs.python.org/3/library/asyncio-sync.html#asyncio.Semaphore
         - tup (Tuple[str, dict]): (url, params)
         - session (ClientSession): aiohttp client session
+        - stream (bool): incrementally parse the chart response
+        - archive (Optional[ResponseArchive]): archive to write the raw response to
 
     Returns:
         Tuple[ Union[str, None], Union[pd.DataFrame, None],
@@ -115,7 +209,7 @@ async def aparse_yahoo_prices(
     try:
         url, params = tup
         print(url, params)
-        resp = await bound_fetch(sem, url, params, session)
+        resp = await bound_fetch(sem, url, params, session, stream, archive)
         resp = resp["chart"]["result"][0]
         interval, pricedata, div, split = parse_prices(resp)
 
@@ -144,8 +238,12 @@ async def store_yahoo_prices(
     sem: Semaphore,
     tup: Tuple[str, dict],
     session: ClientSession,
-    databroker: DataBrokerMongoDb,
+    databroker: DataBroker,
     dbname: str = "FinData",
+    stream: bool = False,
+    archive: Optional[ResponseArchive] = None,
+    pricestore: Optional[PriceStore] = None,
+    spool: Optional[Spool] = None,
 ):
     """
     Method to get, clean and store (mongodb via DataBroker) the yahoo price data.
@@ -154,8 +252,13 @@ async def store_yahoo_prices(
         - sem: internal counter https://docs.python.org/3/library/asyncio-sync.html#asyncio.Semaphore
         - tup: (url, params)
         - session: aiohttp client session
-        - databroker: DataBrokerMongoDb instance
+        - databroker: DataBroker instance
         - dbname: name of the database to write the data to
+        - stream: incrementally parse the chart response
+        - archive: archive to write the raw response to
+        - pricestore: memory-mapped store to append the prices to
+        - spool: local spool to append the records to, drained into the databroker
+            by a SpoolFlusher
 
     """
     # ASYNC GET AND PARSE DATA
@@ -163,7 +266,67 @@ async def store_yahoo_prices(
     prices: Union[pd.DataFrame, None] = None
     div: Union[pd.DataFrame, None] = None
     split: Union[pd.DataFrame, None] = None
-    interval, prices, div, split = await aparse_yahoo_prices(sem, tup, session)
+    interval, prices, div, split = await aparse_yahoo_prices(sem, tup, session, stream, archive)
+
+    save_yahoo_prices(
+        databroker, dbname, tup[0].split("/")[-1], interval, prices, div, split, pricestore, spool
+    )
+
+
+def _save_cataloged(
+    databroker: DataBroker,
+    data: List[dict],
+    dbname: str,
+    col: str,
+    indexTupleList: List[Tuple[str, int]],
+    spool: Optional[Spool] = None,
+    **kwargs,
+):
+    """
+    Private method to save records and record them in the coverage catalog
+    of brokers that keep one. With a spool the records are only appended to
+    it, its flusher saves them.
+    """
+    if spool is not None:
+        spool.save(data, dbname, col, indexTupleList, **kwargs)
+        return
+
+    if hasattr(databroker, "save_cataloged"):
+        databroker.save_cataloged(data, dbname, col, indexTupleList, **kwargs)
+    else:
+        databroker.save(data, dbname, col, indexTupleList, **kwargs)
+
+
+def save_yahoo_prices(
+    databroker: DataBroker,
+    dbname: str,
+    name: str,
+    interval: Union[str, None],
+    prices: Union[pd.DataFrame, None],
+    div: Union[pd.DataFrame, None],
+    split: Union[pd.DataFrame, None],
+    pricestore: Optional[PriceStore] = None,
+    spool: Optional[Spool] = None,
+) -> bool:
+    """
+    Method to store parsed yahoo price data (mongodb via DataBroker).
+
+    Args:
+        - databroker: DataBroker instance
+        - dbname: name of the database to write the data to
+        - name: symbol, used in the log messages
+        - interval: price time-series interval, used as collection name
+        - prices: parsed prices
+        - div: parsed dividends
+        - split: parsed splits
+        - pricestore: memory-mapped store to append the prices to
+        - spool: local spool to append the records to instead of saving them
+
+    Returns:
+        bool: True if all saves succeeded, failed saves (also database errors)
+            are logged
+    """
+    ok = True
 
     # SET DATABASE INDEX FOR THE DATA
     index: List[Tuple[str, int]] = [("symbol", ASCENDING), ("date", ASCENDING)]
@@ -175,58 +338,80 @@ async def store_yahoo_prices(
     if prices is not None:
         if not prices.empty:
             try:
-                databroker.save(
+                _save_cataloged(
+                    databroker,
                     prices.reset_index().to_dict(orient="records"),
                     dbname,
                     interval,
                     index,
+                    spool,
                 )
-            except ValueError:
+
+                # NATIVE UTC DATETIMES - KEEP THE EXCHANGE TIMEZONE AS METADATA
+                timezone = prices.attrs.get("exchangeTimezoneName")
+                if getattr(databroker, "datetime_mode", "string") == "native" and timezone:
+                    _save_cataloged(
+                        databroker,
+                        [{"symbol": name, "exchangeTimezoneName": timezone}],
+                        dbname,
+                        TIMEZONE_COLLECTION,
+                        [("symbol", ASCENDING)],
+                        spool,
+                    )
+            except Exception:
+                ok = False
                 logger.exception(
-                    colored(
-                        f"Failed saving prices for {tup[0].split('/')[-1]} - interval {interval}"
-                    ),
-                    "red",
+                    colored(f"Failed saving prices for {name} - interval {interval}", "red"),
                 )
 
+            # INCREMENTAL APPEND TO THE READ-OPTIMIZED STORE
+            if pricestore is not None:
+                pricestore.append_frame(name, interval, prices)
+
     indexdiv = [("symbol", ASCENDING), ("date", ASCENDING)]
 
     if div is not None:
         # STORE DIVIDENDS
         try:
-            databroker.save(
+            _save_cataloged(
+                databroker,
                 div.reset_index().to_dict(orient="records"),
                 dbname,
                 "Dividends",
-                indexTupleList=indexdiv,
+                indexdiv,
+                spool,
             )
-        except ValueError:
+        except Exception:
+            ok = False
             logger.exception(
-                colored(
-                    f"Failed saving dividends for {tup[0].split('/')[-1]} - interval {interval}"
-                ),
-                "red",
+                colored(f"Failed saving dividends for {name} - interval {interval}", "red"),
             )
     if split is not None:
         # STORE SPLITS
         try:
-            databroker.save(
+            _save_cataloged(
+                databroker,
                 split.reset_index().to_dict(orient="records"),
                 dbname,
                 "Splits",
-                indexTupleList=indexdiv,
+                indexdiv,
+                spool,
             )
-        except ValueError:
+        except Exception:
+            ok = False
             logger.exception(
-                colored(f"Failed saving splits for {tup[0].split('/')[-1]} - interval {interval}"),
-                "red",
+                colored(f"Failed saving splits for {name} - interval {interval}", "red"),
             )
 
-    logger.debug(colored(f'Saving {tup[0].split("/")[-1]:8} - {interval} done !', "green"))
+    logger.debug(colored(f"Saving {name:8} - {interval} done !", "green"))
+    return ok
 
 
 async def aparse_raw_yahoo_financial_data(
-    sem: Semaphore, tup: Tuple[str, dict], session: ClientSession
+    sem: Semaphore,
+    tup: Tuple[str, dict],
+    session: ClientSession,
+    archive: Optional[ResponseArchive] = None,
 ) -> dict:
     """Method to async get and parse yahoo raw financial data.
 
@@ -234,13 +419,14 @@ async def aparse_raw_yahoo_financial_data(
         sem (Semaphore): semaphore
         tup (Tuple[str, dict]): (url, param])
         session (ClientSession): asynch ClientSession instance
+        archive (Optional[ResponseArchive]): archive to write the raw response to
 
     Returns:
         dict: key is data info and values are the actual data
     """
     try:
         url, params = tup
-        resp = await bound_fetch(sem, url, params, session)
+        resp = await bound_fetch(sem, url, params, session, archive=archive)
         resp = resp["quoteSummary"]["result"][0]
         cleaned_resp = parse_raw_fmt(resp)
         logger.debug(f"Cleaning done for {tup[0].split('/')[-1]}")
@@ -263,7 +449,10 @@ async def aparse_raw_yahoo_financial_data(
 
 
 async def aparse_multiindex_yahoo_financial_data(
-    sem: Semaphore, tup: Tuple[str, dict], session: ClientSession
+    sem: Semaphore,
+    tup: Tuple[str, dict],
+    session: ClientSession,
+    archive: Optional[ResponseArchive] = None,
 ) -> Generator:
     """Method to async get and transform data into multi-index. Part of
     stage wise cleaning of the raw data.
@@ -272,6 +461,7 @@ async def aparse_multiindex_yahoo_financial_data(
         sem (Semaphore): semaphore
         tup (Tuple[str, dict]): (url, params])
         session (ClientSession): asynch clientsession instance
+        archive (Optional[ResponseArchive]): archive to write the raw response to
 
     Returns:
         Generator: multi-index dict
@@ -280,18 +470,33 @@ async def aparse_multiindex_yahoo_financial_data(
         Generator: multi-index dict
     """
     try:
-        data = await aparse_raw_yahoo_financial_data(sem, tup, session)
-        transformed_financial_data = parse_to_multiindex(data)
+        url, params = tup
+        resp = await bound_fetch(sem, url, params, session, archive=archive)
+        resp = resp["quoteSummary"]["result"][0]
+
+        # KNOWN MODULES ARE PARSED BY THEIR COMPILED SCHEMA
+        transformed_financial_data = iter(quote_summary_schemas.parse(resp))
         logger.debug(f"Multi-indexing done for {tup[0].split('/')[-1]}")
         return transformed_financial_data
 
+    except (ClientError, HttpProcessingError) as e:
+        logger.error(
+            "aiohttp exception for %s [%s]: %s",
+            tup[0],
+            getattr(e, "status", None),
+            getattr(e, "message", None),
+        )
+        return ({} for i in range(0))
     except Exception as e:
         logger.exception("Non-aiohttp exception occured:  %s", getattr(e, "__dict__", {}))
         return ({} for i in range(0))
 
 
 async def aparse_yahoo_financial_data(
-    sem: Semaphore, tup: Tuple[str, dict], session: ClientSession
+    sem: Semaphore,
+    tup: Tuple[str, dict],
+    session: ClientSession,
+    archive: Optional[ResponseArchive] = None,
 ) -> dict:
     """Next step in the data cleaning process for financial data.
 
@@ -299,70 +504,18 @@ async def aparse_yahoo_financial_data(
         - sem (Semaphore): semphore
         - tup (Tuple[str, dict]): (url, params)
         - session (ClientSession): async ClientSession
+        - archive (Optional[ResponseArchive]): archive to write the raw response to
 
     Returns:
         dict: data dict
     """
-    # FINANCIAL DATA NOT CONTAINING SOME KIND
-    # OF DATE REFERENCE NEED MANUAL ADDING OF DATE
-    DATEUPDATELIST = [
-        "assetProfile",
-        "recommendationTrend_trend",
-        "indexTrend_estimates",
-        "indexTrend",
-        "defaultKeyStatistics",
-        "summaryDetail",
-        "calendarEvents_earnings",
-        "price",
-        "earningsTrend_trend_earningsEstimate",
-        "earningsTrend_trend_revenueEstimate",
-        "earningsTrend_trend_epsTrend",
-        "earningsTrend_trend_epsRevisions",
-        "earningsTrend_trend",
-        "majorHoldersBreakdown",
-        "earningsHistory_history",
-        "netSharePurchaseActivity",
-        "insiderTransactions_transactions",
-        "financialData",
-        "quoteType",
-        "calendarEvents",
-        "esgScores_peerEsgScorePerformance",
-        "esgScores_peerEnvironmentPerformance",
-        "esgScores_peerEsgScorePerformance",
-        "esgScores_peerGovernancePerformance",
-        "esgScores_peerHighestControversyPerformance",
-        "esgScores_peerSocialPerformance",
-        "majorDirectHolders_holders",
-    ]
     try:
-        tf = await aparse_multiindex_yahoo_financial_data(sem, tup, session)
-        tfd = list(tf)
-
-        _keys = [k for k, g in itertools.groupby(tfd, lambda x: list(x.keys())[0])]
-        cglist = [
-            list(map(lambda d: list(d.values())[0], list(g)))
-            for k, g in itertools.groupby(tfd, lambda x: list(x.keys())[0])
-        ]
-        dc = dict(zip(_keys, cglist))
-
-        dc = {
-            k: v for k, v in dc.items() if v not in [[None], [{"maxAge": 86400}], [{"maxAge": 1}]]
-        }
-        dfsdc = {"_".join(k): pd.DataFrame(v) for k, v in dc.items()}
+        tf = await aparse_multiindex_yahoo_financial_data(sem, tup, session, archive)
         date = dt.fromtimestamp(time.mktime(dt.today().date().timetuple()))
 
         current_symbol = tup[0].split("/")[-1]
 
-        for k, v in dfsdc.items():
-            if k in DATEUPDATELIST:
-                v["date"] = date.strftime("%Y-%m-%d")
-                if k == "majorHoldersBreakdown":
-                    v["reportDate"] = date.strftime("%Y-%m-%d")
-
-            if k != "quoteType":
-                v["symbol"] = current_symbol
-
-        data = {k: v.to_dict(orient="records") for k, v in dfsdc.items()}
+        data = parse_financial_records(list(tf), current_symbol, date.strftime("%Y-%m-%d"))
 
         logger.info(f"Processing financial data {current_symbol} - done!")
 
@@ -377,8 +530,10 @@ async def store_yahoo_financial_data(
     sem: Semaphore,
     tup: Tuple[str, dict],
     session: ClientSession,
-    databroker: DataBrokerMongoDb,
+    databroker: DataBroker,
     dbname: str = "FinData",
+    archive: Optional[ResponseArchive] = None,
+    spool: Optional[Spool] = None,
 ):
     """Storing in database step of the data cleaning process.
 
@@ -386,10 +541,28 @@ async def store_yahoo_financial_data(
         - sem (Semaphore): semaphore
         - tup (Tuple[str, dict]): (url, params)
         - session (ClientSession): async ClientSession
-        - databroker (DataBrokerMongoDb): MongoDb databroker instance
+        - databroker (DataBroker): databroker instance
         - dbname (str, optional): Name of the database to store in. Defaults to "FinData".
+        - archive (Optional[ResponseArchive]): archive to write the raw response to
+        - spool (Optional[Spool]): local spool to append the records to
+    """
+    findata = await aparse_yahoo_financial_data(sem, tup, session, archive)
+
+    save_yahoo_financial_data(databroker, dbname, tup[0].split("/")[-1], findata, spool)
+
+
+def save_yahoo_financial_data(
+    databroker: DataBroker, dbname: str, name: str, findata: dict, spool: Optional[Spool] = None
+):
+    """Storing parsed financial data in the database.
+
+    Args:
+        - databroker (DataBroker): databroker instance
+        - dbname (str): Name of the database to store in
+        - name (str): symbol, used in the log messages
+        - findata (dict): parsed financial data, keys are the table names
+        - spool (Optional[Spool]): local spool to append the records to instead of saving them
     """
-    findata = await aparse_yahoo_financial_data(sem, tup, session)
     indexdict = generate_database_indices_dict(findata)
 
     newindexdict = {}
@@ -405,6 +578,6 @@ async def store_yahoo_financial_data(
     for k, v in findata.items():
         # logger.info(k, newindexdict[k])
         # vv = deepcopy(v)  # otherwise the original dict (self._yh_finjson) is updated with _id field
-        databroker.save(v, dbname, k, indexTupleList=newindexdict[k], unique=True)
+        _save_cataloged(databroker, v, dbname, k, newindexdict[k], spool, unique=True)
 
-    logger.info(colored(f'Saving {tup[0].split("/")[-1]} yahoo financials done !', "green"))
+    logger.info(colored(f"Saving {name} yahoo financials done !", "green"))
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.BucketUtils
+=================================================================
+
+A module containing methods for the bucketed price document layout.
+
+Instead of one document per bar, a bucket document holds all bars of
+one symbol for one day (intraday, "datetime" time field) or one year
+(daily and longer, "date" time field) as parallel arrays:
+
+    {
+        "symbol": "abc", "bucket": "2020", "timefield": "date", "count": 2,
+        "first": "2020-01-02", "last": "2020-01-03", "version": 3,
+        "const": {"currency": "USD", "exchange": "F"},
+        "cols": {"date": [...], "open": [...], ..., "volume": [...]},
+    }
+
+Fields with the same value for all bars of a bucket are stored once
+in "const". Buckets are transparently unpacked into records again,
+fields a record did not have are left out.
+
+The version is incremented on every write. A writer replaces a bucket
+only if its version did not change since it was read and retries
+otherwise, so concurrent writers to the same bucket do not lose bars.
+
+"""
+from typing import Any, Dict, Iterator, List, Tuple
+
+# NUMBER OF LEADING CHARACTERS OF THE TIME VALUE FORMING THE BUCKET KEY
+BUCKET_KEY_LENGTH = {"date": 4, "datetime": 10}
+
+# FIELDS OF A BUCKET DOCUMENT BESIDES THE KEY FIELDS OF THE SERIES
+BUCKET_FIELDS = ("bucket", "timefield", "count", "first", "last", "version", "const", "cols")
+
+_RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+
+def bucket_key(value: str, timefield: str) -> str:
+    """
+    Method to get the bucket of a time value.
+
+    Args:
+        - value (str): "YYYY-MM-DD" date or ISO datetime
+        - timefield (str): "date" (yearly buckets) or "datetime" (daily buckets)
+
+    Returns:
+        str: bucket key
+    """
+    return str(value)[: BUCKET_KEY_LENGTH.get(timefield, 4)]
+
+
+def group_records(
+    records: List[Dict], keyfields: List[str], timefield: str
+) -> Dict[Tuple, List[Dict]]:
+    """
+    Method to group records per bucket.
+
+    Args:
+        - records (List[Dict]): price records
+        - keyfields (List[str]): fields identifying the series, e.g. ["symbol"]
+        - timefield (str): time field of the records
+
+    Returns:
+        Dict[Tuple, List[Dict]]: (key values..., bucket) -> records
+    """
+    groups: Dict[Tuple, List[Dict]] = {}
+    for rec in records:
+        key = tuple(rec.get(k) for k in keyfields) + (bucket_key(rec[timefield], timefield),)
+        groups.setdefault(key, []).append(rec)
+
+    return groups
+
+
+def build_bucket(
+    key: Tuple, keyfields: List[str], timefield: str, records: List[Dict], version: int = 1
+) -> Dict[str, Any]:
+    """
+    Method to pack the records of a bucket into a bucket document.
+
+    Args:
+        - key (Tuple): (key values..., bucket)
+        - keyfields (List[str]): fields identifying the series
+        - timefield (str): time field of the records
+        - records (List[Dict]): records of the bucket, unique on the time field
+        - version (int): version of the bucket document
+
+    Returns:
+        Dict[str, Any]: bucket document
+    """
+    records = sorted(records, key=lambda r: r[timefield])
+
+    fields: Dict[str, None] = {}
+    for rec in records:
+        for k in rec:
+            if k not in keyfields and k != "_id":
+                fields.setdefault(k, None)
+
+    const: Dict[str, Any] = {}
+    cols: Dict[str, list] = {}
+    for k in fields:
+        values = [rec.get(k) for rec in records]
+        if k != timefield and all(v == values[0] for v in values):
+            const[k] = values[0]
+        else:
+            cols[k] = values
+
+    doc: Dict[str, Any] = dict(zip(keyfields, key[:-1]))
+    doc.update(
+        {
+            "bucket": key[-1],
+            "timefield": timefield,
+            "count": len(records),
+            "first": records[0][timefield],
+            "last": records[-1][timefield],
+            "version": version,
+            "const": const,
+            "cols": cols,
+        }
+    )
+    return doc
+
+
+def unpack_bucket(doc: Dict[str, Any], keyfields: List[str]) -> Iterator[Dict]:
+    """
+    Method to unpack a bucket document into records.
+
+    Args:
+        - doc (Dict[str, Any]): bucket document
+        - keyfields (List[str]): fields identifying the series
+
+    Returns:
+        Iterator[Dict]: records, sorted on the time field
+    """
+    keys = {k: doc[k] for k in keyfields if k in doc}
+    const = {k: v for k, v in doc["const"].items() if v is not None}
+    cols = doc["cols"]
+    names = list(cols)
+    for row in zip(*(cols[k] for k in names)):
+        rec = dict(keys)
+        # NONE FILLS THE COLUMNS OF THE RECORDS WITHOUT THE FIELD
+        rec.update((k, v) for k, v in zip(names, row) if v is not None)
+        rec.update(const)
+        yield rec
+
+
+def bucket_query(searchdict: Dict, keyfields: List[str]) -> Dict:
+    """
+    Method to translate a record query into a bucket query. Conditions
+    on the key fields are kept, conditions on the time field are mapped
+    onto the bucket keys, all other conditions are left to match_record.
+
+    Args:
+        - searchdict (Dict): mongo query on the records
+        - keyfields (List[str]): fields identifying the series
+
+    Returns:
+        Dict: mongo query on the bucket documents
+    """
+    query: Dict = {}
+    for k, v in searchdict.items():
+        if k in keyfields:
+            query[k] = v
+        elif k in BUCKET_KEY_LENGTH:
+            query["timefield"] = k
+            if isinstance(v, dict):
+                cond = {}
+                for op, value in v.items():
+                    if op in ("$gt", "$gte"):
+                        cond["$gte"] = bucket_key(value, k)
+                    elif op in ("$lt", "$lte"):
+                        cond["$lte"] = bucket_key(value, k)
+                    elif op == "$in":
+                        cond["$in"] = sorted({bucket_key(x, k) for x in value})
+                if cond:
+                    query["bucket"] = cond
+            else:
+                query["bucket"] = bucket_key(v, k)
+
+    return query
+
+
+def match_record(rec: Dict, searchdict: Dict) -> bool:
+    """
+    Method to evaluate a simple mongo query on a record. Supports equality
+    and the $gt, $gte, $lt, $lte, $in, $nin and $ne operators.
+
+    Args:
+        - rec (Dict): record
+        - searchdict (Dict): mongo query
+
+    Returns:
+        bool: True if the record matches
+    """
+    for k, cond in searchdict.items():
+        value = rec.get(k)
+        if not isinstance(cond, dict):
+            if value != cond:
+                return False
+            continue
+
+        for op, arg in cond.items():
+            if op in _RANGE_OPERATORS and value is None:
+                return False
+            if (
+                (op == "$gt" and not value > arg)
+                or (op == "$gte" and not value >= arg)
+                or (op == "$lt" and not value < arg)
+                or (op == "$lte" and not value <= arg)
+                or (op == "$in" and value not in arg)
+                or (op == "$nin" and value in arg)
+                or (op == "$ne" and value == arg)
+            ):
+                return False
+            if op not in _RANGE_OPERATORS | {"$in", "$nin", "$ne"}:
+                raise ValueError(f"Unsupported operator {op} on bucketed collection")
+
+    return True
+
+
+def project_record(rec: Dict, selectiondict: Dict) -> Dict:
+    """
+    Method to apply a mongo projection to a record.
+
+    Args:
+        - rec (Dict): record
+        - selectiondict (Dict): mongo projection, _id is ignored
+
+    Returns:
+        Dict: projected record
+    """
+    fields = {k: v for k, v in selectiondict.items() if k != "_id"}
+    if not fields:
+        return rec
+    if any(fields.values()):
+        return {k: rec[k] for k in fields if fields[k] and k in rec}
+    return {k: v for k, v in rec.items() if k not in fields}
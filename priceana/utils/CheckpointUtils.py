@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.CheckpointUtils
+=================================================================
+
+A module containing the checkpoint of completed download work units.
+
+A work unit is one (url, params) tuple of generate_combinations. The
+checkpoint is an append-only file with one JSON line [url, params] per
+completed unit, flushed on every mark so a crash loses at most the
+units in flight. A torn last line of a crashed run is ignored.
+
+Volatile parameters are left out of the keys: without an end date
+period2 is the time of the run, a resumed run has a later one.
+
+"""
+import json
+import os
+import threading
+from typing import Iterable, List, Sequence, Tuple
+
+# REQUEST PARAMETERS THAT CHANGE FROM RUN TO RUN
+VOLATILE_PARAMS = ("period2",)
+
+
+class Checkpoint:
+    """
+    Persistent set of the completed (url, params) work units of a run.
+    """
+
+    def __init__(self, path: str, resume: bool = True, volatile: Sequence[str] = VOLATILE_PARAMS):
+        """
+        Args:
+            - path (str): checkpoint file
+            - resume (bool): keep the units completed by earlier runs,
+                start from an empty checkpoint otherwise
+            - volatile (Sequence[str]): parameters left out of the keys
+        """
+        self.path = path
+        self.volatile = tuple(volatile)
+        self.completed = set()
+        self._lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if resume and os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        url, params = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.completed.add(self.key((url, params)))
+
+        self._fh = open(path, "a" if resume else "w")
+
+        # TERMINATE A TORN LAST LINE, THE NEXT MARK STARTS ON A NEW LINE
+        if resume and self._fh.tell() > 0:
+            with open(path, "rb") as fh:
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != b"\n":
+                    self._fh.write("\n")
+
+    def key(self, tup: Tuple[str, dict]) -> str:
+        """
+        Public method to get the key of a work unit, independent of the
+        order of the parameters and without the volatile ones.
+
+        Args:
+            - tup (Tuple[str, dict]): (url, params)
+
+        Returns:
+            str: key
+        """
+        url, params = tup
+        params = {k: v for k, v in params.items() if k not in self.volatile}
+        return json.dumps([url, params], sort_keys=True)
+
+    def __contains__(self, tup: Tuple[str, dict]) -> bool:
+        return self.key(tup) in self.completed
+
+    def __len__(self) -> int:
+        return len(self.completed)
+
+    def pending(self, combinations: Iterable[Tuple[str, dict]]) -> List[Tuple[str, dict]]:
+        """
+        Public method to drop the completed units from the combinations.
+
+        Args:
+            - combinations (Iterable[Tuple[str, dict]]): (url, params) tuples
+
+        Returns:
+            List[Tuple[str, dict]]: units still to do
+        """
+        return [tup for tup in combinations if tup not in self]
+
+    def mark(self, tup: Tuple[str, dict]):
+        """
+        Public method to record a completed unit.
+
+        Args:
+            - tup (Tuple[str, dict]): (url, params)
+        """
+        key = self.key(tup)
+        with self._lock:
+            if key in self.completed:
+                return
+            self.completed.add(key)
+            self._fh.write(key + "\n")
+            self._fh.flush()
+
+    @property
+    def closed(self) -> bool:
+        return self._fh.closed
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,20 +1,378 @@
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime as dt
+from concurrent.futures import Future, ThreadPoolExecutor
 from pprint import pprint
-from typing import Any, Dict, List, Tuple, Union
+from itertools import groupby, islice
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
 from pymongo.errors import BulkWriteError
 from termcolor import colored
 from tqdm import tqdm
 
+from .BucketUtils import (
+    BUCKET_FIELDS,
+    BUCKET_KEY_LENGTH,
+    build_bucket,
+    bucket_query,
+    group_records,
+    match_record,
+    project_record,
+    unpack_bucket,
+)
+from .DateTimeUtils import (
+    DATETIME_FIELDS,
+    native_collection,
+    native_query,
+    native_record,
+    to_utc_datetime,
+)
 from .LoggingUtils import logger
 
 
-class DataBrokerMongoDb:
+def index_fields(indexTupleList: List[Union[Tuple[str, Any], str]]) -> List[str]:
+    """
+    Method to get the field names of an index given as mongo index tuples
+    or as plain field names.
+
+    Args:
+        - indexTupleList (List[Union[Tuple[str, Any], str]]): index definition
+
+    Returns:
+        List[str]: index field names
+    """
+    return [t if isinstance(t, str) else t[0] for t in indexTupleList]
+
+
+# COLLECTION OF THE COVERAGE CATALOG, ONE DOCUMENT PER (collection, symbol)
+CATALOG_COLLECTION = "Catalog"
+
+# RETRIES OF A BUCKET WRITE THAT CONFLICTS WITH A CONCURRENT WRITER
+BUCKET_RETRIES = 10
+
+
+def column_array(values: Sequence) -> np.ndarray:
+    """
+    Method to convert a column to a NumPy array: int64 for integer columns,
+    float64 for numeric columns (None becomes NaN), bool for boolean
+    columns without gaps, datetime64[ns] (UTC) for datetime columns (None
+    becomes NaT), object otherwise.
+
+    Args:
+        - values (Sequence): column values
+
+    Returns:
+        np.ndarray: typed column
+    """
+    numeric = all(
+        v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values
+    )
+    if numeric and len(values):
+        if any(v is None or isinstance(v, float) for v in values):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        return np.array(values, dtype=np.int64)
+    if len(values) and all(isinstance(v, (bool, np.bool_)) for v in values):
+        return np.array(values, dtype=bool)
+    if len(values) and all(v is None or isinstance(v, dt) for v in values):
+        return pd.to_datetime(list(values), utc=True).tz_localize(None).to_numpy()
+
+    out = np.empty(len(values), dtype=object)
+    out[:] = list(values)
+    return out
+
+
+class LoadCache:
+    """
+    LRU cache of load results keyed by (db, col, query, projection) and
+    bounded by the total number of cached records. Results are stored and
+    returned as shallow copies, callers may modify them.
+
+    Each collection and database has a generation that invalidate increments,
+    results of loads that overlapped an invalidation are not stored.
+    """
+
+    def __init__(self, max_records: int):
+        self.max_records = max_records
+
+        self._entries: "OrderedDict[tuple, List[dict]]" = OrderedDict()
+        self._records = 0
+        self._generations: Dict[Tuple[str, Optional[str]], int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(db: str, col: str, searchdict: Dict, selectiondict: Dict) -> tuple:
+        """
+        Public method to get the normalized cache key of a load.
+
+        Returns:
+            tuple: (db, col, query json, projection json), with sorted keys
+        """
+        return (
+            db,
+            col,
+            json.dumps(searchdict, sort_keys=True, default=str),
+            json.dumps(selectiondict, sort_keys=True, default=str),
+        )
+
+    def get(self, key: tuple) -> Optional[List[dict]]:
+        """Public method to get a cached load result, None on a miss."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return [dict(doc) for doc in value]
+
+    def _generation(self, db: str, col: str) -> Tuple[int, int]:
+        return self._generations.get((db, None), 0), self._generations.get((db, col), 0)
+
+    def generation(self, db: str, col: str) -> Tuple[int, int]:
+        """Public method to get the generation to pass to put, taken before loading."""
+        with self._lock:
+            return self._generation(db, col)
+
+    def put(self, key: tuple, value: List[dict], generation: Tuple[int, int]):
+        """
+        Public method to store a load result, evicting the least recently
+        used results beyond max_records.
+
+        Args:
+            - key (tuple): cache key
+            - value (List[dict]): load result
+            - generation (Tuple[int, int]): generation taken before the load
+        """
+        if len(value) > self.max_records:
+            return
+
+        value = [dict(doc) for doc in value]
+        with self._lock:
+            if self._generation(*key[:2]) != generation:
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._records -= len(old)
+            self._entries[key] = value
+            self._records += len(value)
+
+            while self._records > self.max_records:
+                _, evicted = self._entries.popitem(last=False)
+                self._records -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, db: str, col: Optional[str] = None):
+        """
+        Public method to drop the cached results of a collection, or of
+        all collections of a database if col is None.
+
+        Args:
+            - db (str): database name
+            - col (Optional[str]): collection name
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == db and (col is None or key[1] == col):
+                    self._records -= len(self._entries.pop(key))
+                    self.invalidations += 1
+
+            self._generations[(db, col)] = self._generations.get((db, col), 0) + 1
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "records": self._records,
+            }
+
+
+class DataBroker(ABC):
+    """
+    Protocol of the storage backends. Any class defining save, load, update
+    and get_number_of_documents is accepted as a DataBroker, subclassing is
+    optional.
+    """
+
+    _PROTOCOL = ("save", "load", "update", "get_number_of_documents")
+
+    @classmethod
+    def __subclasshook__(cls, C):
+        if cls is DataBroker:
+            if all(any(m in B.__dict__ for B in C.__mro__) for m in cls._PROTOCOL):
+                return True
+        return NotImplemented
+
+    @abstractmethod
+    def save(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        unique: bool = True,
+    ) -> Dict[str, int]:
+        """Save records, returns the number of inserted, updated and unchanged records."""
+
+    @abstractmethod
+    def load(self, db: str, col: str, searchdict: Dict, selectiondict={}) -> List[dict]:
+        """Load the records matching a mongo style query and projection."""
+
+    @abstractmethod
+    def update(self, db: str, col: str, myquery, newvalues):
+        """Update the records matching a mongo style query with a $set dict."""
+
+    @abstractmethod
+    def get_number_of_documents(self, db: str, col: str) -> int:
+        """Number of records stored in a collection."""
+
+
+class DataBrokerMongoDb(DataBroker):
     """
     DataBroker that interacts with mongodb.
+
+    Write modes:
+        - "insert": insert_many, documents with existing index keys are skipped
+        - "upsert": bulk ReplaceOne(upsert=True) keyed on the index fields,
+            changed documents are updated
+
+    Collections listed in bucket_collections use the bucketed layout (see
+    BucketUtils): one document per symbol and day (intraday) or year (daily)
+    with the bars as parallel arrays. save and load convert transparently.
+
+    With cache_records > 0 the results of load are kept in a LoadCache,
+    save, update and drops through the broker invalidate the collection.
+
+    Datetime modes:
+        - "string": date and datetime fields are stored as given (ISO strings)
+        - "native": date and datetime fields of the price, dividend and split
+            collections (see native_collection) are stored as BSON datetimes in
+            UTC, date strings in queries are converted accordingly
     """
 
-    def __init__(self, client):
+    WRITE_MODES = ["insert", "upsert"]
+    DATETIME_MODES = ["string", "native"]
+
+    def __init__(
+        self,
+        client,
+        write_mode: str = "insert",
+        batch_size: int = 1000,
+        bucket_collections: Optional[List[str]] = None,
+        cache_records: int = 0,
+        datetime_mode: str = "string",
+    ):
         self.client = client
+        self.bucket_collections = set(bucket_collections or [])
+
+        if datetime_mode not in self.DATETIME_MODES:
+            raise ValueError(f"Invalid datetime mode {datetime_mode}")
+        self.datetime_mode = datetime_mode
+
+        # OPTIONAL READ-THROUGH CACHE OF load, BOUNDED BY THE NUMBER OF RECORDS
+        self.cache: Optional[LoadCache] = LoadCache(cache_records) if cache_records else None
+
+        if write_mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {write_mode}")
+
+        # DEFAULT WRITE MODE AND UPSERT BATCH SIZE FOR save
+        self.write_mode = write_mode
+        self.batch_size = batch_size
+
+        # INDEXES KNOWN TO EXIST PER (db, col) AS (key tuples, unique)
+        # AVOIDS A create_index ROUND TRIP ON EVERY SAVE
+        self._indexes: Dict[Tuple[str, str], Set[Tuple[tuple, bool]]] = {}
+        self._index_lock = threading.Lock()
+
+    def _native(self, col: str) -> bool:
+        return self.datetime_mode == "native" and native_collection(col)
+
+    def ensure_index(self, db: str, col: str, indexTupleList: List[Tuple[str, Any]], unique: bool):
+        """
+        Public method to create an index unless it is known to exist.
+        The existing indexes of a collection are read once, after that
+        only new index specs reach the server.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - indexTupleList (List[Tuple[str, Any]]): tuples define the index
+            - unique (bool): index keys unique ?
+        """
+        spec = (tuple(tuple(t) for t in indexTupleList), bool(unique))
+
+        with self._index_lock:
+            known = self._indexes.get((db, col))
+            if known is not None and spec in known:
+                return
+
+            colm = self.client[db][col]
+            if known is None:
+                known = self._indexes[(db, col)] = {
+                    (tuple(tuple(k) for k in info["key"]), bool(info.get("unique", False)))
+                    for info in colm.index_information().values()
+                }
+                if spec in known:
+                    return
+
+            colm.create_index(indexTupleList, unique=unique)
+            known.add(spec)
+
+    def invalidate_indexes(self, db: str, col: Optional[str] = None):
+        """
+        Public method to forget the ensured indexes of a collection, or of
+        all collections of a database if col is None. Must be called when
+        collections are dropped outside of the broker.
+
+        Args:
+            - db (str): database name
+            - col (Optional[str]): collection name
+        """
+        with self._index_lock:
+            for key in list(self._indexes):
+                if key[0] == db and (col is None or key[1] == col):
+                    del self._indexes[key]
+
+    def drop_collection(self, db: str, col: str):
+        """
+        Public method to drop a collection and forget its indexes.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+        """
+        self.client[db].drop_collection(col)
+        self.invalidate_indexes(db, col)
+        if self.cache is not None:
+            self.cache.invalidate(db, col)
+
+    def drop_database(self, db: str):
+        """
+        Public method to drop a database and forget its indexes.
+
+        Args:
+            - db (str): database name
+        """
+        self.client.drop_database(db)
+        self.invalidate_indexes(db)
+        if self.cache is not None:
+            self.cache.invalidate(db)
 
     def get_stats(self, db: str):
         """
@@ -32,6 +390,143 @@ class DataBrokerMongoDb:
 
         pprint(status)
 
+    def update_catalog(
+        self,
+        db: str,
+        col: str,
+        data: Union[List[Dict], Dict],
+        indexTupleList: List[Tuple[str, Any]],
+        inserted: Optional[int] = None,
+    ):
+        """
+        Public method to record saved records in the coverage catalog: per
+        (collection, symbol) the first and last date, the number of records
+        and the time of the last update.
+
+        Args:
+            - db (str): database name
+            - col (str): collection the records were saved to
+            - data (Union[List[Dict], Dict]): saved records
+            - indexTupleList (List[Tuple[str, Any]]): index the records were saved with,
+                its date or datetime field gives the first and last date
+            - inserted (Optional[int]): number of inserted records if all records
+                belong to one symbol, otherwise the records are recounted
+        """
+        datal = data if isinstance(data, list) else [data]
+        fields = index_fields(indexTupleList)
+        timefield = next((f for f in fields if f in DATETIME_FIELDS), None)
+
+        ranges: Dict[Any, list] = {}
+        for rec in datal:
+            value = rec.get(timefield) if timefield else None
+            if isinstance(value, str) and self._native(col):
+                value = to_utc_datetime(value)
+            rng = ranges.setdefault(rec.get("symbol"), [value, value])
+            if value is not None:
+                rng[0] = value if rng[0] is None else min(rng[0], value)
+                rng[1] = value if rng[1] is None else max(rng[1], value)
+
+        if inserted is not None and len(ranges) > 1:
+            inserted = None
+        # ONE AGGREGATION RECOUNTS ALL SYMBOLS OF A MULTI-SYMBOL SAVE
+        counts = self._count_symbols(db, col, list(ranges)) if inserted is None else {}
+
+        requests = []
+        for symbol, (first, last) in ranges.items():
+            update: Dict[str, Dict[str, Any]] = {"$set": {"updated": dt.utcnow()}}
+            if first is not None:
+                update["$min"] = {"first": first}
+                update["$max"] = {"last": last}
+            if inserted is not None:
+                update["$inc"] = {"count": inserted}
+            else:
+                update["$set"]["count"] = counts.get(symbol, 0)
+            requests.append(UpdateOne({"collection": col, "symbol": symbol}, update, upsert=True))
+
+        if requests:
+            self.ensure_index(db, CATALOG_COLLECTION, [("collection", 1), ("symbol", 1)], True)
+            self.client[db][CATALOG_COLLECTION].bulk_write(requests, ordered=False)
+
+    def _count_symbols(self, db: str, col: str, symbols: List[Any]) -> Dict[Any, int]:
+        # BUCKETS HOLD count RECORDS EACH
+        n = "$count" if col in self.bucket_collections else 1
+        pipeline = [
+            {"$match": {"symbol": {"$in": symbols}}},
+            {"$group": {"_id": "$symbol", "n": {"$sum": n}}},
+        ]
+        return {doc["_id"]: doc["n"] for doc in self.client[db][col].aggregate(pipeline)}
+
+    def save_cataloged(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        **kwargs,
+    ) -> Dict[str, int]:
+        """
+        Public method to save records and record them in the coverage catalog.
+
+        Args:
+            - data (Union[List[Dict], Dict]): records to save
+            - db (str): database name
+            - col (str): collection name
+            - indexTupleList (List[Tuple[str, Any]]): index of the collection
+            - kwargs: further save arguments
+
+        Returns:
+            Dict[str, int]: result of save
+        """
+        res = self.save(data, db, col, indexTupleList, **kwargs)
+        inserted = res.get("inserted") if isinstance(res, dict) else None
+        self.update_catalog(db, col, data, indexTupleList, inserted)
+        return res
+
+    def get_catalog(
+        self, db: str, col: Optional[str] = None, symbols: Optional[List[str]] = None
+    ) -> List[dict]:
+        """
+        Public method to read the coverage catalog.
+
+        Args:
+            - db (str): database name
+            - col (Optional[str]): only this collection
+            - symbols (Optional[List[str]]): only these symbols
+
+        Returns:
+            List[dict]: catalog entries with collection, symbol, first, last,
+                count and updated, sorted on collection and symbol
+        """
+        query: Dict[str, Any] = {}
+        if col is not None:
+            query["collection"] = col
+        if symbols is not None:
+            query["symbol"] = {"$in": list(symbols)}
+
+        cursor = self.client[db][CATALOG_COLLECTION].find(query, {"_id": False})
+        return list(cursor.sort([("collection", ASCENDING), ("symbol", ASCENDING)]))
+
+    def get_stale_symbols(self, db: str, col: str, before: Union[str, dt]) -> List[str]:
+        """
+        Public method to get the symbols of a collection whose last stored
+        date is before the given date, from the coverage catalog.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - before (Union[str, dt]): date (YYYY-MM-DD, ISO datetime or datetime)
+
+        Returns:
+            List[str]: stale symbols, sorted
+        """
+        if self._native(col):
+            before = to_utc_datetime(before)
+
+        cursor = self.client[db][CATALOG_COLLECTION].find(
+            {"collection": col, "last": {"$lt": before}}, {"_id": False, "symbol": True}
+        )
+        return sorted(doc["symbol"] for doc in cursor)
+
     def get_number_of_documents(self, db: str, col: str) -> int:
         """
         Get the total number of documents stored in the collection col
@@ -45,6 +540,10 @@ class DataBrokerMongoDb:
             int: number of documents stored in col
         """
         colm = self.client[db][col]
+        if col in self.bucket_collections:
+            res = list(colm.aggregate([{"$group": {"_id": None, "n": {"$sum": "$count"}}}]))
+            return res[0]["n"] if res else 0
+
         n = colm.count_documents({})
 
         return n
@@ -56,7 +555,9 @@ class DataBrokerMongoDb:
         col: str,
         indexTupleList: List[Tuple[str, Any]],
         unique: bool = True,
-    ):
+        mode: Optional[str] = None,
+        batch_size: Optional[int] = None,
+    ) -> Dict[str, int]:
         """
         Public method to save the data to a collection.
         User should take care that data is given in the correct format (list of dicts, bjson).
@@ -73,19 +574,219 @@ class DataBrokerMongoDb:
             tuples define the index
         unique: Bool
             index keys unique ? (default: True)
+        mode: Optional[str]
+            "insert" or "upsert" (default: broker write_mode)
+        batch_size: Optional[int]
+            number of upserts per bulk write (default: broker batch_size)
+
+        Returns:
+        --------
+        Dict[str, int]
+            number of inserted, updated and unchanged documents
         """
         colm = self.client[db][col]
-        colm.create_index(indexTupleList, unique=unique)
 
         if not isinstance(data, list):
             datal: List = [data]
         else:
             datal = data
 
-        try:
-            colm.insert_many(datal, ordered=False)
-        except BulkWriteError:
-            pass
+        if self._native(col):
+            datal = [native_record(rec) for rec in datal]
+
+        mode = mode or self.write_mode
+        if col in self.bucket_collections:
+            res = self._save_buckets(
+                colm, datal, indexTupleList, mode, batch_size or self.batch_size
+            )
+        elif mode == "upsert":
+            self.ensure_index(db, col, indexTupleList, unique)
+            res = self._upsert(colm, datal, indexTupleList, batch_size or self.batch_size)
+        elif mode == "insert":
+            self.ensure_index(db, col, indexTupleList, unique)
+            try:
+                inserted = len(colm.insert_many(datal, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                inserted = e.details.get("nInserted", 0)
+            res = {"inserted": inserted, "updated": 0, "unchanged": len(datal) - inserted}
+        else:
+            raise ValueError(f"Invalid write mode {mode}")
+
+        if self.cache is not None:
+            self.cache.invalidate(db, col)
+
+        return res
+
+    def _upsert(
+        self, colm, datal: List[Dict], indexTupleList: List[Tuple[str, Any]], batch_size: int
+    ) -> Dict[str, int]:
+        """
+        Private method to replace documents by their index keys, inserting
+        the ones that do not exist yet.
+
+        Args:
+            - colm (Collection): mongo collection
+            - datal (List[Dict]): documents to save
+            - indexTupleList (List[Tuple[str, Any]]): index, its fields key the documents
+            - batch_size (int): number of operations per bulk write
+
+        Returns:
+            Dict[str, int]: number of inserted, updated and unchanged documents
+        """
+        keys = [k for k, _ in indexTupleList]
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        for i in range(0, len(datal), batch_size):
+            # THE _ID OF A STORED DOCUMENT IS IMMUTABLE, DOCUMENTS MAY CARRY ONE
+            # FROM AN EARLIER INSERT
+            requests = [
+                ReplaceOne(
+                    {k: doc.get(k) for k in keys},
+                    {k: v for k, v in doc.items() if k != "_id"},
+                    upsert=True,
+                )
+                for doc in datal[i : i + batch_size]
+            ]
+            res = colm.bulk_write(requests, ordered=False)
+            counts["inserted"] += res.upserted_count
+            counts["updated"] += res.modified_count
+            counts["unchanged"] += res.matched_count - res.modified_count
+
+        return counts
+
+    def _save_buckets(
+        self,
+        colm,
+        datal: List[Dict],
+        indexTupleList: List[Tuple[str, Any]],
+        mode: str,
+        batch_size: int,
+    ) -> Dict[str, int]:
+        """
+        Private method to merge records into bucket documents. The last index
+        field is the time field, the others identify the series.
+
+        Args:
+            - colm (Collection): mongo collection
+            - datal (List[Dict]): records to save
+            - indexTupleList (List[Tuple[str, Any]]): record index, e.g. symbol, date
+            - mode (str): "insert" keeps existing bars, "upsert" replaces them
+            - batch_size (int): number of buckets per bulk write
+
+        Returns:
+            Dict[str, int]: number of inserted, updated and unchanged records
+        """
+        if mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {mode}")
+
+        keyfields = [k for k, _ in indexTupleList[:-1]]
+        timefield = indexTupleList[-1][0]
+        self.ensure_index(
+            colm.database.name,
+            colm.name,
+            [(k, ASCENDING) for k in keyfields] + [("bucket", ASCENDING)],
+            True,
+        )
+
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        pending = list(group_records(datal, keyfields, timefield).items())
+
+        for _ in range(BUCKET_RETRIES + 1):
+            conflicts = []
+            for i in range(0, len(pending), batch_size):
+                batch = pending[i : i + batch_size]
+                conflicts += self._write_buckets(colm, batch, keyfields, timefield, mode, counts)
+
+            if not conflicts:
+                return counts
+            pending = conflicts
+
+        raise RuntimeError(
+            f"{len(pending)} buckets of {colm.name} still conflicting after {BUCKET_RETRIES} retries"
+        )
+
+    def _write_buckets(
+        self,
+        colm,
+        batch: List[Tuple[Tuple, List[Dict]]],
+        keyfields: List[str],
+        timefield: str,
+        mode: str,
+        counts: Dict[str, int],
+    ) -> List[Tuple[Tuple, List[Dict]]]:
+        """
+        Private method to merge the records of a batch of buckets into the
+        bucket documents. A bucket is only replaced if its version did not
+        change since it was read, the replacement of a bucket written by a
+        concurrent writer fails on the unique bucket index.
+
+        Args:
+            - colm (Collection): mongo collection
+            - batch (List[Tuple[Tuple, List[Dict]]]): (bucket key, records) per bucket
+            - keyfields (List[str]): fields identifying the series
+            - timefield (str): time field of the records
+            - mode (str): "insert" keeps existing bars, "upsert" replaces them
+            - counts (Dict[str, int]): counts of the written buckets are added to it
+
+        Returns:
+            List[Tuple[Tuple, List[Dict]]]: buckets written concurrently by
+                another writer, to be merged again
+        """
+        filters = [{**dict(zip(keyfields, key[:-1])), "bucket": key[-1]} for key, _ in batch]
+
+        # ONE ROUND TRIP FOR THE EXISTING BUCKETS OF THE BATCH
+        existing = {
+            tuple(doc.get(k) for k in keyfields) + (doc["bucket"],): doc
+            for doc in colm.find({"$or": filters}, {"_id": False})
+        }
+
+        requests, written = [], []
+        for (key, records), flt in zip(batch, filters):
+            old_doc = existing.get(key, {})
+            merged = {r[timefield]: r for r in unpack_bucket(old_doc, keyfields)} if old_doc else {}
+
+            bucket_counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+            for rec in records:
+                rec = {k: v for k, v in rec.items() if k != "_id" and v is not None}
+                old = merged.get(rec[timefield])
+                if old is None:
+                    bucket_counts["inserted"] += 1
+                elif mode == "upsert" and old != rec:
+                    bucket_counts["updated"] += 1
+                else:
+                    bucket_counts["unchanged"] += 1
+                    continue
+                merged[rec[timefield]] = rec
+
+            index = None
+            if bucket_counts["inserted"] or bucket_counts["updated"]:
+                # NONE MATCHES A MISSING VERSION: NEW BUCKETS AND BUCKETS OF EARLIER RELEASES
+                version = old_doc.get("version")
+                doc = build_bucket(
+                    key, keyfields, timefield, list(merged.values()), (version or 0) + 1
+                )
+                index = len(requests)
+                requests.append(ReplaceOne({**flt, "version": version}, doc, upsert=True))
+            written.append((key, records, bucket_counts, index))
+
+        conflicting = set()
+        if requests:
+            try:
+                colm.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if any(err.get("code") != 11000 for err in errors):
+                    raise
+                conflicting = {err["index"] for err in errors}
+
+        conflicts = []
+        for key, records, bucket_counts, index in written:
+            if index in conflicting:
+                conflicts.append((key, records))
+                continue
+            for k, n in bucket_counts.items():
+                counts[k] += n
+        return conflicts
 
     def load(self, db: str, col: str, searchdict: Dict, selectiondict={}) -> List[dict]:
         """
@@ -99,15 +800,200 @@ class DataBrokerMongoDb:
         Returns:
             List[dict]: requested data as list of dicts
         """
+        if self._native(col):
+            searchdict = native_query(searchdict)
+
+        if self.cache is not None:
+            key = LoadCache.key(db, col, searchdict, selectiondict)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            generation = self.cache.generation(db, col)
+
         colm = self.client[db][col]
-        cursor = colm.find(searchdict, {**{"_id": False}, **selectiondict})
+        if col in self.bucket_collections:
+            out = list(self._iter_buckets(colm, searchdict, selectiondict))
+        else:
+            cursor = colm.find(searchdict, {**{"_id": False}, **selectiondict})
+
+            out = []
+            for doc in cursor:
+                out.append(doc)
 
-        out = []
-        for doc in cursor:
-            out.append(doc)
+        if self.cache is not None:
+            self.cache.put(key, out, generation)
 
         return out
 
+    def _iter_buckets(
+        self,
+        colm,
+        searchdict: Dict,
+        selectiondict: Dict,
+        batch_size: Optional[int] = None,
+        sort: Optional[List[Tuple[str, int]]] = None,
+    ) -> Iterator[dict]:
+        """
+        Private method to load records from bucket documents. The leading
+        sort fields that are key fields, up to the time field, are sorted
+        on in mongo (the time field on the bucket key), the records of the
+        buckets with equal values on them are sorted in memory. Only a
+        sort starting with another field needs all records in memory.
+
+        Args:
+            - colm (Collection): mongo collection
+            - searchdict (dict): mongo search dict on the records
+            - selectiondict (dict): mongo projection on the records
+            - batch_size (Optional[int]): cursor batch size (buckets)
+            - sort (Optional[List[Tuple[str, int]]]): mongo sort specification
+                on the records, sorted per bucket if None
+
+        Returns:
+            Iterator[dict]: requested data
+        """
+        # THE KEY FIELDS OF THE SERIES ARE THE TOP LEVEL FIELDS OF ANY BUCKET
+        for doc in colm.find({}, {"_id": False}, limit=1):
+            keyfields = [k for k in doc if k not in BUCKET_FIELDS]
+            query = bucket_query(searchdict, keyfields)
+
+            bucket_sort = []
+            for k, direction in sort or []:
+                if k in keyfields:
+                    bucket_sort.append((k, direction))
+                elif k in BUCKET_KEY_LENGTH:
+                    # THE RECORDS OF A BUCKET KEY ARE INTERLEAVED ON THE FOLLOWING FIELDS
+                    bucket_sort.append(("bucket", direction))
+                    break
+                else:
+                    break
+
+            cursor = colm.find(query, {"_id": False}).sort(bucket_sort or [("bucket", ASCENDING)])
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+
+            if not sort:
+                for bucket in cursor:
+                    for rec in unpack_bucket(bucket, keyfields):
+                        if match_record(rec, searchdict):
+                            yield project_record(rec, selectiondict)
+                return
+
+            fields = [k for k, _ in bucket_sort]
+            for _, buckets in groupby(cursor, key=lambda b: tuple(b.get(k) for k in fields)):
+                records = [
+                    rec
+                    for bucket in buckets
+                    for rec in unpack_bucket(bucket, keyfields)
+                    if match_record(rec, searchdict)
+                ]
+                # NULL FIRST AS IN MONGO
+                for k, direction in reversed(sort):
+                    records.sort(
+                        key=lambda r: (r.get(k) is not None, r.get(k)), reverse=direction < 0
+                    )
+                for rec in records:
+                    yield project_record(rec, selectiondict)
+
+    def iter_load(
+        self,
+        db: str,
+        col: str,
+        searchdict: Dict,
+        selectiondict: Dict = {},
+        sort: Optional[List[Tuple[str, int]]] = None,
+        limit: int = 0,
+        batch_size: Optional[int] = None,
+    ) -> Iterator[dict]:
+        """
+        Public method to stream data from the database, documents are
+        fetched from the server in batches of batch_size.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo valid search dict
+            - selectiondict (dict): mongo projection
+            - sort (Optional[List[Tuple[str, int]]]): mongo sort specification
+            - limit (int): maximum number of documents, 0 for no limit
+            - batch_size (Optional[int]): cursor batch size (default: broker batch_size)
+
+        Returns:
+            Iterator[dict]: requested data
+        """
+        colm = self.client[db][col]
+        batch_size = batch_size or self.batch_size
+        if self._native(col):
+            searchdict = native_query(searchdict)
+
+        if col in self.bucket_collections:
+            records = self._iter_buckets(colm, searchdict, selectiondict, batch_size, sort)
+            yield from islice(records, limit or None)
+            return
+
+        cursor = colm.find(
+            searchdict, {**{"_id": False}, **selectiondict}, limit=limit, batch_size=batch_size
+        )
+        if sort:
+            cursor = cursor.sort(sort)
+
+        yield from cursor
+
+    def load_frame(
+        self,
+        db: str,
+        col: str,
+        searchdict: Dict,
+        selectiondict: Dict = {},
+        sort: Optional[List[Tuple[str, int]]] = None,
+        limit: int = 0,
+        batch_size: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Public method to load data into a DataFrame. Each cursor batch is
+        converted to typed NumPy columns right away, so the documents of
+        only one batch are held in memory at a time.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo valid search dict
+            - selectiondict (dict): mongo projection
+            - sort (Optional[List[Tuple[str, int]]]): mongo sort specification
+            - limit (int): maximum number of documents, 0 for no limit
+            - batch_size (Optional[int]): cursor batch size (default: broker batch_size)
+
+        Returns:
+            pd.DataFrame: requested data, one column per field
+        """
+        batch_size = batch_size or self.batch_size
+        docs = self.iter_load(db, col, searchdict, selectiondict, sort, limit, batch_size)
+
+        chunks: Dict[str, List[np.ndarray]] = {}
+        n = 0
+        while True:
+            batch = list(islice(docs, batch_size))
+            if not batch:
+                break
+
+            names: Dict[str, None] = {}
+            for doc in batch:
+                names.update(dict.fromkeys(doc))
+            for k in names:
+                if k not in chunks:
+                    # FIELD NOT SEEN BEFORE - MISSING IN THE EARLIER ROWS
+                    chunks[k] = [column_array([None] * n)] if n else []
+                chunks[k].append(column_array([doc.get(k) for doc in batch]))
+            for k in chunks:
+                if k not in names:
+                    chunks[k].append(column_array([None] * len(batch)))
+            n += len(batch)
+
+        # RETYPE THE OBJECT COLUMNS, THE BATCHES OF A FIELD CAN HAVE DIFFERENT TYPES
+        columns = {k: np.concatenate(v) for k, v in chunks.items()}
+        return pd.DataFrame(
+            {k: column_array(v) if v.dtype == object else v for k, v in columns.items()}
+        )
+
     def update(self, db: str, col: str, myquery, newvalues):
         """
         Public method to update records in a collection.
@@ -119,7 +1005,263 @@ class DataBrokerMongoDb:
             - newvalues (mongodb set dict) : mongodb set field dict eg.
                 { "$set": { "name": "Minnie" } }
         """
+        if self._native(col):
+            myquery = native_query(myquery)
+
         colm = self.client[db][col]
-        x = colm.update_many(myquery, newvalues)
+        if col in self.bucket_collections:
+            modified = self._update_buckets(colm, myquery, newvalues)
+        else:
+            modified = colm.update_many(myquery, newvalues).modified_count
+
+        if self.cache is not None:
+            self.cache.invalidate(db, col)
+
+        logger.info("{} documents updated.".format(modified))
+
+    def _update_buckets(self, colm, myquery: Dict, newvalues: Dict) -> int:
+        """
+        Private method to update records of a bucketed collection. Only
+        $set of fields other than the key and time fields is supported.
+
+        Args:
+            - colm (Collection): mongo collection
+            - myquery (dict): query to select records to update
+            - newvalues (dict): {"$set": {...}}
+
+        Returns:
+            int: number of updated records
+        """
+        if set(newvalues) != {"$set"}:
+            raise ValueError("Only $set updates are supported on bucketed collections")
+
+        doc = colm.find_one({}, {"_id": False})
+        if doc is None:
+            return 0
+
+        keyfields = [k for k in doc if k not in BUCKET_FIELDS]
+        timefield = doc["timefield"]
+        values = newvalues["$set"]
+        if set(values) & {*keyfields, timefield}:
+            raise ValueError(f"Cannot $set the key fields {keyfields + [timefield]} of buckets")
+
+        records = [{**rec, **values} for rec in self._iter_buckets(colm, myquery, {})]
+        index = [(k, ASCENDING) for k in keyfields] + [(timefield, ASCENDING)]
+        counts = self._save_buckets(colm, records, index, "upsert", self.batch_size)
+        return counts["updated"]
+
+
+class BufferedDataBroker(DataBrokerMongoDb):
+    """
+    DataBrokerMongoDb that buffers saves per (db, collection) across calls,
+    so the records of many tickers are written in a few large bulk writes.
+
+    A buffer is flushed when it holds max_records records or when its
+    oldest record is max_delay seconds old. Flushes run concurrently on a
+    thread pool. Call flush() or close() (or use the broker as a context
+    manager) to write the remaining records.
+    """
+
+    def __init__(
+        self,
+        client,
+        write_mode: str = "insert",
+        batch_size: int = 1000,
+        max_records: int = 10000,
+        max_delay: Optional[float] = 5.0,
+        workers: int = 4,
+        bucket_collections: Optional[List[str]] = None,
+        cache_records: int = 0,
+        datetime_mode: str = "string",
+    ):
+        super().__init__(
+            client, write_mode, batch_size, bucket_collections, cache_records, datetime_mode
+        )
+        self.max_records = max_records
+        self.max_delay = max_delay
+
+        # BUFFERS KEYED ON (db, col, index, unique, mode, batch_size, catalog)
+        self._buffers: Dict[tuple, List[Dict]] = {}
+        self._first_save: Dict[tuple, float] = {}
+        self._buffer_lock = threading.Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures: List[Future] = []
+        self._closed = False
+
+        # COLLECTIONS WHOSE FLUSHES UPDATE THE COVERAGE CATALOG (SEE update_catalog)
+        self._catalog_cols: Set[Tuple[str, str]] = set()
+
+        # CUMULATIVE RESULT OF THE FLUSHED WRITES
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0, "failed": 0, "flushes": 0}
+        self._counts_lock = threading.Lock()
+
+        # BACKGROUND THREAD FLUSHING BUFFERS OLDER THAN max_delay
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+        if max_delay:
+            self._timer = threading.Thread(target=self._flush_loop, daemon=True)
+            self._timer.start()
+
+    def save(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        unique: bool = True,
+        mode: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        catalog: bool = False,
+    ) -> Dict[str, int]:
+        """
+        Public method to add data to the write buffer of a collection.
+        Same arguments as DataBrokerMongoDb.save.
+
+        Args:
+            - catalog (bool): the flush of the records updates the coverage catalog
+
+        Returns:
+            Dict[str, int]: number of buffered records
+        """
+        if self._closed:
+            raise ValueError("BufferedDataBroker is closed")
+
+        datal = data if isinstance(data, list) else [data]
+        index = tuple(tuple(t) for t in indexTupleList)
+        key = (db, col, index, unique, mode, batch_size, catalog)
+
+        with self._buffer_lock:
+            buffer = self._buffers.setdefault(key, [])
+            if not buffer:
+                self._first_save[key] = time.monotonic()
+            buffer.extend(datal)
+
+            if len(buffer) >= self.max_records:
+                self._submit(key)
+
+        return {"buffered": len(datal)}
+
+    def _submit(self, key: tuple):
+        """
+        Private method to hand a buffer to the thread pool, the buffer lock must be held.
+
+        Args:
+            - key (tuple): buffer key
+        """
+        records = self._buffers.pop(key)
+        self._first_save.pop(key, None)
+
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(self._executor.submit(self._write, key, records))
+
+    def _write(self, key: tuple, records: List[Dict]):
+        """
+        Private method to write a flushed buffer with DataBrokerMongoDb.save.
+
+        Args:
+            - key (tuple): buffer key
+            - records (List[Dict]): buffered records
+        """
+        db, col, index, unique, mode, batch_size, catalog = key
+        try:
+            res = DataBrokerMongoDb.save(
+                self, records, db, col, list(index), unique, mode, batch_size
+            )
+        except Exception:
+            logger.exception(
+                colored(f"Failed flushing {len(records)} records to {db}.{col}", "red")
+            )
+            with self._counts_lock:
+                self.counts["failed"] += len(records)
+            return
+
+        if catalog or (db, col) in self._catalog_cols:
+            # ONE CATALOG UPDATE PER FLUSH
+            try:
+                DataBrokerMongoDb.update_catalog(self, db, col, records, list(index))
+            except Exception:
+                logger.exception(colored(f"Failed updating the catalog of {db}.{col}", "red"))
+
+        with self._counts_lock:
+            for k, v in res.items():
+                self.counts[k] += v
+            self.counts["flushes"] += 1
+
+    def update_catalog(
+        self,
+        db: str,
+        col: str,
+        data: Union[List[Dict], Dict],
+        indexTupleList: List[Tuple[str, Any]],
+        inserted: Optional[int] = None,
+    ):
+        """
+        Public method to have the flushes of a collection update the coverage
+        catalog, the records are still buffered. Same arguments as
+        DataBrokerMongoDb.update_catalog. Records flushed before the call
+        are not cataloged, use save_cataloged to buffer cataloged records.
+        """
+        self._catalog_cols.add((db, col))
+
+    def save_cataloged(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        **kwargs,
+    ) -> Dict[str, int]:
+        """
+        Public method to buffer records whose flush updates the coverage
+        catalog, once per flush. Same arguments as save.
+
+        Returns:
+            Dict[str, int]: number of buffered records
+        """
+        return self.save(data, db, col, indexTupleList, catalog=True, **kwargs)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.max_delay / 2):
+            now = time.monotonic()
+            with self._buffer_lock:
+                for key, first in list(self._first_save.items()):
+                    if now - first >= self.max_delay:
+                        self._submit(key)
+
+    def flush(self, wait: bool = True):
+        """
+        Public method to write all buffered records.
+
+        Args:
+            - wait (bool): wait until all pending writes are done
+        """
+        with self._buffer_lock:
+            for key in list(self._buffers):
+                self._submit(key)
+            futures = list(self._futures)
+
+        if wait:
+            for f in futures:
+                f.result()
+
+    def close(self):
+        """
+        Public method to flush all buffered records and stop the background threads.
+        """
+        if self._closed:
+            return
+
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+
+        self.flush(wait=True)
+        self._closed = True
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
 
-        logger.info("{} documents updated.".format(x.modified_count))
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.DataBrokerParquet
+=================================================================
+
+A module containing a file based columnar DataBroker.
+
+Records are stored as Parquet files partitioned by database,
+collection, symbol and year:
+
+    <root>/<db>/<col>/symbol=<symbol>/year=<YYYY>/part-0.parquet
+
+The year is taken from the "date" or "datetime" index field, records
+of collections without one go to year=all. Each collection keeps its
+unified schema and index fields in <root>/<db>/<col>/_common_metadata.
+
+Loads push the query down as a pyarrow dataset filter (partition
+pruning on symbol and year, row group statistics on the other fields)
+and read only the projected columns.
+
+Requires pyarrow (optional dependency).
+"""
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+from .BucketUtils import BUCKET_KEY_LENGTH, match_record
+from .DataBroker import DataBroker, index_fields
+from .LoggingUtils import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = ds = pq = None
+
+# PARTITION FIELDS, "year" IS NOT PART OF THE RECORDS
+PARTITION_FIELDS = ("symbol", "year")
+
+_PART_FILE = "part-0.parquet"
+_META_FILE = "_common_metadata"
+
+
+def _sorted_keys(keys) -> list:
+    """Index keys sorted with None last, mixed types sort on their str."""
+    try:
+        return sorted(keys, key=lambda t: tuple((v is None, v if v is not None else 0) for v in t))
+    except TypeError:
+        return sorted(keys, key=lambda t: tuple((v is None, str(v)) for v in t))
+
+
+def _is_missing(value: Any) -> bool:
+    """None and NaN both mark a gap, Parquet stores NaN as null."""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _same_record(old: dict, new: dict) -> bool:
+    """Records compared field by field, gaps (missing, None or NaN) are equal."""
+    for k in set(old) | set(new):
+        a, b = old.get(k), new.get(k)
+        if _is_missing(a) or _is_missing(b):
+            if not (_is_missing(a) and _is_missing(b)):
+                return False
+        elif a != b:
+            return False
+    return True
+
+
+def _year(rec: dict, fields: List[str]) -> str:
+    """Year partition of a record, from its "date" or "datetime" index field."""
+    for f in fields:
+        if f in BUCKET_KEY_LENGTH and rec.get(f) is not None:
+            return str(rec[f])[:4]
+    return "all"
+
+
+def _group_records(datal: List[dict], fields: List[str]) -> Dict[Tuple[str, str], List[dict]]:
+    """
+    Private method to group records on their (symbol, year) partition.
+
+    Args:
+        - datal (List[dict]): records to group
+        - fields (List[str]): index fields
+
+    Returns:
+        Dict[Tuple[str, str], List[dict]]: records per partition
+    """
+    groups: Dict[Tuple[str, str], List[dict]] = {}
+    for rec in datal:
+        if rec.get("symbol") is None:
+            raise ValueError(f"Records of a parquet collection must hold a symbol: {rec}")
+        groups.setdefault((str(rec["symbol"]), _year(rec, fields)), []).append(rec)
+    return groups
+
+
+def _merge_records(
+    merged: Dict[tuple, dict],
+    records: List[dict],
+    fields: List[str],
+    mode: str,
+    counts: Dict[str, int],
+) -> bool:
+    """
+    Private method to merge records into the records of a partition.
+
+    Args:
+        - merged (Dict[tuple, dict]): stored records keyed on the index fields,
+            updated in place
+        - records (List[dict]): records to save
+        - fields (List[str]): index fields
+        - mode (str): "insert" keeps stored records, "upsert" replaces them
+        - counts (Dict[str, int]): inserted, updated and unchanged counts,
+            updated in place
+
+    Returns:
+        bool: True if the partition changed
+    """
+    changed = False
+    for rec in records:
+        rec = {k: v for k, v in rec.items() if k != "_id"}
+        key = tuple(rec.get(f) for f in fields)
+        old = merged.get(key)
+        if old is None:
+            counts["inserted"] += 1
+        elif mode == "upsert" and not _same_record(old, rec):
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+            continue
+        merged[key] = rec
+        changed = True
+    return changed
+
+
+class DataBrokerParquet(DataBroker):
+    """
+    DataBroker storing the collections as partitioned Parquet files.
+
+    Write modes are the same as for DataBrokerMongoDb: "insert" keeps
+    existing records, "upsert" replaces them. Records are keyed on the
+    index fields, the files of a partition are rewritten on save.
+    """
+
+    WRITE_MODES = ["insert", "upsert"]
+
+    def __init__(self, root: str, write_mode: str = "insert"):
+        if pa is None:
+            raise ImportError("DataBrokerParquet requires pyarrow")
+
+        if write_mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {write_mode}")
+
+        self.root = root
+        self.write_mode = write_mode
+
+        # PARTITION FILES ARE READ-MODIFY-WRITTEN, SERIALIZE THE WRITERS
+        self._lock = threading.Lock()
+
+    def _col_path(self, db: str, col: str) -> str:
+        return os.path.join(self.root, db, col)
+
+    def _partition_path(self, db: str, col: str, symbol: str, year: str) -> str:
+        return os.path.join(
+            self._col_path(db, col), f"symbol={quote(symbol, safe='')}", f"year={year}"
+        )
+
+    def _read_meta(self, db: str, col: str) -> Tuple[Optional["pa.Schema"], List[str]]:
+        """
+        Private method to read the unified schema and the index fields of a collection.
+
+        Returns:
+            Tuple[Optional[pa.Schema], List[str]]: (schema, index fields), (None, []) if unknown
+        """
+        path = os.path.join(self._col_path(db, col), _META_FILE)
+        if not os.path.exists(path):
+            return None, []
+
+        schema = pq.read_schema(path)
+        fields = json.loads((schema.metadata or {}).get(b"index", b"[]"))
+        return schema.remove_metadata(), fields
+
+    def _write_meta(self, db: str, col: str, schema: "pa.Schema", fields: List[str]):
+        path = os.path.join(self._col_path(db, col), _META_FILE)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        pq.write_metadata(schema.with_metadata({"index": json.dumps(fields)}), tmppath)
+        os.replace(tmppath, path)
+
+    @staticmethod
+    def _read_partition(path: str, symbol: str) -> List[dict]:
+        # THE PARTITION FIELDS ARE NOT STORED, DO NOT INFER THEM FROM THE PATH
+        records = pq.read_table(path, partitioning=None).to_pylist()
+        for rec in records:
+            rec["symbol"] = symbol
+        return records
+
+    @staticmethod
+    def _write_partition(path: str, records: List[dict]) -> "pa.Schema":
+        """
+        Private method to write the records of a partition, without the
+        partition fields, under a temporary name renamed into place.
+
+        Returns:
+            pa.Schema: schema of the written file
+        """
+        names: Dict[str, None] = {}
+        for rec in records:
+            for k in rec:
+                if k not in PARTITION_FIELDS and k != "_id":
+                    names.setdefault(k, None)
+
+        # NAN MARKS THE GAPS OF ALIGNED RECORDS (see align_records), ALSO IN STRING COLUMNS
+        table = pa.table(
+            {k: pa.array([rec.get(k) for rec in records], from_pandas=True) for k in names}
+        )
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = os.path.join(os.path.dirname(path), f".{os.getpid()}.tmp")
+        pq.write_table(table, tmppath)
+        os.replace(tmppath, path)
+        return table.schema
+
+    def get_number_of_documents(self, db: str, col: str) -> int:
+        """
+        Get the total number of records stored in the collection col
+        from the database db, from the Parquet footers only.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+
+        Returns:
+            int: number of records stored in col
+        """
+        dataset = self._dataset(db, col)
+        return dataset.count_rows() if dataset is not None else 0
+
+    def save(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        unique: bool = True,
+        mode: Optional[str] = None,
+    ) -> Dict[str, int]:
+        """
+        Public method to save records to a collection.
+
+        Args:
+            - data (Union[List[Dict], Dict]): records to save, must hold a symbol
+            - db (str): database name
+            - col (str): collection name
+            - indexTupleList (List[Tuple[str, Any]]): index tuples or field names,
+                the index fields key the records
+            - unique (bool): kept for the DataBroker protocol, records are always
+                unique on the index fields
+            - mode (Optional[str]): "insert" or "upsert" (default: broker write_mode)
+
+        Returns:
+            Dict[str, int]: number of inserted, updated and unchanged records
+        """
+        mode = mode or self.write_mode
+        if mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {mode}")
+
+        datal = data if isinstance(data, list) else [data]
+        fields = index_fields(indexTupleList)
+
+        groups = _group_records(datal, fields)
+
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        with self._lock:
+            schema, _ = self._read_meta(db, col)
+            schemas = [schema] if schema is not None else []
+
+            for (symbol, year), records in groups.items():
+                path = os.path.join(self._partition_path(db, col, symbol, year), _PART_FILE)
+
+                merged: Dict[tuple, dict] = {}
+                if os.path.exists(path):
+                    for rec in self._read_partition(path, symbol):
+                        merged[tuple(rec.get(f) for f in fields)] = rec
+
+                if _merge_records(merged, records, fields, mode, counts):
+                    rows = [merged[k] for k in _sorted_keys(merged)]
+                    schemas.append(self._write_partition(path, rows))
+
+            if schemas:
+                self._write_meta(
+                    db, col, pa.unify_schemas(schemas, promote_options="permissive"), fields
+                )
+
+        return counts
+
+    def _dataset(self, db: str, col: str) -> Optional["ds.Dataset"]:
+        """
+        Private method to open a collection as pyarrow dataset with the
+        unified schema, None if the collection does not exist.
+        """
+        schema, _ = self._read_meta(db, col)
+        if schema is None:
+            return None
+
+        partitioning = ds.partitioning(
+            pa.schema([(f, pa.string()) for f in PARTITION_FIELDS]), flavor="hive"
+        )
+        return ds.dataset(
+            self._col_path(db, col),
+            schema=pa.unify_schemas([schema, partitioning.schema]),
+            format="parquet",
+            partitioning=partitioning,
+        )
+
+    @staticmethod
+    def _expression(searchdict: Dict, names: List[str]) -> Optional["ds.Expression"]:
+        """
+        Private method to translate a mongo style query into a dataset filter.
+        Supports equality and the $gt, $gte, $lt, $lte, $in, $nin and $ne
+        operators. Conditions on the "date" or "datetime" field are also
+        mapped onto the year partitions.
+
+        Args:
+            - searchdict (Dict): mongo style query
+            - names (List[str]): fields of the collection
+
+        Returns:
+            Optional[ds.Expression]: filter, None matches everything
+        """
+        expr = None
+
+        def add(e):
+            nonlocal expr
+            expr = e if expr is None else expr & e
+
+        for k, cond in searchdict.items():
+            if k not in names:
+                # UNKNOWN FIELDS MATCH NOTHING
+                add(ds.scalar(False))
+                continue
+
+            field = ds.field(k)
+            for op, arg in cond.items() if isinstance(cond, dict) else [("$eq", cond)]:
+                if op == "$eq":
+                    add(field.is_null() if arg is None else field == arg)
+                elif op == "$ne":
+                    add(field.is_valid() if arg is None else field != arg)
+                elif op == "$gt":
+                    add(field > arg)
+                elif op == "$gte":
+                    add(field >= arg)
+                elif op == "$lt":
+                    add(field < arg)
+                elif op == "$lte":
+                    add(field <= arg)
+                elif op == "$in":
+                    add(field.isin(arg))
+                elif op == "$nin":
+                    add(~field.isin(arg))
+                else:
+                    raise ValueError(f"Unsupported operator {op} on parquet collection")
+
+                # PARTITION PRUNING ON THE YEAR OF THE TIME FIELD
+                if k in BUCKET_KEY_LENGTH:
+                    year = ds.field("year")
+                    if op == "$eq" and arg is not None:
+                        add(year == str(arg)[:4])
+                    elif op in ("$gt", "$gte"):
+                        add(year >= str(arg)[:4])
+                    elif op in ("$lt", "$lte"):
+                        add(year <= str(arg)[:4])
+                    elif op == "$in":
+                        add(year.isin(sorted({str(x)[:4] for x in arg})))
+
+        return expr
+
+    def load_table(
+        self, db: str, col: str, searchdict: Dict = {}, selectiondict: Dict = {}
+    ) -> "pa.Table":
+        """
+        Public method to load records as a pyarrow Table.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo style query, pushed down as dataset filter
+            - selectiondict (dict): mongo style projection, only these columns are read
+
+        Returns:
+            pa.Table: requested data, sorted per partition on the index fields
+        """
+        dataset = self._dataset(db, col)
+        if dataset is None:
+            return pa.table({})
+
+        names = [n for n in dataset.schema.names if n != "year"]
+        projection = {k: v for k, v in selectiondict.items() if k != "_id"}
+        if any(projection.values()):
+            columns = [k for k in projection if projection[k] and k in names]
+        else:
+            columns = [n for n in names if n not in projection]
+
+        return dataset.to_table(columns=columns, filter=self._expression(searchdict, names))
+
+    def load(self, db: str, col: str, searchdict: Dict, selectiondict={}) -> List[dict]:
+        """
+        Public method to load records from a collection.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo style query
+            - selectiondict (dict): mongo style projection
+
+        Returns:
+            List[dict]: requested data as list of dicts
+        """
+        return self.load_table(db, col, searchdict, selectiondict).to_pylist()
+
+    def update(self, db: str, col: str, myquery, newvalues):
+        """
+        Public method to update records in a collection. Only the partitions
+        that can hold matching records are rewritten.
+
+        Args:
+            - db (str): database to update
+            - col (str): collection to update
+            - myquery (dict): query to select records to update
+            - newvalues (dict): { "$set": {...} }, index and partition fields can not be set
+        """
+        if set(newvalues) != {"$set"}:
+            raise ValueError("Only $set updates are supported on parquet collections")
+
+        dataset = self._dataset(db, col)
+        if dataset is None:
+            return
+
+        schema, fields = self._read_meta(db, col)
+        values = newvalues["$set"]
+        if set(values) & (set(fields) | set(PARTITION_FIELDS)):
+            raise ValueError("Index and partition fields can not be updated")
+
+        names = [n for n in dataset.schema.names if n != "year"]
+        expr = self._expression(myquery, names)
+
+        n = 0
+        with self._lock:
+            schemas = [schema]
+            for fragment in dataset.get_fragments(filter=expr):
+                symbol = ds.get_partition_keys(fragment.partition_expression)["symbol"]
+                records = self._read_partition(fragment.path, symbol)
+
+                hits = [rec for rec in records if match_record(rec, myquery)]
+                for rec in hits:
+                    rec.update(values)
+                if hits:
+                    n += len(hits)
+                    schemas.append(self._write_partition(fragment.path, records))
+
+            self._write_meta(
+                db, col, pa.unify_schemas(schemas, promote_options="permissive"), fields
+            )
+
+        logger.info("{} documents updated.".format(n))
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.DataBrokerSql
+=================================================================
+
+A module containing an embedded SQL DataBroker based on SQLite.
+
+Each database is an attached SQLite file <root>/<db>.sqlite (or an
+in-memory database), each collection a table whose composite primary
+key is the index of the collection, e.g. (symbol, date) for daily
+prices or the indexDict fields for the financial data tables. Columns
+are added as new record fields show up.
+
+As all databases share one connection, cross-symbol aggregations and
+joins run in-engine, e.g. daily returns:
+
+    broker.query(
+        'SELECT symbol, date, close / LAG(close) OVER '
+        '(PARTITION BY symbol ORDER BY date) - 1 AS ret FROM FinData."1d"'
+    )
+
+SQLite attaches at most MAX_ATTACHED databases to a connection, the
+least recently used one is detached to attach another. In-memory
+databases are shared-cache databases kept alive by a connection of
+their own, so they keep their data while detached.
+
+"""
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import quote
+
+import numpy as np
+
+from .DataBroker import DataBroker, column_array, index_fields
+from .LoggingUtils import logger
+
+_OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=", "$ne": "IS NOT"}
+
+# DEFAULT SQLITE_MAX_ATTACHED OF SQLITE
+MAX_ATTACHED = 10
+
+
+def _quote(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_value(value: Any) -> Any:
+    """Convert a record value to a value SQLite can store."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+    return value
+
+
+def sql_where(searchdict: Dict) -> Tuple[str, List[Any]]:
+    """
+    Method to translate a mongo style query into a SQL WHERE clause.
+    Supports equality and the $gt, $gte, $lt, $lte, $in, $nin and $ne operators.
+
+    Args:
+        - searchdict (Dict): mongo style query
+
+    Returns:
+        Tuple[str, List[Any]]: (where clause, parameters), empty clause matches everything
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+    for k, cond in searchdict.items():
+        col = _quote(k)
+        for op, arg in cond.items() if isinstance(cond, dict) else [("$eq", cond)]:
+            if op == "$eq":
+                clauses.append(f"{col} IS ?")
+                params.append(_sql_value(arg))
+            elif op in _OPERATORS:
+                clauses.append(f"{col} {_OPERATORS[op]} ?")
+                params.append(_sql_value(arg))
+            elif op in ("$in", "$nin"):
+                arg = list(arg)
+                neg = "NOT " if op == "$nin" else ""
+                clauses.append(f"{col} {neg}IN ({', '.join('?' * len(arg))})")
+                params.extend(_sql_value(a) for a in arg)
+            else:
+                raise ValueError(f"Unsupported operator {op} on sql collection")
+
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+class DataBrokerSql(DataBroker):
+    """
+    DataBroker storing the collections as tables of embedded SQLite databases.
+
+    Write modes:
+        - "upsert": INSERT ... ON CONFLICT DO UPDATE on the primary key (default)
+        - "insert": INSERT OR IGNORE, existing keys are skipped
+    """
+
+    WRITE_MODES = ["upsert", "insert"]
+
+    def __init__(self, root: Optional[str] = None, write_mode: str = "upsert"):
+        """
+        Args:
+            - root (Optional[str]): folder of the database files, None keeps them in memory
+            - write_mode (str): default write mode of save
+        """
+        if write_mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {write_mode}")
+
+        self.root = root
+        self.write_mode = write_mode
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+
+        # URI FILENAMES FOR THE SHARED-CACHE IN-MEMORY DATABASES
+        self._conn = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+        self._lock = threading.RLock()
+
+        # ATTACHED DATABASES, LEAST RECENTLY USED FIRST
+        self._attached: "OrderedDict[str, None]" = OrderedDict()
+        # CONNECTIONS KEEPING THE IN-MEMORY DATABASES ALIVE PER db
+        self._memory: Dict[str, sqlite3.Connection] = {}
+        self._memory_prefix = f"file:priceana-{uuid.uuid4().hex}-"
+
+        # COLUMNS AND PRIMARY KEY OF THE KNOWN TABLES PER (db, col)
+        self._tables: Dict[Tuple[str, str], Tuple[List[str], List[str]]] = {}
+
+    def _attach(self, db: str, keep: Sequence[str] = ()):
+        """
+        Private method to attach the database db, detaching the least
+        recently used database not in keep if MAX_ATTACHED are attached.
+        The lock must be held.
+        """
+        if db in self._attached:
+            self._attached.move_to_end(db)
+            return
+
+        while len(self._attached) >= MAX_ATTACHED:
+            lru = next((d for d in self._attached if d not in keep), None)
+            if lru is None:
+                raise ValueError(f"At most {MAX_ATTACHED} databases can be attached at once")
+            self._conn.execute(f"DETACH DATABASE {_quote(lru)}")
+            del self._attached[lru]
+
+        if self.root is None:
+            path = f"{self._memory_prefix}{quote(db, safe='')}?mode=memory&cache=shared"
+            if db not in self._memory:
+                self._memory[db] = sqlite3.connect(path, uri=True, check_same_thread=False)
+        else:
+            path = os.path.join(self.root, f"{db}.sqlite")
+        self._conn.execute(f"ATTACH DATABASE ? AS {_quote(db)}", (path,))
+        self._attached[db] = None
+
+    def _table(self, db: str, col: str) -> Optional[Tuple[List[str], List[str]]]:
+        """
+        Private method to attach the database of a table and get the columns
+        and primary key of the table, None if it does not exist. The lock
+        must be held.
+        """
+        self._attach(db)
+        if (db, col) not in self._tables:
+            info = self._conn.execute(f"PRAGMA {_quote(db)}.table_info({_quote(col)})").fetchall()
+            if not info:
+                return None
+            columns = [row[1] for row in info]
+            pk = [row[1] for row in sorted(info, key=lambda r: r[5]) if row[5] > 0]
+            self._tables[(db, col)] = (columns, pk)
+
+        return self._tables[(db, col)]
+
+    def _ensure_table(self, db: str, col: str, pk: List[str], fields: List[str]) -> List[str]:
+        """
+        Private method to create the table or add missing columns, the lock must be held.
+
+        Returns:
+            List[str]: primary key of the table
+        """
+        table = f"{_quote(db)}.{_quote(col)}"
+        known = self._table(db, col)
+
+        if known is None:
+            columns = list(dict.fromkeys(pk + fields))
+            self._conn.execute(
+                f"CREATE TABLE {table} ({', '.join(_quote(c) for c in columns)}, "
+                f"PRIMARY KEY ({', '.join(_quote(c) for c in pk)}))"
+            )
+            self._tables[(db, col)] = (columns, list(pk))
+            return list(pk)
+
+        columns, tpk = known
+        for field in fields:
+            if field not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {_quote(field)}")
+                columns.append(field)
+        return tpk
+
+    def get_number_of_documents(self, db: str, col: str) -> int:
+        """
+        Get the total number of records stored in the collection col
+        from the database db.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+
+        Returns:
+            int: number of records stored in col
+        """
+        with self._lock:
+            if self._table(db, col) is None:
+                return 0
+            return self._count(db, col)
+
+    def _count(self, db: str, col: str) -> int:
+        sql = f"SELECT count(*) FROM {_quote(db)}.{_quote(col)}"
+        return self._conn.execute(sql).fetchone()[0]
+
+    def save(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        unique: bool = True,
+        mode: Optional[str] = None,
+    ) -> Dict[str, int]:
+        """
+        Public method to save records to a table, the table is created with
+        the index fields as composite primary key.
+
+        Args:
+            - data (Union[List[Dict], Dict]): records to save
+            - db (str): database name
+            - col (str): collection name
+            - indexTupleList (List[Tuple[str, Any]]): index tuples or field names
+            - unique (bool): kept for the DataBroker protocol, the primary key is unique
+            - mode (Optional[str]): "upsert" or "insert" (default: broker write_mode)
+
+        Returns:
+            Dict[str, int]: number of inserted, updated and unchanged records
+        """
+        mode = mode or self.write_mode
+        if mode not in self.WRITE_MODES:
+            raise ValueError(f"Invalid write mode {mode}")
+
+        datal = data if isinstance(data, list) else [data]
+        fields = list(dict.fromkeys(k for rec in datal for k in rec if k != "_id"))
+        if not datal:
+            return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        with self._lock, self._conn:
+            pk = self._ensure_table(db, col, index_fields(indexTupleList), fields)
+
+            table = f"{_quote(db)}.{_quote(col)}"
+            names = ", ".join(_quote(f) for f in fields)
+            sql = (
+                f"INSERT {'OR IGNORE ' if mode == 'insert' else ''}INTO {table} ({names}) "
+                f"VALUES ({', '.join('?' * len(fields))})"
+                + (" ON CONFLICT DO NOTHING" if mode == "upsert" else "")
+            )
+            # THE CHANGES OF THE INSERT ARE THE INSERTED ROWS, NO COUNT QUERIES NEEDED
+            changes = self._conn.total_changes
+            self._conn.executemany(sql, ([_sql_value(rec.get(f)) for f in fields] for rec in datal))
+            inserted = self._conn.total_changes - changes
+
+            updated = 0
+            values = [f for f in fields if f not in pk]
+            if mode == "upsert" and values:
+                # ONLY ROWS WITH CHANGED VALUES COUNT AS UPDATED, ?NNN PARAMETERS ARE
+                # THE VALUES FOLLOWED BY THE KEYS
+                sql = (
+                    f"UPDATE {table} SET "
+                    + ", ".join(f"{_quote(f)} = ?{i + 1}" for i, f in enumerate(values))
+                    + " WHERE "
+                    + " AND ".join(
+                        f"{_quote(k)} = ?{len(values) + j + 1}" for j, k in enumerate(pk)
+                    )
+                    + " AND ("
+                    + " OR ".join(f"{_quote(f)} IS NOT ?{i + 1}" for i, f in enumerate(values))
+                    + ")"
+                )
+                changes = self._conn.total_changes
+                self._conn.executemany(
+                    sql, ([_sql_value(rec.get(f)) for f in values + pk] for rec in datal)
+                )
+                updated = self._conn.total_changes - changes
+
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": len(datal) - inserted - updated,
+        }
+
+    def _select(
+        self, db: str, col: str, searchdict: Dict, selectiondict: Dict
+    ) -> Optional[sqlite3.Cursor]:
+        """
+        Private method to run the select of load and load_columns, the lock
+        must be held. Returns None if the table does not exist.
+        """
+        table = self._table(db, col)
+        if table is None:
+            return None
+
+        columns, pk = table
+        projection = {k: v for k, v in selectiondict.items() if k != "_id"}
+        if any(projection.values()):
+            columns = [k for k in projection if projection[k] and k in columns]
+        else:
+            columns = [c for c in columns if c not in projection]
+
+        where, params = sql_where(searchdict)
+        sql = (
+            f"SELECT {', '.join(_quote(c) for c in columns)} FROM {_quote(db)}.{_quote(col)}"
+            f"{where} ORDER BY {', '.join(_quote(k) for k in pk)}"
+        )
+        return self._conn.execute(sql, params)
+
+    def load(self, db: str, col: str, searchdict: Dict, selectiondict={}) -> List[dict]:
+        """
+        Public method to load records, sorted on the primary key. Fields
+        that are NULL are left out of the records.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo style query
+            - selectiondict (dict): mongo style projection
+
+        Returns:
+            List[dict]: requested data as list of dicts
+        """
+        with self._lock:
+            cursor = self._select(db, col, searchdict, selectiondict)
+            if cursor is None:
+                return []
+            names = [d[0] for d in cursor.description]
+            return [
+                {k: v for k, v in zip(names, row) if v is not None} for row in cursor.fetchall()
+            ]
+
+    def load_columns(
+        self, db: str, col: str, searchdict: Dict = {}, selectiondict: Dict = {}
+    ) -> Dict[str, np.ndarray]:
+        """
+        Public method to load records as columns, sorted on the primary key.
+
+        Args:
+            - db (str): database name
+            - col (str): collection name
+            - searchdict (dict): mongo style query
+            - selectiondict (dict): mongo style projection
+
+        Returns:
+            Dict[str, np.ndarray]: column name -> values
+        """
+        with self._lock:
+            cursor = self._select(db, col, searchdict, selectiondict)
+            if cursor is None:
+                return {}
+            return self._columns(cursor)
+
+    @staticmethod
+    def _columns(cursor: sqlite3.Cursor) -> Dict[str, np.ndarray]:
+        names = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        cols = list(zip(*rows)) if rows else [()] * len(names)
+        return {k: column_array(v) for k, v in zip(names, cols)}
+
+    def query(
+        self, sql: str, params: Sequence = (), dbs: Sequence[str] = ()
+    ) -> Dict[str, np.ndarray]:
+        """
+        Public method to run a SQL query in-engine. Tables are addressed
+        as <db>."<col>".
+
+        Args:
+            - sql (str): SQL query
+            - params (Sequence): query parameters
+            - dbs (Sequence[str]): databases to attach before running the query,
+                at most MAX_ATTACHED
+
+        Returns:
+            Dict[str, np.ndarray]: column name -> values
+        """
+        with self._lock:
+            for db in dbs:
+                self._attach(db, keep=dbs)
+            return self._columns(self._conn.execute(sql, params))
+
+    def update(self, db: str, col: str, myquery, newvalues):
+        """
+        Public method to update records in a table.
+
+        Args:
+            - db (str): database to update
+            - col (str): collection to update
+            - myquery (dict): query to select records to update
+            - newvalues (dict): { "$set": {...} }
+        """
+        if set(newvalues) != {"$set"}:
+            raise ValueError("Only $set updates are supported on sql collections")
+
+        values = newvalues["$set"]
+        with self._lock, self._conn:
+            if self._table(db, col) is None:
+                return
+            self._ensure_table(db, col, [], list(values))
+
+            where, params = sql_where(myquery)
+            sets = ", ".join(f"{_quote(k)} = ?" for k in values)
+            x = self._conn.execute(
+                f"UPDATE {_quote(db)}.{_quote(col)} SET {sets}{where}",
+                [_sql_value(v) for v in values.values()] + params,
+            )
+
+        logger.info("{} documents updated.".format(x.rowcount))
+
+    def close(self):
+        """
+        Public method to close the connections, in-memory databases are dropped.
+        """
+        with self._lock:
+            self._conn.close()
+            for conn in self._memory.values():
+                conn.close()
+            self._memory.clear()
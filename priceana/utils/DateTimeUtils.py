@@ -8,9 +8,21 @@ A module containing methods for date validation and cleaning.
 
 """
 
+import re
 import time
 from datetime import datetime as dt
-from typing import Dict, Optional, Union
+from datetime import timezone
+from typing import Any, Dict, Optional, Union
+
+# RECORD FIELDS HOLDING THE BAR DATE (DAILY) OR TIME (INTRADAY)
+DATETIME_FIELDS = ("date", "datetime")
+
+# QUERY OPERATORS WHOSE OPERANDS ARE CONVERTED BY native_query
+COMPARISON_OPERATORS = ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin")
+
+# COLLECTIONS OF DATED BARS BESIDES THE PRICE INTERVALS ("1d", "1h", "1wk", ...)
+NATIVE_COLLECTIONS = ("Dividends", "Splits")
+_INTERVAL_PATTERN = re.compile(r"^\d+(m|h|d|wk|mo)$")
 
 
 def validate_date(_date: Union[dt, str]) -> None:
@@ -72,3 +84,82 @@ def clean_start_end_period(
         params = {"range": period}
 
     return params
+
+
+def to_utc_datetime(value: Union[dt, str]) -> dt:
+    """Method to convert a stored date or datetime to a naive UTC datetime,
+    as BSON datetimes are stored by pymongo.
+
+    Args:
+        value (Union[dt, str]): "YYYY-MM-DD" date (midnight), ISO datetime
+            with offset or datetime
+
+    Returns:
+        dt: naive datetime in UTC
+    """
+    if not isinstance(value, dt):
+        # fromisoformat ONLY ACCEPTS THE "Z" SUFFIX FROM PYTHON 3.11 ON
+        value = dt.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def native_collection(col: str) -> bool:
+    """Method to check if the date and datetime fields of a collection are
+    stored as native datetimes in datetime_mode "native": the price
+    intervals, dividends and splits. The date fields of the fundamentals
+    are periods as "2Q2021" and are kept as strings.
+
+    Args:
+        col (str): collection name
+
+    Returns:
+        bool: True for collections of dated bars
+    """
+    return col in NATIVE_COLLECTIONS or _INTERVAL_PATTERN.match(col) is not None
+
+
+def native_record(rec: dict) -> dict:
+    """Method to get a copy of a record with native UTC datetimes
+    in its date and datetime fields.
+
+    Args:
+        rec (dict): record with date strings
+
+    Returns:
+        dict: converted copy of the record
+    """
+    out = dict(rec)
+    for k in DATETIME_FIELDS:
+        if isinstance(out.get(k), str):
+            out[k] = to_utc_datetime(out[k])
+    return out
+
+
+def native_query(searchdict: Dict[str, Any]) -> Dict[str, Any]:
+    """Method to convert the date strings of a mongo query on the date
+    and datetime fields to native UTC datetimes. Only equality and the
+    operands of the comparison operators are converted, other operators
+    like $regex or $exists are left untouched.
+
+    Args:
+        searchdict (Dict[str, Any]): mongo query
+
+    Returns:
+        Dict[str, Any]: converted query
+    """
+
+    def operand(value):
+        if isinstance(value, str):
+            return to_utc_datetime(value)
+        if isinstance(value, list):
+            return [operand(v) for v in value]
+        return value
+
+    def convert(value):
+        if isinstance(value, dict):
+            return {op: operand(v) if op in COMPARISON_OPERATORS else v for op, v in value.items()}
+        return operand(value)
+
+    return {k: convert(v) if k in DATETIME_FIELDS else v for k, v in searchdict.items()}
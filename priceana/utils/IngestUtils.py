@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.IngestUtils
+=================================================================
+
+A module containing a multi-process price ingestion runner.
+
+The ticker universe is sharded round-robin over N worker processes.
+Each worker runs its own event loop, HTTP session and DataBroker
+(created in the worker by a picklable factory, clients must not be
+shared across processes) and gets 1/N of the global request-rate
+budget. The per-worker reports are aggregated into one run report.
+
+Usage:
+
+    python -m priceana.utils.IngestUtils AAPL MSFT ... --mongo mongodb://localhost:27017 --processes 16
+
+"""
+import argparse
+import asyncio
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, List, Optional
+
+from aiohttp import ClientSession
+from termcolor import colored
+
+from .AsyncUtils import aparse_yahoo_prices, save_yahoo_prices
+from .DataBroker import BufferedDataBroker, DataBroker, DataBrokerMongoDb
+from .LoggingUtils import logger
+from .UrlUtils import generate_price_params, plan_combinations
+
+# COUNTERS OF A RUN REPORT
+REPORT_COUNTS = ["symbols", "requests", "ok", "failed", "records"]
+
+
+class RateLimiter:
+    """
+    Async limiter of the request rate and the number of open requests.
+    Used in place of the Semaphore passed to the fetch coroutines, create
+    it inside the running event loop.
+    """
+
+    def __init__(self, rate: Optional[float] = None, concurrency: int = 1000):
+        """
+        Args:
+            - rate (Optional[float]): maximum requests per second, unlimited if None
+            - concurrency (int): maximum number of open requests
+        """
+        self.rate = rate
+        self._sem = asyncio.Semaphore(concurrency)
+        self._next = 0.0
+
+    async def __aenter__(self):
+        await self._sem.acquire()
+        if self.rate:
+            # RESERVE THE NEXT SLOT, NO AWAIT BETWEEN READ AND WRITE
+            now = asyncio.get_event_loop().time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+            if start > now:
+                await asyncio.sleep(start - now)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._sem.release()
+
+
+def mongo_broker(uri: str, **kwargs) -> DataBrokerMongoDb:
+    """
+    Method to create a DataBrokerMongoDb with its own client, pass it as
+    partial(mongo_broker, uri) to get a picklable broker factory.
+
+    Args:
+        - uri (str): mongodb uri
+        - kwargs: further DataBrokerMongoDb arguments
+
+    Returns:
+        DataBrokerMongoDb: broker
+    """
+    from pymongo import MongoClient
+
+    return DataBrokerMongoDb(MongoClient(uri), **kwargs)
+
+
+async def _ingest(
+    worker: int,
+    tickers: List[str],
+    databroker: DataBroker,
+    dbname: str,
+    params: List[dict],
+    rate: Optional[float],
+    concurrency: int,
+    stream: bool,
+) -> dict:
+    """
+    Private method to download and save the prices of a shard on the running
+    loop. A fixed number of workers take the units from the lazy plan, a unit
+    that raises counts as failed and does not stop the shard.
+    """
+    report = dict.fromkeys(REPORT_COUNTS, 0)
+    report.update({"worker": worker, "pid": os.getpid(), "symbols": len(tickers)})
+    limiter = RateLimiter(rate, concurrency)
+
+    async def _one(tup) -> bool:
+        interval, prices, div, split = await aparse_yahoo_prices(limiter, tup, session, stream)
+        if prices is None:
+            return False
+
+        symbol = tup[0].split("/")[-1]
+        if not save_yahoo_prices(databroker, dbname, symbol, interval, prices, div, split):
+            return False
+        report["records"] += len(prices)
+        return True
+
+    units = plan_combinations(tickers, params)
+
+    async def _worker():
+        for tup in units:
+            report["requests"] += 1
+            try:
+                ok = await _one(tup)
+            except Exception:
+                ok = False
+                logger.exception(colored(f"Worker {worker} failed on {tup[0]}", "red"))
+            report["ok" if ok else "failed"] += 1
+
+    async with ClientSession() as session:
+        results = await asyncio.gather(
+            *[_worker() for _ in range(concurrency)], return_exceptions=True
+        )
+
+    for res in results:
+        if isinstance(res, BaseException):
+            logger.error(colored(f"Worker {worker} stopped: {res!r}", "red"))
+
+    return report
+
+
+def ingest_shard(
+    worker: int,
+    tickers: List[str],
+    broker_factory: Callable[[], DataBroker],
+    dbname: str = "FinData",
+    period: str = "max",
+    interval: str = "1d",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    rate: Optional[float] = None,
+    concurrency: int = 1000,
+    stream: bool = False,
+) -> dict:
+    """
+    Method to ingest one shard, run in a worker process. Creates its own
+    event loop, HTTP session and DataBroker. The event loop of the caller
+    is restored afterwards, as for processes=1 the shard runs in-process.
+
+    Args:
+        - worker (int): worker number
+        - tickers (List[str]): symbols of the shard
+        - broker_factory (Callable[[], DataBroker]): picklable DataBroker factory
+        - dbname (str): name of the database to write the data to
+        - period (str): historical time period
+        - interval (str): price time-series interval, "all" for all intervals
+        - start (Optional[str]): start date
+        - end (Optional[str]): end date
+        - rate (Optional[float]): maximum requests per second of this worker
+        - concurrency (int): maximum number of open requests of this worker
+        - stream (bool): incrementally parse the chart responses
+
+    Returns:
+        dict: worker report with the counts of REPORT_COUNTS, seconds and pid
+    """
+    t0 = time.perf_counter()
+    databroker = broker_factory()
+    params = generate_price_params(period, interval, start, end)
+
+    try:
+        previous = asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        previous = None
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        report = loop.run_until_complete(
+            _ingest(worker, tickers, databroker, dbname, params, rate, concurrency, stream)
+        )
+    finally:
+        # NOTHING MAY STAY BEHIND IN A WRITE BUFFER
+        if isinstance(databroker, BufferedDataBroker):
+            databroker.close()
+        loop.close()
+        asyncio.set_event_loop(previous)
+
+    report["seconds"] = time.perf_counter() - t0
+    logger.info(colored(f"Worker {worker} done: {report}", "green"))
+    return report
+
+
+def run_sharded_ingest(
+    tickers: List[str],
+    broker_factory: Callable[[], DataBroker],
+    dbname: str = "FinData",
+    processes: Optional[int] = None,
+    period: str = "max",
+    interval: str = "1d",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    rate: Optional[float] = None,
+    concurrency: int = 1000,
+    stream: bool = False,
+) -> dict:
+    """
+    Method to ingest the prices of a ticker universe with a pool of worker processes.
+
+    Args:
+        - tickers (List[str]): symbols to ingest
+        - broker_factory (Callable[[], DataBroker]): picklable DataBroker factory,
+            e.g. partial(mongo_broker, uri), called once per worker
+        - dbname (str): name of the database to write the data to
+        - processes (Optional[int]): number of worker processes,
+            defaults to the number of cores, 1 runs in-process
+        - period (str): historical time period
+        - interval (str): price time-series interval, "all" for all intervals
+        - start (Optional[str]): start date
+        - end (Optional[str]): end date
+        - rate (Optional[float]): global maximum requests per second, split
+            evenly among the workers
+        - concurrency (int): global maximum number of open requests, split
+            evenly among the workers
+        - stream (bool): incrementally parse the chart responses
+
+    Returns:
+        dict: run report with the summed counts of REPORT_COUNTS, the wall
+            seconds, the request rate and the worker reports under "workers"
+    """
+    t0 = time.perf_counter()
+    processes = max(1, min(processes or os.cpu_count() or 1, len(tickers)))
+    shards = [tickers[i::processes] for i in range(processes)]
+
+    shard = partial(
+        ingest_shard,
+        broker_factory=broker_factory,
+        dbname=dbname,
+        period=period,
+        interval=interval,
+        start=start,
+        end=end,
+        rate=rate / processes if rate else None,
+        concurrency=max(1, concurrency // processes),
+        stream=stream,
+    )
+
+    if processes == 1:
+        reports = [shard(0, shards[0])]
+    else:
+        with Pool(processes) as pool:
+            reports = pool.starmap(shard, enumerate(shards))
+
+    report: dict = {k: sum(r[k] for r in reports) for k in REPORT_COUNTS}
+    report["seconds"] = time.perf_counter() - t0
+    report["requests_per_second"] = report["requests"] / report["seconds"]
+    report["workers"] = reports
+
+    logger.info(colored(f"Ingest done: { {k: report[k] for k in REPORT_COUNTS} }", "green"))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest yahoo prices with worker processes.")
+    parser.add_argument("tickers", nargs="+", help="yahoo symbols")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongodb uri")
+    parser.add_argument("--db", default="FinData", help="database name")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes")
+    parser.add_argument("--period", default="max", help="historical time period")
+    parser.add_argument("--interval", default="1d", help="price interval or all")
+    parser.add_argument("--start", default=None, help="start date YYYY-MM-DD")
+    parser.add_argument("--end", default=None, help="end date YYYY-MM-DD")
+    parser.add_argument("--rate", type=float, default=None, help="global requests per second")
+    parser.add_argument("--concurrency", type=int, default=1000, help="global open requests")
+    parser.add_argument("--stream", action="store_true", help="incremental chart parsing")
+    args = parser.parse_args()
+
+    run_sharded_ingest(
+        args.tickers,
+        partial(mongo_broker, args.mongo),
+        args.db,
+        args.processes,
+        args.period,
+        args.interval,
+        args.start,
+        args.end,
+        args.rate,
+        args.concurrency,
+        args.stream,
+    )
+
+
+if __name__ == "__main__":
+    main()
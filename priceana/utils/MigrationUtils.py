@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.MigrationUtils
+=================================================================
+
+A module containing the migration of stored date and datetime
+strings to native BSON datetimes in UTC, the storage of a
+DataBrokerMongoDb with datetime_mode="native".
+
+Documents are converted in batches of bulk updates keyed on _id,
+documents that were already converted are skipped, so the migration
+can be interrupted and rerun. By default the collections of dated bars
+(prices, dividends and splits, see native_collection) are migrated,
+values that are no ISO dates are left as they are. Bucketed collections
+are skipped, the first and last dates of the coverage catalog are
+converted as well.
+
+Usage:
+
+    python -m priceana.utils.MigrationUtils --mongo mongodb://localhost:27017 --db FinData
+
+"""
+import argparse
+from datetime import datetime as dt
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+from termcolor import colored
+
+from .DataBroker import CATALOG_COLLECTION, DataBrokerMongoDb
+from .DateTimeUtils import DATETIME_FIELDS, native_collection, to_utc_datetime
+from .LoggingUtils import logger
+
+
+def _convert(doc: dict, fields: List[str]) -> Dict[str, dt]:
+    """
+    Private method to convert the date strings of a document, values that
+    are no ISO dates are skipped.
+    """
+    values = {}
+    for k in fields:
+        if isinstance(doc.get(k), str):
+            try:
+                values[k] = to_utc_datetime(doc[k])
+            except ValueError:
+                pass
+    return values
+
+
+def migrate_datetimes(
+    databroker: DataBrokerMongoDb,
+    db: str,
+    collections: Optional[List[str]] = None,
+    batch_size: int = 1000,
+) -> Dict[str, int]:
+    """
+    Method to convert the date and datetime string fields of stored
+    collections to native UTC datetimes.
+
+    Args:
+        - databroker (DataBrokerMongoDb): broker of the database
+        - db (str): database name
+        - collections (Optional[List[str]]): collections to migrate, all price,
+            dividend and split collections if None
+        - batch_size (int): number of documents per bulk update
+
+    Returns:
+        Dict[str, int]: number of converted documents per collection
+    """
+    dbm = databroker.client[db]
+    if collections is None:
+        collections = sorted(c for c in dbm.list_collection_names() if native_collection(c))
+
+    counts: Dict[str, int] = {}
+    for col in collections:
+        if col in databroker.bucket_collections:
+            logger.info(colored(f"Skipping bucketed collection {db}.{col}", "yellow"))
+            continue
+
+        colm = dbm[col]
+        query = {"$or": [{k: {"$type": "string"}} for k in DATETIME_FIELDS]}
+        projection = {k: True for k in DATETIME_FIELDS}
+
+        n = 0
+        requests = []
+        for doc in colm.find(query, projection, batch_size=batch_size):
+            values = _convert(doc, list(DATETIME_FIELDS))
+            if not values:
+                continue
+            requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": values}))
+
+            if len(requests) >= batch_size:
+                n += colm.bulk_write(requests, ordered=False).modified_count
+                requests = []
+
+        if requests:
+            n += colm.bulk_write(requests, ordered=False).modified_count
+
+        counts[col] = n
+        if databroker.cache is not None:
+            databroker.cache.invalidate(db, col)
+        logger.info(colored(f"Migrated {n} documents of {db}.{col}", "green"))
+
+    # CATALOG RANGES OF THE MIGRATED COLLECTIONS
+    catalog = dbm[CATALOG_COLLECTION]
+    for doc in catalog.find({"collection": {"$in": list(counts)}}, {"first": True, "last": True}):
+        values = _convert(doc, ["first", "last"])
+        if values:
+            catalog.update_one({"_id": doc["_id"]}, {"$set": values})
+
+    return counts
+
+
+def main():
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Convert stored date strings to BSON datetimes.")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongodb uri")
+    parser.add_argument("--db", default="FinData", help="database name")
+    parser.add_argument("--collections", nargs="*", default=None)
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per bulk update")
+    args = parser.parse_args()
+
+    migrate_datetimes(
+        DataBrokerMongoDb(MongoClient(args.mongo)), args.db, args.collections, args.batch_size
+    )
+
+
+if __name__ == "__main__":
+    main()
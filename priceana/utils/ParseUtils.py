@@ -97,6 +97,9 @@ def parse_quotes_as_frame(data: dict) -> pd.DataFrame:
             quotes.index = [ts.strftime("%Y-%m-%d") for ts in quotes.index]
             quotes.index.name = "date"
 
+        # EXCHANGE TIMEZONE, STORED ONCE PER SYMBOL WITH NATIVE DATETIMES
+        quotes.attrs["exchangeTimezoneName"] = data["meta"]["exchangeTimezoneName"]
+
         return quotes
 
     except (TypeError, AttributeError, KeyError, ValueError, IndexError) as e:
@@ -173,6 +176,15 @@ def _parse_actions_as_frame(
     return dividend, split
 
 
+# KEYS CONTAINING ONE OF THESE SUBSTRINGS ARE STORED USING THE FMT VALUE
+RAW_FMT_DATE_KEYS = [
+    "date",
+    "lastfiscalYearEnd",
+    "nextfiscalYearEnd",
+    "mostrecentQuarter",
+]
+
+
 def parse_raw_fmt(dc: Union[dict, None]) -> dict:
     """
     Private method to clean yahoo returned data. More specifically to remove the
@@ -197,13 +209,7 @@ def parse_raw_fmt(dc: Union[dict, None]) -> dict:
         if isinstance(value, dict):
             if "raw" in value.keys():
                 # RAW EXCEPTION LIST -> USE FMT HERE
-                _datelist = [
-                    "date",
-                    "lastfiscalYearEnd",
-                    "nextfiscalYearEnd",
-                    "mostrecentQuarter",
-                ]
-                if any(substring.lower() in key.lower() for substring in _datelist):
+                if any(substring.lower() in key.lower() for substring in RAW_FMT_DATE_KEYS):
                     newdc[key] = value.get("fmt", None)
 
                 # IF DATA IS IN PERCENTAGE USE FMT
@@ -347,6 +353,137 @@ def parse_from_multiindex(current_symbol: str, gen: Generator) -> dict:
         return {}
 
 
+# SENTINEL FOR KEYS ABSENT FROM A RECORD - DISTINCT FROM AN EXPLICIT None
+_MISSING = object()
+
+
+def _infer_record_column(values: list) -> list:
+    """
+    Private method to coerce the values of a single record column the way
+    pandas infers the dtype of an object column.
+
+    Args:
+        - values (list): column values, missing keys given as _MISSING
+
+    Returns:
+        list: coerced column values
+    """
+    present = [v for v in values if v is not _MISSING and v is not None]
+    isnull = len(present) != len(values)
+
+    # ALL BOOLEANS WITHOUT GAPS STAY BOOLEANS
+    if present and not isnull and all(isinstance(v, bool) for v in present):
+        return values
+
+    # NUMERIC COLUMNS - INTS ONLY SURVIVE IF NOTHING IS MISSING
+    if present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        if not isnull and all(isinstance(v, int) for v in present):
+            return values
+        return [np.nan if (v is _MISSING or v is None) else float(v) for v in values]
+
+    # OBJECT COLUMN - MISSING KEYS BECOME NAN, EXPLICIT NONE IS KEPT
+    return [np.nan if v is _MISSING else v for v in values]
+
+
+def align_records(records: List[Union[dict, float, int, str]]) -> List[dict]:
+    """
+    Method to align a list of records on a common set of keys without
+    building a DataFrame. The result is identical to
+    pd.DataFrame(records).to_dict(orient="records"): keys are ordered by first
+    appearance, missing keys are filled with NaN and numeric columns with gaps
+    are cast to float.
+
+    Args:
+        - records (List[Union[dict, float, int, str]]): records to align,
+            scalars are treated as {0: value}
+
+    Returns:
+        List[dict]: aligned records
+    """
+    records = [rec if isinstance(rec, dict) else {0: rec} for rec in records]
+
+    # KEY ORDER OF FIRST APPEARANCE - SAME AS DATAFRAME COLUMNS
+    columns: Dict = {}
+    for rec in records:
+        for k in rec:
+            columns.setdefault(k, None)
+
+    coerced = [_infer_record_column([rec.get(k, _MISSING) for rec in records]) for k in columns]
+
+    return [dict(zip(columns, row)) for row in zip(*coerced)]
+
+
+# FINANCIAL DATA NOT CONTAINING SOME KIND
+# OF DATE REFERENCE NEED MANUAL ADDING OF DATE
+FINANCIAL_DATEUPDATELIST = [
+    "assetProfile",
+    "recommendationTrend_trend",
+    "indexTrend_estimates",
+    "indexTrend",
+    "defaultKeyStatistics",
+    "summaryDetail",
+    "calendarEvents_earnings",
+    "price",
+    "earningsTrend_trend_earningsEstimate",
+    "earningsTrend_trend_revenueEstimate",
+    "earningsTrend_trend_epsTrend",
+    "earningsTrend_trend_epsRevisions",
+    "earningsTrend_trend",
+    "majorHoldersBreakdown",
+    "earningsHistory_history",
+    "netSharePurchaseActivity",
+    "insiderTransactions_transactions",
+    "financialData",
+    "quoteType",
+    "calendarEvents",
+    "esgScores_peerEsgScorePerformance",
+    "esgScores_peerEnvironmentPerformance",
+    "esgScores_peerEsgScorePerformance",
+    "esgScores_peerGovernancePerformance",
+    "esgScores_peerHighestControversyPerformance",
+    "esgScores_peerSocialPerformance",
+    "majorDirectHolders_holders",
+]
+
+
+def parse_financial_records(tfd: List[dict], current_symbol: str, date: str) -> dict:
+    """
+    Method to group multi-index financial data into tables of records,
+    stamping the date and symbol on each record.
+
+    Args:
+        - tfd (List[dict]): multi-index dicts, see parse_to_multiindex
+        - current_symbol (str): ticker symbol
+        - date (str): date (YYYY-MM-DD) for the tables without a date reference
+
+    Returns:
+        dict: keys are table names and values are lists of records
+    """
+    _keys = [k for k, g in itertools.groupby(tfd, lambda x: list(x.keys())[0])]
+    cglist = [
+        list(map(lambda d: list(d.values())[0], list(g)))
+        for k, g in itertools.groupby(tfd, lambda x: list(x.keys())[0])
+    ]
+    dc = dict(zip(_keys, cglist))
+
+    dc = {k: v for k, v in dc.items() if v not in [[None], [{"maxAge": 86400}], [{"maxAge": 1}]]}
+
+    # ALIGN THE RECORDS PER TABLE WITHOUT THE DATAFRAME ROUND TRIP
+    data = {"_".join(k): align_records(v) for k, v in dc.items()}
+
+    for k, v in data.items():
+        for record in v:
+            if k in FINANCIAL_DATEUPDATELIST:
+                record["date"] = date
+                if k == "majorHoldersBreakdown":
+                    record["reportDate"] = date
+
+            if k != "quoteType":
+                record["symbol"] = current_symbol
+
+    return data
+
+
 def parse_prices(
     data: Union[dict, None]
 ) -> Tuple[
@@ -473,18 +610,5 @@ def generate_database_indices_dict(dc: Union[dict, None]) -> dict:
     if dc == {} or dc is None:
         return {}
     else:
-        requests = []
-        requests_keys = []
-        for k, vdc in dc.items():
-            if vdc == [] or vdc is None:
-                continue
-            else:
-                v = pd.DataFrame(vdc)
-                requests_keys.append(k)
-                requests.append(v)
-
-        # db_index_handler_client = DatabaseIndexHandlerClient()
-        # res = db_index_handler_client.delegate(requests)
-
-        res = dict(zip(requests_keys, [indexDict[k] for k in requests_keys]))
-        return res  # dict(zip(requests_keys, res))
+        # INDEXES ONLY DEPEND ON THE TABLE NAME - NO NEED TO LOOK AT THE RECORDS
+        return {k: indexDict[k] for k, vdc in dc.items() if vdc != [] and vdc is not None}
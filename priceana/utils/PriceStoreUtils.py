@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.PriceStoreUtils
+=================================================================
+
+A module containing a read-optimized, memory-mapped price store.
+
+Each (symbol, interval) series is kept as one flat binary file per
+field, epoch and volume as int64, the prices as float64:
+
+    <root>/<interval>/<symbol>.<field>
+
+The offset index of a series, <root>/<interval>/<symbol>.index, holds
+the number of committed rows, the first and last epoch and the version
+of the field files. It is replaced atomically by each append, appends
+of different symbols never touch the same files and can run in parallel
+processes (one writer per series). Rows beyond the committed length (an
+interrupted append) are ignored by readers and overwritten by the next
+append. A merge writes a new version of all field files,
+
+    <root>/<interval>/<symbol>@<version>.<field>
+
+and commits it with the offset index, an interrupted merge leaves the
+committed version untouched.
+
+Reading a series maps the files read-only with np.memmap, columns
+are only mapped when accessed, nothing is copied or deserialized.
+
+"""
+import json
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+# FIELDS OF A SERIES AND THEIR DTYPES
+FIELDS = {
+    "epoch": np.int64,
+    "open": np.float64,
+    "high": np.float64,
+    "low": np.float64,
+    "close": np.float64,
+    "adjclose": np.float64,
+    "volume": np.int64,
+}
+
+_INDEX_SUFFIX = ".index"
+
+
+def _field_file(name: str, field: str, version: int = 0) -> str:
+    """File name of a field of a series, "@" is quoted in the names."""
+    return f"{name}.{field}" if version == 0 else f"{name}@{version}.{field}"
+
+
+class PriceSeries:
+    """
+    Read-only view of a stored series. The fields are attributes holding
+    memory-mapped arrays, each file is mapped on first access.
+    """
+
+    def __init__(self, folder: str, name: str, length: int, version: int = 0):
+        self._folder = folder
+        self._name = name
+        self._version = version
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getattr__(self, field: str) -> np.ndarray:
+        if field not in FIELDS:
+            raise AttributeError(field)
+
+        if self.length == 0:
+            values = np.empty(0, dtype=FIELDS[field])
+        else:
+            path = os.path.join(self._folder, _field_file(self._name, field, self._version))
+            values = np.memmap(path, dtype=FIELDS[field], mode="r", shape=(self.length,))
+
+        # CACHE THE MAPPING, __getattr__ IS NOT CALLED AGAIN
+        setattr(self, field, values)
+        return values
+
+    def window(self, start: Optional[int] = None, end: Optional[int] = None) -> slice:
+        """
+        Public method to get the rows with start <= epoch < end.
+
+        Args:
+            - start (Optional[int]): first epoch to include
+            - end (Optional[int]): first epoch to exclude
+
+        Returns:
+            slice: rows of the window, apply to any field array
+        """
+        i = 0 if start is None else int(np.searchsorted(self.epoch, start, side="left"))
+        j = self.length if end is None else int(np.searchsorted(self.epoch, end, side="left"))
+        return slice(i, j)
+
+
+class PriceStore:
+    """
+    Memory-mapped store of the price series per (symbol, interval).
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+        # OFFSET INDEX PER INTERVAL AND SYMBOL, LOADED ON FIRST USE
+        self._index: Dict[str, Dict[str, dict]] = {}
+        self._lock = threading.Lock()
+
+    def _folder(self, interval: str) -> str:
+        return os.path.join(self.root, interval)
+
+    @staticmethod
+    def _name(symbol: str) -> str:
+        return quote(symbol, safe="")
+
+    def _load_index(self, interval: str) -> Dict[str, dict]:
+        if interval not in self._index:
+            folder = self._folder(interval)
+            index: Dict[str, dict] = {}
+            for filename in os.listdir(folder) if os.path.isdir(folder) else []:
+                if filename.endswith(_INDEX_SUFFIX):
+                    symbol = unquote(filename[: -len(_INDEX_SUFFIX)])
+                    meta = self._read_meta(interval, symbol)
+                    if meta is not None:
+                        index[symbol] = meta
+            self._index[interval] = index
+
+        return self._index[interval]
+
+    def _read_meta(self, interval: str, symbol: str) -> Optional[dict]:
+        path = os.path.join(self._folder(interval), self._name(symbol) + _INDEX_SUFFIX)
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, interval: str, symbol: str, meta: dict):
+        path = os.path.join(self._folder(interval), self._name(symbol) + _INDEX_SUFFIX)
+        tmppath = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmppath, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmppath, path)
+
+    def refresh(self, interval: Optional[str] = None):
+        """
+        Public method to reread the offset index after appends by other processes.
+
+        Args:
+            - interval (Optional[str]): interval to reread, all if None
+        """
+        with self._lock:
+            if interval is None:
+                self._index.clear()
+            else:
+                self._index.pop(interval, None)
+
+    def symbols(self, interval: str) -> List[str]:
+        """
+        Public method to list the stored symbols of an interval.
+
+        Args:
+            - interval (str): price interval
+
+        Returns:
+            List[str]: symbols, sorted
+        """
+        with self._lock:
+            return sorted(self._load_index(interval))
+
+    def append(self, symbol: str, interval: str, columns: Dict[str, np.ndarray]) -> int:
+        """
+        Public method to append rows to a series. Rows after the last stored
+        epoch are written in place. If any row is at or before it, the series
+        is merged and written as a new version of the field files, new rows
+        replace stored rows with the same epoch. Series opened before a merge
+        keep the fields they mapped, they are reopened to read the others.
+
+        Args:
+            - symbol (str): ticker symbol
+            - interval (str): price interval
+            - columns (Dict[str, np.ndarray]): field -> values, epoch required,
+                missing price fields are NaN, missing volume is 0
+
+        Returns:
+            int: number of rows of the series after the append
+        """
+        epoch = np.asarray(columns["epoch"], dtype=np.int64)
+        n = len(epoch)
+        new = {
+            f: np.asarray(columns[f], dtype=dt)
+            if f in columns
+            else np.full(n, np.nan if dt is np.float64 else 0, dtype=dt)
+            for f, dt in FIELDS.items()
+        }
+        order = np.argsort(epoch, kind="stable")
+        new = {f: v[order] for f, v in new.items()}
+
+        with self._lock:
+            index = self._load_index(interval)
+            folder = self._folder(interval)
+            name = self._name(symbol)
+            os.makedirs(folder, exist_ok=True)
+
+            # THE INDEX FILE OF THE SERIES IS THE COMMITTED STATE, ALSO AFTER
+            # APPENDS BY OTHER PROCESSES
+            meta = self._read_meta(interval, symbol) or {"length": 0, "first": None, "last": None}
+            length = meta["length"]
+            version = meta.get("version", 0)
+
+            if length and n and new["epoch"][0] <= meta["last"]:
+                # OVERLAP - MERGE WITH THE STORED ROWS, THE NEW ONES WIN
+                series = PriceSeries(folder, name, length, version)
+                old = {f: np.array(getattr(series, f)) for f in FIELDS}
+                del series
+                keep = ~np.isin(old["epoch"], new["epoch"])
+                merged = {f: np.concatenate([old[f][keep], new[f]]) for f in FIELDS}
+                order = np.argsort(merged["epoch"], kind="stable")
+                rows = {f: v[order] for f, v in merged.items()}
+                offset = 0
+                # A NEW VERSION OF THE FILE SET, COMMITTED BY THE OFFSET INDEX
+                stale, version = version, version + 1
+            else:
+                rows = new
+                offset = length
+                stale = None
+
+            if len(rows["epoch"]):
+                for f, values in rows.items():
+                    path = os.path.join(folder, _field_file(name, f, version))
+                    # TRUNCATE UNCOMMITTED ROWS OF AN INTERRUPTED APPEND OR MERGE
+                    with open(path, "r+b" if offset else "wb") as fh:
+                        fh.truncate(offset * values.itemsize)
+                        fh.seek(offset * values.itemsize)
+                        fh.write(values.tobytes())
+
+                length = offset + len(rows["epoch"])
+                first = int(rows["epoch"][0]) if offset == 0 else meta["first"]
+                meta = {
+                    "length": length,
+                    "first": first,
+                    "last": int(rows["epoch"][-1]),
+                    "version": version,
+                }
+                self._write_meta(interval, symbol, meta)
+                index[symbol] = meta
+
+                if stale is not None:
+                    # OPEN MAPPINGS KEEP THE DATA OF THE REMOVED FILES
+                    for f in FIELDS:
+                        try:
+                            os.remove(os.path.join(folder, _field_file(name, f, stale)))
+                        except OSError:
+                            pass
+
+        return length
+
+    def append_frame(self, symbol: str, interval: str, prices: pd.DataFrame) -> int:
+        """
+        Public method to append a frame as returned by parse_prices. The
+        epoch is taken from the "datetime" or "date" index (daily bars at
+        midnight UTC).
+
+        Args:
+            - symbol (str): ticker symbol
+            - interval (str): price interval
+            - prices (pd.DataFrame): parsed prices
+
+        Returns:
+            int: number of rows of the series after the append
+        """
+        times = pd.to_datetime(pd.Index(prices.index), utc=True)
+        columns = {"epoch": times.asi8 // 10**9}
+        for f in FIELDS:
+            if f in prices.columns:
+                columns[f] = prices[f].to_numpy()
+        return self.append(symbol, interval, columns)
+
+    def open(self, symbol: str, interval: str) -> PriceSeries:
+        """
+        Public method to open a series, unknown series are empty.
+
+        Args:
+            - symbol (str): ticker symbol
+            - interval (str): price interval
+
+        Returns:
+            PriceSeries: memory-mapped series
+        """
+        with self._lock:
+            meta = self._load_index(interval).get(symbol, {"length": 0})
+        return PriceSeries(
+            self._folder(interval), self._name(symbol), meta["length"], meta.get("version", 0)
+        )
+
+    def open_many(
+        self, interval: str, symbols: Optional[Iterable[str]] = None
+    ) -> Dict[str, PriceSeries]:
+        """
+        Public method to open many series at once.
+
+        Args:
+            - interval (str): price interval
+            - symbols (Optional[Iterable[str]]): symbols to open, all if None
+
+        Returns:
+            Dict[str, PriceSeries]: symbol -> memory-mapped series
+        """
+        with self._lock:
+            index = dict(self._load_index(interval))
+
+        folder = self._folder(interval)
+        series = {}
+        for s in sorted(index) if symbols is None else symbols:
+            meta = index.get(s, {"length": 0})
+            series[s] = PriceSeries(folder, self._name(s), meta["length"], meta.get("version", 0))
+        return series
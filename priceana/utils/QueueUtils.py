@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.QueueUtils
+=================================================================
+
+A module containing a database-backed work queue for ingestion on
+many nodes.
+
+Each work item is one (url, params) combination as returned by
+generate_combinations, keyed on (endpoint, symbol, interval or
+modules). An item is pending, leased, done or failed. A worker claims
+a batch of items by leasing them for lease_seconds and extends the
+lease with heartbeats while working on them. Items of a worker that
+died become claimable again when their lease expires. A failed item
+is retried after an exponential backoff until max_attempts claims.
+
+Usage (on every node):
+
+    python -m priceana.utils.QueueUtils --mongo mongodb://host:27017
+
+"""
+import argparse
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime as dt
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import ClientSession
+from pymongo import ASCENDING, UpdateOne
+from termcolor import colored
+
+from .AsyncUtils import (
+    aparse_yahoo_financial_data,
+    aparse_yahoo_prices,
+    save_yahoo_financial_data,
+    save_yahoo_prices,
+)
+from .DataBroker import DataBrokerMongoDb
+from .IngestUtils import RateLimiter
+from .LoggingUtils import logger
+
+# STATES OF A WORK ITEM
+QUEUE_STATES = ["pending", "leased", "done", "failed"]
+
+
+class WorkQueue:
+    """
+    Work queue of (url, params) items in a collection of a DataBrokerMongoDb.
+    """
+
+    def __init__(
+        self,
+        databroker: DataBrokerMongoDb,
+        db: str = "FinData",
+        col: str = "JobQueue",
+        lease_seconds: float = 300.0,
+        max_attempts: int = 5,
+        retry_delay: float = 60.0,
+    ):
+        """
+        Args:
+            - databroker (DataBrokerMongoDb): broker of the queue database
+            - db (str): database name
+            - col (str): queue collection name
+            - lease_seconds (float): lease of a claimed item, extended by heartbeats
+            - max_attempts (int): claims of an item before it is failed
+            - retry_delay (float): delay in seconds before the first retry,
+                doubled per attempt
+        """
+        self.databroker = databroker
+        self.db = db
+        self.col = col
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        # available_at: WHEN A PENDING ITEM OR AN EXPIRED LEASE CAN BE CLAIMED
+        databroker.ensure_index(db, col, [("state", ASCENDING), ("available_at", ASCENDING)], False)
+        self.colm = databroker.client[db][col]
+
+    @staticmethod
+    def item_id(url: str, params: dict) -> str:
+        """
+        Public method to get the key of a work item.
+
+        Args:
+            - url (str): request url
+            - params (dict): request parameters
+
+        Returns:
+            str: "<endpoint>:<symbol>:<interval or modules>"
+        """
+        endpoint, symbol = url.rstrip("/").split("/")[-2:]
+        return f"{endpoint}:{symbol}:{params.get('interval', params.get('modules', ''))}"
+
+    def enqueue(self, combinations: Iterable[Tuple[str, dict]], reset: bool = False) -> int:
+        """
+        Public method to add work items. Items are keyed without the
+        periods, existing items keep their parameters and state unless reset.
+
+        Args:
+            - combinations (Iterable[Tuple[str, dict]]): (url, params) tuples
+            - reset (bool): give existing items the new parameters and set them
+                back to pending with no attempts, e.g. to refresh done items
+
+        Returns:
+            int: number of new items
+        """
+        now = dt.utcnow()
+        state = {"state": "pending", "attempts": 0, "available_at": now, "owner": None}
+
+        requests = []
+        for url, params in combinations:
+            item = {"url": url, "params": params}
+            if reset:
+                update = {"$set": {**item, **state}}
+            else:
+                update = {"$setOnInsert": {**item, **state}}
+            requests.append(UpdateOne({"_id": self.item_id(url, params)}, update, upsert=True))
+
+        if not requests:
+            return 0
+        return self.colm.bulk_write(requests, ordered=False).upserted_count
+
+    def claim(self, worker: str, n: int = 50) -> List[dict]:
+        """
+        Public method to lease up to n claimable items to a worker. Pending
+        items and items with an expired lease are claimable, each item is
+        leased to one worker only.
+
+        Args:
+            - worker (str): worker identity
+            - n (int): maximum number of items
+
+        Returns:
+            List[dict]: claimed items with _id, url, params and attempts
+        """
+        now = dt.utcnow()
+
+        # EXPIRED LEASES WITHOUT ATTEMPTS LEFT ARE FAILED
+        self.colm.update_many(
+            {
+                "state": "leased",
+                "available_at": {"$lte": now},
+                "attempts": {"$gte": self.max_attempts},
+            },
+            {"$set": {"state": "failed", "owner": None}},
+        )
+
+        claimable = {
+            "state": {"$in": ["pending", "leased"]},
+            "available_at": {"$lte": now},
+            "attempts": {"$lt": self.max_attempts},
+        }
+        ids = [
+            d["_id"]
+            for d in self.colm.find(claimable, {"_id": True})
+            .sort("available_at", ASCENDING)
+            .limit(n)
+        ]
+        if not ids:
+            return []
+
+        # THE FILTER IS RECHECKED PER DOCUMENT, A RACING WORKER GETS THE REST
+        token = uuid.uuid4().hex
+        self.colm.update_many(
+            {"_id": {"$in": ids}, **claimable},
+            {
+                "$set": {
+                    "state": "leased",
+                    "owner": worker,
+                    "claim": token,
+                    "available_at": now + timedelta(seconds=self.lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+        )
+        return list(
+            self.colm.find({"claim": token}, {"url": True, "params": True, "attempts": True})
+        )
+
+    def heartbeat(self, worker: str, ids: List[str]) -> int:
+        """
+        Public method to extend the leases of the items a worker is working on.
+
+        Args:
+            - worker (str): worker identity
+            - ids (List[str]): item keys
+
+        Returns:
+            int: number of extended leases, leases lost to another worker are not
+        """
+        lease = dt.utcnow() + timedelta(seconds=self.lease_seconds)
+        return self.colm.update_many(
+            {"_id": {"$in": list(ids)}, "state": "leased", "owner": worker},
+            {"$set": {"available_at": lease}},
+        ).modified_count
+
+    def complete(self, worker: str, ids: List[str]) -> int:
+        """
+        Public method to mark items of a worker as done.
+
+        Args:
+            - worker (str): worker identity
+            - ids (List[str]): item keys
+
+        Returns:
+            int: number of completed items
+        """
+        return self.colm.update_many(
+            {"_id": {"$in": list(ids)}, "state": "leased", "owner": worker},
+            {"$set": {"state": "done", "owner": None, "done_at": dt.utcnow()}},
+        ).modified_count
+
+    def fail(self, worker: str, ids: List[str], error: str = "") -> int:
+        """
+        Public method to release failed items of a worker, to be retried after
+        the backoff or failed when no attempts are left.
+
+        Args:
+            - worker (str): worker identity
+            - ids (List[str]): item keys
+            - error (str): error message kept on the items
+
+        Returns:
+            int: number of released items
+        """
+        now = dt.utcnow()
+        n = 0
+        for doc in self.colm.find(
+            {"_id": {"$in": list(ids)}, "state": "leased", "owner": worker}, {"attempts": True}
+        ):
+            attempts = doc["attempts"]
+            update = {"owner": None, "last_error": error}
+            if attempts >= self.max_attempts:
+                update["state"] = "failed"
+            else:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                update.update(state="pending", available_at=now + timedelta(seconds=delay))
+            n += self.colm.update_one(
+                {"_id": doc["_id"], "owner": worker}, {"$set": update}
+            ).modified_count
+        return n
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Public method to count the items per state.
+
+        Returns:
+            Dict[str, int]: state -> number of items
+        """
+        counts = dict.fromkeys(QUEUE_STATES, 0)
+        for res in self.colm.aggregate([{"$group": {"_id": "$state", "n": {"$sum": 1}}}]):
+            counts[res["_id"]] = res["n"]
+        return counts
+
+
+async def run_queue_worker(
+    queue: WorkQueue,
+    databroker: DataBrokerMongoDb,
+    dbname: str = "FinData",
+    worker: Optional[str] = None,
+    batch_size: int = 50,
+    rate: Optional[float] = None,
+    concurrency: int = 100,
+    poll_interval: Optional[float] = None,
+    stream: bool = False,
+) -> Dict[str, int]:
+    """
+    Method to work through the queue: claim a batch, download, parse and
+    save its items, heartbeat the leases meanwhile, then complete or fail them.
+
+    Args:
+        - queue (WorkQueue): work queue
+        - databroker (DataBrokerMongoDb): broker to save the data with
+        - dbname (str): name of the database to write the data to
+        - worker (Optional[str]): worker identity, defaults to host:pid
+        - batch_size (int): items per claim
+        - rate (Optional[float]): maximum requests per second
+        - concurrency (int): maximum number of open requests
+        - poll_interval (Optional[float]): keep polling while items are pending
+            or leased, return when nothing is claimable if None
+        - stream (bool): incrementally parse the chart responses
+
+    Returns:
+        Dict[str, int]: number of claimed, done and failed items
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    limiter = RateLimiter(rate, concurrency)
+    counts = {"claimed": 0, "done": 0, "failed": 0}
+
+    async def _one(item: dict, session: ClientSession) -> bool:
+        tup = (item["url"], item["params"])
+        symbol = item["url"].rstrip("/").split("/")[-1]
+        if item["_id"].startswith("chart:"):
+            interval, prices, div, split = await aparse_yahoo_prices(limiter, tup, session, stream)
+            if prices is None:
+                return False
+            return save_yahoo_prices(databroker, dbname, symbol, interval, prices, div, split)
+        else:
+            findata = await aparse_yahoo_financial_data(limiter, tup, session)
+            if not findata:
+                return False
+            save_yahoo_financial_data(databroker, dbname, symbol, findata)
+        return True
+
+    async def _heartbeat(ids: List[str]):
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            queue.heartbeat(worker, ids)
+
+    async with ClientSession() as session:
+        while True:
+            items = queue.claim(worker, batch_size)
+            if not items:
+                stats = queue.stats()
+                if poll_interval is None or not (stats["pending"] or stats["leased"]):
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+
+            counts["claimed"] += len(items)
+            beat = asyncio.ensure_future(_heartbeat([i["_id"] for i in items]))
+            try:
+                results = await asyncio.gather(
+                    *[_one(i, session) for i in items], return_exceptions=True
+                )
+            finally:
+                beat.cancel()
+
+            done = [i["_id"] for i, r in zip(items, results) if r is True]
+            failed = [i["_id"] for i, r in zip(items, results) if r is not True]
+            counts["done"] += queue.complete(worker, done)
+            if failed:
+                counts["failed"] += queue.fail(worker, failed, "download or parse failed")
+
+    logger.info(colored(f"Queue worker {worker} done: {counts}", "green"))
+    return counts
+
+
+def main():
+    from pymongo import MongoClient
+
+    from .UrlUtils import generate_combinations, generate_price_params, generate_price_urls
+
+    parser = argparse.ArgumentParser(description="Work through the ingestion queue.")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongodb uri")
+    parser.add_argument("--db", default="FinData", help="database name")
+    parser.add_argument("--enqueue", nargs="*", default=None, help="symbols to enqueue")
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="re-enqueue existing items with the new periods, also done and failed ones",
+    )
+    parser.add_argument("--period", default="max", help="historical time period")
+    parser.add_argument("--interval", default="1d", help="price interval or all")
+    parser.add_argument("--batch-size", type=int, default=50, help="items per claim")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second")
+    parser.add_argument("--poll", type=float, default=None, help="poll interval in seconds")
+    args = parser.parse_args()
+
+    databroker = DataBrokerMongoDb(MongoClient(args.mongo))
+    queue = WorkQueue(databroker, args.db)
+
+    if args.enqueue:
+        params = generate_price_params(args.period, args.interval, None, None)
+        queue.enqueue(
+            generate_combinations(generate_price_urls(args.enqueue), params), reset=args.reset
+        )
+        return
+
+    asyncio.get_event_loop().run_until_complete(
+        run_queue_worker(
+            queue,
+            databroker,
+            args.db,
+            batch_size=args.batch_size,
+            rate=args.rate,
+            poll_interval=args.poll,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
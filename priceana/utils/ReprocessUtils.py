@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.ReprocessUtils
+=================================================================
+
+A module containing methods for replaying the raw response archive
+through the parsers and into the DataBroker, without network access.
+
+Parsing is spread over a process pool, saving is done by the calling
+process through its DataBroker.
+
+Usage:
+
+    python -m priceana.utils.ReprocessUtils <archive root> --mongo mongodb://localhost:27017
+
+"""
+import argparse
+import os
+from multiprocessing import Pool
+from typing import List, Optional, Tuple, Union
+
+from termcolor import colored
+
+from .ArchiveUtils import ResponseArchive
+from .AsyncUtils import save_yahoo_financial_data, save_yahoo_prices
+from .DataBroker import DataBroker, DataBrokerMongoDb
+from .LoggingUtils import logger
+from .ParseUtils import parse_financial_records, parse_prices
+from .PriceStoreUtils import PriceStore
+from .SchemaUtils import quote_summary_schemas
+
+
+def parse_archived_response(path: str) -> Tuple[str, str, Union[tuple, dict, None]]:
+    """
+    Method to parse a single archived response.
+
+    Args:
+        - path (str): path of the archived response
+
+    Returns:
+        Tuple[str, str, Union[tuple, dict, None]]: (endpoint, symbol, parsed data),
+            parsed data is the parse_prices tuple for chart responses, the
+            financial records for quoteSummary responses and None on failure
+    """
+    endpoint, symbol = "", ""
+    try:
+        header, resp = ResponseArchive.load(path)
+        endpoint, symbol = header["url"].rstrip("/").split("/")[-2:]
+
+        if endpoint == "chart":
+            return endpoint, symbol, parse_prices(resp["chart"]["result"][0])
+
+        tfd = quote_summary_schemas.parse(resp["quoteSummary"]["result"][0])
+        return endpoint, symbol, parse_financial_records(tfd, symbol, header["date"])
+
+    except Exception as e:
+        logger.exception(colored(f"Failed reprocessing {path}: {e}", "red"))
+        return endpoint, symbol, None
+
+
+def reprocess_archive(
+    archive: ResponseArchive,
+    databroker: DataBroker,
+    dbname: str = "FinData",
+    processes: Optional[int] = None,
+    endpoint: Optional[str] = None,
+    symbols: Optional[List[str]] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    pricestore: Optional[PriceStore] = None,
+) -> dict:
+    """
+    Method to replay archived responses into the database.
+
+    Args:
+        - archive (ResponseArchive): archive to replay
+        - databroker (DataBroker): broker to save the parsed data with
+        - dbname (str): name of the database to write the data to
+        - processes (Optional[int]): number of parser processes,
+            defaults to the number of cores, 1 parses in-process
+        - endpoint (Optional[str]): only this endpoint ("chart" or "quoteSummary")
+        - symbols (Optional[List[str]]): only these symbols
+        - start (Optional[str]): first fetch date (YYYY-MM-DD) to include
+        - end (Optional[str]): last fetch date (YYYY-MM-DD) to include
+        - pricestore (Optional[PriceStore]): memory-mapped store to append the prices to
+
+    Returns:
+        dict: number of responses replayed per endpoint and failures
+    """
+    paths = list(archive.iter_paths(endpoint, symbols, start, end))
+    processes = processes or os.cpu_count() or 1
+
+    counts = {"chart": 0, "quoteSummary": 0, "failed": 0}
+
+    def _save(results):
+        for ep, symbol, parsed in results:
+            if parsed is None:
+                counts["failed"] += 1
+            elif ep == "chart":
+                save_yahoo_prices(databroker, dbname, symbol, *parsed, pricestore)
+                counts[ep] += 1
+            else:
+                save_yahoo_financial_data(databroker, dbname, symbol, parsed)
+                counts[ep] += 1
+
+    if processes == 1:
+        _save(map(parse_archived_response, paths))
+    else:
+        # ORDERED IMAP - OLDER RESPONSES ARE SAVED FIRST, AS IN THE LIVE RUNS
+        with Pool(processes) as pool:
+            chunksize = max(1, len(paths) // (4 * processes))
+            _save(pool.imap(parse_archived_response, paths, chunksize))
+
+    logger.info(colored(f"Reprocessing {archive.root} done: {counts}", "green"))
+    return counts
+
+
+def main():
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Replay the raw response archive.")
+    parser.add_argument("root", help="archive root directory")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017", help="mongodb uri")
+    parser.add_argument("--db", default="FinData", help="database name")
+    parser.add_argument("--processes", type=int, default=None, help="parser processes")
+    parser.add_argument("--endpoint", choices=["chart", "quoteSummary"], default=None)
+    parser.add_argument("--symbols", nargs="*", default=None)
+    parser.add_argument("--start", default=None, help="first fetch date YYYY-MM-DD")
+    parser.add_argument("--end", default=None, help="last fetch date YYYY-MM-DD")
+    parser.add_argument("--pricestore", default=None, help="memory-mapped price store root")
+    args = parser.parse_args()
+
+    reprocess_archive(
+        ResponseArchive(args.root),
+        DataBrokerMongoDb(MongoClient(args.mongo)),
+        args.db,
+        args.processes,
+        args.endpoint,
+        args.symbols,
+        args.start,
+        args.end,
+        PriceStore(args.pricestore) if args.pricestore else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.SchemaUtils
+=================================================================
+
+A module containing compiled schemas for parsing the yahoo
+quoteSummary modules.
+
+The generic parser (parse_raw_fmt followed by parse_to_multiindex)
+inspects the type of every value recursively. For the modules listed
+in indexDict the structure is known, so a schema is learned from the
+first observed payload and compiled into per-node parsers that only
+dispatch on the field name. The compiled parsers yield exactly the
+same multi-index records as the generic path.
+
+"""
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Set, Tuple
+
+from ..constants import all_keys
+from .LoggingUtils import logger
+from .ParseUtils import RAW_FMT_DATE_KEYS, indexDict, parse_raw_fmt, parse_to_multiindex
+
+# FIELD KINDS IN A LEARNED SCHEMA
+_SCALAR = "scalar"
+_VALUE = "value"
+_DICT = "dict"
+_LIST = "list"
+_MIXED = "mixed"
+
+_SCALAR_TYPES = {float, str, int, bool}
+
+
+def _compile_raw_fmt_converter(key: str) -> Callable[[dict], object]:
+    """
+    Private method to select the raw/fmt conversion for a field once,
+    mirroring the key based rules of parse_raw_fmt.
+
+    Args:
+        - key (str): field name
+
+    Returns:
+        Callable[[dict], object]: converter for {"raw": ..., "fmt": ...} values
+    """
+    lkey = key.lower()
+    if any(substring.lower() in lkey for substring in RAW_FMT_DATE_KEYS):
+        return lambda value: value.get("fmt", None)
+    elif "percent" in lkey:
+        return lambda value: float(value.get("fmt", None).split("%")[0].replace(",", ""))
+    else:
+        return lambda value: float(value.get("raw", None))
+
+
+def _learn_node(node: dict, payload: dict) -> None:
+    """
+    Private method to merge the structure of a raw payload into a schema node.
+
+    NOTE:
+        This is a recursive method.
+
+    Args:
+        - node (dict): schema node, field name -> {"kind": ..., "fields": ...}
+        - payload (dict): raw yahoo payload for this node
+    """
+    for key, value in payload.items():
+        # NONE AND EMPTY DICTS CARRY NO STRUCTURE
+        if value is None or (isinstance(value, dict) and not value):
+            continue
+
+        if isinstance(value, dict):
+            kind = _VALUE if "raw" in value else _DICT
+        elif isinstance(value, list):
+            kind = _LIST
+        elif isinstance(value, (float, str, int)):
+            kind = _SCALAR
+        else:
+            kind = _MIXED
+
+        field = node.get(key)
+        if field is None:
+            field = node[key] = {"kind": kind, "fields": {}}
+        elif field["kind"] != kind:
+            field["kind"] = _MIXED
+
+        if field["kind"] == _DICT:
+            _learn_node(field["fields"], value)
+        elif field["kind"] == _LIST:
+            for el in value:
+                if isinstance(el, dict):
+                    _learn_node(field["fields"], el)
+
+
+def _schema_tables(node: dict, prefix: Tuple[str, ...]) -> Iterator[str]:
+    """
+    Private method to list the table names a schema node produces.
+
+    Args:
+        - node (dict): schema node
+        - prefix (Tuple[str, ...]): path of the node
+
+    Returns:
+        Iterator[str]: table names as used in indexDict
+    """
+    if any(field["kind"] in (_SCALAR, _VALUE) for field in node.values()):
+        yield "_".join(prefix)
+
+    for key, field in node.items():
+        if field["kind"] in (_DICT, _LIST):
+            yield from _schema_tables(field["fields"], prefix + (key,))
+
+
+def _parse_field_generic(key: str, value, prefix: tuple, scalars: dict) -> Iterator[dict]:
+    """
+    Private method to parse a single field with the generic recursive parsers.
+
+    Args:
+        - key (str): field name
+        - value: raw field value
+        - prefix (tuple): multi-index prefix of the parent node
+        - scalars (dict): scalar values of the parent node, updated in place
+
+    Returns:
+        Iterator[dict]: multi-index records of nested tables
+    """
+    cleaned = parse_raw_fmt({key: value})[key]
+    if isinstance(cleaned, (float, str, int)):
+        scalars[key] = cleaned
+    else:
+        yield from parse_to_multiindex(cleaned, prefix + (key,))
+
+
+class QuoteSummarySchemaRegistry:
+    """
+    Registry of compiled parsers for the yahoo quoteSummary modules.
+
+    Modules known from indexDict get a schema learned from the first
+    observed payload. Unknown modules and fields are parsed generically
+    and counted, making schema drift visible through the stats.
+    """
+
+    def __init__(self, known_modules: Set[str] = None):
+        if known_modules is None:
+            known_modules = {k.split("_")[0] for k in indexDict} & set(all_keys)
+
+        self._known_modules = set(known_modules)
+        self._schemas: Dict[str, dict] = {}
+        self._parsers: Dict[str, Callable] = {}
+        self._stale: Set[str] = set()
+
+        # COUNTERS
+        self.generic_count: Counter = Counter()
+        self.drift_count: Counter = Counter()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Compiled modules, generic parse counts per unknown module,
+        drift counts per known module and learned tables missing from indexDict.
+        """
+        unindexed = sorted(
+            table
+            for module, node in self._schemas.items()
+            for table in _schema_tables(node, (module,))
+            if table not in indexDict
+        )
+        return {
+            "compiled": sorted(self._parsers),
+            "generic": dict(self.generic_count),
+            "drift": dict(self.drift_count),
+            "unindexed": unindexed,
+        }
+
+    def learn(self, module: str, payload: dict) -> None:
+        """
+        Public method to merge an observed payload into the schema
+        of a module and recompile its parser.
+
+        Args:
+            - module (str): quoteSummary module name
+            - payload (dict): raw module payload
+        """
+        node = self._schemas.setdefault(module, {})
+        _learn_node(node, payload)
+        self._parsers[module] = self._compile_node(module, node)
+
+        for table in _schema_tables(node, (module,)):
+            if table not in indexDict:
+                logger.debug(f"Schema {module} - table {table} not in indexDict")
+
+    def _compile_node(self, module: str, node: dict) -> Callable[[dict, tuple], Iterator[dict]]:
+        """
+        Private method to compile a schema node into a parser.
+
+        Args:
+            - module (str): module the node belongs to, used for drift counting
+            - node (dict): schema node
+
+        Returns:
+            Callable[[dict, tuple], Iterator[dict]]: parser yielding multi-index records
+        """
+        kinds = {k: field["kind"] for k, field in node.items()}
+        converters = {k: _compile_raw_fmt_converter(k) for k, v in kinds.items() if v == _VALUE}
+        children = {
+            k: self._compile_node(module, field["fields"])
+            for k, field in node.items()
+            if field["kind"] in (_DICT, _LIST)
+        }
+
+        def parse_node(payload: dict, prefix: tuple) -> Iterator[dict]:
+            scalars: dict = {}
+            for key, value in payload.items():
+                if value is None:
+                    continue
+
+                cls = value.__class__
+                if cls is dict and not value:
+                    continue
+
+                kind = kinds.get(key)
+                if kind == _VALUE and cls is dict and "raw" in value:
+                    converted = converters[key](value)
+                    if converted is not None:
+                        scalars[key] = converted
+                elif kind == _SCALAR and cls in _SCALAR_TYPES:
+                    scalars[key] = value
+                elif kind == _DICT and cls is dict and "raw" not in value:
+                    yield from children[key](value, prefix + (key,))
+                elif kind == _LIST and cls is list:
+                    child = children[key]
+                    p2 = prefix + (key,)
+                    for el in value:
+                        if el.__class__ is dict:
+                            yield from child(el, p2)
+                else:
+                    # UNKNOWN FIELD OR CHANGED TYPE - SCHEMA DRIFT
+                    if kind != _MIXED:
+                        self.drift_count[module] += 1
+                        self._stale.add(module)
+                    yield from _parse_field_generic(key, value, prefix, scalars)
+
+            if scalars:
+                yield {prefix: scalars}
+
+        return parse_node
+
+    def parse(self, resp: dict) -> List[dict]:
+        """
+        Public method to transform a raw quoteSummary result into
+        multi-index records. The output is identical to
+        list(parse_to_multiindex(parse_raw_fmt(resp))).
+
+        Args:
+            - resp (dict): raw quoteSummary result, keys are module names
+
+        Returns:
+            List[dict]: multi-index records
+        """
+        if not isinstance(resp, dict):
+            raise TypeError("quoteSummary result must be a dict")
+
+        out: List[dict] = []
+        scalars: dict = {}
+        for module, payload in resp.items():
+            if module in self._known_modules and isinstance(payload, dict):
+                if not payload:
+                    continue
+                if module not in self._parsers:
+                    self.learn(module, payload)
+                out.extend(self._parsers[module](payload, (module,)))
+            else:
+                self.generic_count[module] += 1
+                logger.debug(f"No schema for module {module} - using generic parser")
+                out.extend(_parse_field_generic(module, payload, (), scalars))
+
+        if scalars:
+            out.append({(): scalars})
+
+        # LEARN THE NEW FIELDS OF MODULES THAT DRIFTED
+        for module in self._stale:
+            self.learn(module, resp[module])
+        self._stale.clear()
+
+        return out
+
+
+# DEFAULT REGISTRY SHARED BY THE DOWNLOAD COROUTINES
+quote_summary_schemas = QuoteSummarySchemaRegistry()
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.SpoolUtils
+=================================================================
+
+A module containing a durable local spool of parsed records and a
+background flusher draining it into a DataBroker.
+
+The store path appends each save to the spool instead of writing to
+the database, so downloads go on while the database is slow or down.
+The spool is a folder of segment files <root>/<seq>.spool, each a
+sequence of frames:
+
+    <length: uint32> <crc32: uint32> <zlib compressed pickled batch>
+
+A batch holds the save arguments (db, collection, index, options) and
+the records. Appends go to the active segment, the flusher seals it
+and drains the sealed segments in order. A segment is deleted once all
+its batches are saved, the offset of the saved batches is kept in
+<root>/<seq>.offset so a restart resumes after them. A torn frame at
+the end of a segment (a crash during an append) ends the segment. A
+corrupt frame followed by further frames is not skipped, the segment
+is renamed to <root>/<seq>.corrupt and kept for inspection.
+
+"""
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from termcolor import colored
+
+from .DataBroker import DataBroker
+from .LoggingUtils import logger
+
+# FRAME HEADER: PAYLOAD LENGTH AND CRC32 OF THE PAYLOAD
+_HEADER = struct.Struct(">II")
+
+_SUFFIX = ".spool"
+_CORRUPT_SUFFIX = ".corrupt"
+
+
+class CorruptSegmentError(Exception):
+    """Raised on a corrupt frame that is not at the end of a segment."""
+
+    def __init__(self, path: str, offset: int):
+        self.path = path
+        self.offset = offset
+        super().__init__(f"Corrupt frame at offset {offset} of {path}")
+
+
+class Spool:
+    """
+    Durable append-only spool of save batches, stored as compressed,
+    length-prefixed frames in segment files.
+    """
+
+    def __init__(self, root: str, segment_bytes: int = 64 * 2**20, fsync: bool = False):
+        """
+        Args:
+            - root (str): spool folder
+            - segment_bytes (int): size after which the active segment is sealed
+            - fsync (bool): fsync every append, survives power loss, not only crashes
+        """
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+
+        # SEGMENTS OF EARLIER RUNS ARE SEALED, NEW APPENDS START A NEW SEGMENT, ALSO
+        # AFTER THE QUARANTINED ONES AS THEY KEEP THEIR OFFSET FILES
+        seqs = [
+            int(os.path.splitext(fn)[0])
+            for fn in os.listdir(root)
+            if fn.endswith(_SUFFIX) or fn.endswith(_CORRUPT_SUFFIX)
+        ]
+        self._seq = max(seqs, default=0)
+        self._fh = None
+        self._lock = threading.Lock()
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.root, f"{seq:012d}{_SUFFIX}")
+
+    def save(
+        self,
+        data: Union[List[Dict], Dict],
+        db: str,
+        col: str,
+        indexTupleList: List[Tuple[str, Any]],
+        **kwargs,
+    ) -> Dict[str, int]:
+        """
+        Public method to append a save to the spool, same arguments as
+        DataBroker.save.
+
+        Args:
+            - data (Union[List[Dict], Dict]): records to save
+            - db (str): database name
+            - col (str): collection name
+            - indexTupleList (List[Tuple[str, Any]]): index of the collection
+            - kwargs: further save options, e.g. unique
+
+        Returns:
+            Dict[str, int]: number of spooled records
+        """
+        datal = data if isinstance(data, list) else [data]
+        batch = {"db": db, "col": col, "index": list(indexTupleList), "kwargs": kwargs}
+        payload = zlib.compress(pickle.dumps((batch, datal), protocol=4))
+        frame = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._lock:
+            if self._fh is None:
+                self._seq += 1
+                self._fh = open(self._path(self._seq), "ab")
+
+            self._fh.write(frame)
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+
+            if self._fh.tell() >= self.segment_bytes:
+                self._seal()
+
+        return {"spooled": len(datal)}
+
+    def _seal(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def seal(self):
+        """
+        Public method to seal the active segment, later appends start a new one.
+        """
+        with self._lock:
+            self._seal()
+
+    def segments(self) -> List[str]:
+        """
+        Public method to list the sealed segments.
+
+        Returns:
+            List[str]: paths of the sealed segments, oldest first
+        """
+        with self._lock:
+            active = self._path(self._seq) if self._fh is not None else None
+            names = sorted(fn for fn in os.listdir(self.root) if fn.endswith(_SUFFIX))
+
+        paths = [os.path.join(self.root, fn) for fn in names]
+        return [p for p in paths if p != active]
+
+    def pending_bytes(self) -> int:
+        """
+        Public method to get the size of the segments not drained yet.
+
+        Returns:
+            int: number of bytes
+        """
+        paths = [os.path.join(self.root, fn) for fn in os.listdir(self.root)]
+        return sum(os.path.getsize(p) - self.get_offset(p) for p in paths if p.endswith(_SUFFIX))
+
+    @staticmethod
+    def iter_batches(path: str, offset: int = 0) -> Iterator[Tuple[int, dict, List[Dict]]]:
+        """
+        Public method to read the batches of a segment. A short read at the
+        end of the segment is a torn frame and ends it.
+
+        Args:
+            - path (str): segment path
+            - offset (int): offset of the first frame to read
+
+        Returns:
+            Iterator[Tuple[int, dict, List[Dict]]]: (offset after the frame,
+                save arguments, records) per batch
+
+        Raises:
+            CorruptSegmentError: a frame fails its CRC and more bytes follow it
+        """
+        with open(path, "rb") as fh:
+            fh.seek(offset)
+            while True:
+                start = fh.tell()
+                header = fh.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    if header:
+                        logger.warning(colored(f"Torn frame at the end of {path}", "yellow"))
+                    break
+
+                length, crc = _HEADER.unpack(header)
+                payload = fh.read(length)
+                if len(payload) < length:
+                    logger.warning(colored(f"Torn frame at the end of {path}", "yellow"))
+                    break
+
+                if zlib.crc32(payload) != crc:
+                    if fh.read(1):
+                        raise CorruptSegmentError(path, start)
+                    logger.warning(colored(f"Torn frame at the end of {path}", "yellow"))
+                    break
+
+                batch, records = pickle.loads(zlib.decompress(payload))
+                yield fh.tell(), batch, records
+
+    @staticmethod
+    def get_offset(path: str) -> int:
+        """
+        Public method to get the offset of the saved batches of a segment.
+
+        Args:
+            - path (str): segment path
+
+        Returns:
+            int: offset, 0 if nothing was saved yet
+        """
+        offsetpath = f"{path[: -len(_SUFFIX)]}.offset"
+        if not os.path.exists(offsetpath):
+            return 0
+        with open(offsetpath) as fh:
+            return int(fh.read() or 0)
+
+    @staticmethod
+    def set_offset(path: str, offset: int):
+        """
+        Public method to record the offset of the saved batches of a segment.
+
+        Args:
+            - path (str): segment path
+            - offset (int): offset after the last saved batch
+        """
+        offsetpath = f"{path[: -len(_SUFFIX)]}.offset"
+        tmppath = f"{offsetpath}.{os.getpid()}.tmp"
+        with open(tmppath, "w") as fh:
+            fh.write(str(offset))
+        os.replace(tmppath, offsetpath)
+
+    @staticmethod
+    def quarantine(path: str) -> str:
+        """
+        Public method to set a corrupt segment aside, its offset file is kept.
+
+        Args:
+            - path (str): segment path
+
+        Returns:
+            str: new path of the segment
+        """
+        corruptpath = f"{path[: -len(_SUFFIX)]}{_CORRUPT_SUFFIX}"
+        os.replace(path, corruptpath)
+        return corruptpath
+
+    @staticmethod
+    def remove(path: str):
+        """
+        Public method to delete a drained segment and its offset file.
+
+        Args:
+            - path (str): segment path
+        """
+        os.remove(path)
+        offsetpath = f"{path[: -len(_SUFFIX)]}.offset"
+        if os.path.exists(offsetpath):
+            os.remove(offsetpath)
+
+    def close(self):
+        self.seal()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SpoolFlusher:
+    """
+    Background thread draining a Spool into a DataBroker. Consecutive
+    batches for the same collection are merged into one save of at most
+    max_records records. A failed save is retried with exponential
+    backoff, the segment stays on disk until it is saved.
+    """
+
+    def __init__(
+        self,
+        spool: Spool,
+        databroker: DataBroker,
+        interval: float = 1.0,
+        max_records: int = 10000,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        """
+        Args:
+            - spool (Spool): spool to drain
+            - databroker (DataBroker): broker to save the records with
+            - interval (float): seconds between drains
+            - max_records (int): maximum number of records per save
+            - retries (int): retries of a failed save before the drain gives up
+                until the next interval
+            - backoff (float): first retry delay in seconds, doubled per retry
+            - max_backoff (float): maximum retry delay in seconds
+        """
+        self.spool = spool
+        self.databroker = databroker
+        self.interval = interval
+        self.max_records = max_records
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.counts = {
+            "batches": 0,
+            "records": 0,
+            "saves": 0,
+            "retries": 0,
+            "failed": 0,
+            "corrupt": 0,
+        }
+        self._drain_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SpoolFlusher":
+        """
+        Public method to start the background thread.
+
+        Returns:
+            SpoolFlusher: self
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, drain: bool = True):
+        """
+        Public method to stop the background thread.
+
+        Args:
+            - drain (bool): drain the spool once more after stopping
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if drain:
+            self.drain()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.drain()
+            except Exception:
+                logger.exception(colored("Spool drain failed", "red"))
+
+    def _save(self, batch: dict, records: List[Dict], nbatches: int):
+        """
+        Private method to save merged records, retrying with exponential backoff.
+
+        Args:
+            - batch (dict): save arguments
+            - records (List[Dict]): merged records
+            - nbatches (int): number of merged batches
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                save = getattr(self.databroker, "save_cataloged", self.databroker.save)
+                save(records, batch["db"], batch["col"], batch["index"], **batch["kwargs"])
+                self.counts["saves"] += 1
+                self.counts["batches"] += nbatches
+                self.counts["records"] += len(records)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    # ONLY SAVES GIVEN UP ON COUNT AS FAILED
+                    self.counts["failed"] += 1
+                    raise
+                logger.warning(
+                    colored(
+                        f"Save to {batch['db']}.{batch['col']} failed, retry in {delay}s", "yellow"
+                    )
+                )
+                self.counts["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def drain(self) -> int:
+        """
+        Public method to seal the active segment and save all spooled batches.
+        The batches before a corrupt frame are saved, the segment is quarantined.
+
+        Returns:
+            int: number of saved records
+        """
+        with self._drain_lock:
+            before = self.counts["records"]
+            self.spool.seal()
+
+            for path in self.spool.segments():
+                offset = self.spool.get_offset(path)
+                key, current, merged, nbatches, end = None, {}, [], 0, offset
+                corrupt = False
+
+                try:
+                    for end_batch, batch, records in self.spool.iter_batches(path, offset):
+                        bkey = (
+                            batch["db"],
+                            batch["col"],
+                            repr(batch["index"]),
+                            repr(batch["kwargs"]),
+                        )
+                        if merged and (
+                            bkey != key or len(merged) + len(records) > self.max_records
+                        ):
+                            self._save(current, merged, nbatches)
+                            self.spool.set_offset(path, end)
+                            merged, nbatches = [], 0
+
+                        key, current = bkey, batch
+                        merged.extend(records)
+                        nbatches += 1
+                        end = end_batch
+                except CorruptSegmentError as e:
+                    corrupt = True
+                    logger.error(colored(f"{e}, the segment is quarantined", "red"))
+
+                if merged:
+                    self._save(current, merged, nbatches)
+
+                if corrupt:
+                    # THE OFFSET POINTS AT THE CORRUPT FRAME
+                    self.spool.set_offset(path, end)
+                    self.spool.quarantine(path)
+                    self.counts["corrupt"] += 1
+                else:
+                    self.spool.remove(path)
+
+            return self.counts["records"] - before
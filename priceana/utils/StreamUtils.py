@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Module priceana.utils.StreamUtils
+=================================================================
+
+A module containing methods for incrementally parsing large
+yahoo chart responses.
+
+The timestamp and OHLCV arrays are read chunk by chunk straight
+into NumPy buffers, so the full Python object tree of the response
+is never built. All other values (meta, events, ...) are small and
+are decoded with the json module.
+
+"""
+import json
+from typing import AsyncIterator, Tuple
+
+import numpy as np
+
+# BYTE VALUES OF THE JSON STRUCTURAL CHARACTERS
+_LBRACE, _RBRACE = ord("{"), ord("}")
+_LBRACKET, _RBRACKET = ord("["), ord("]")
+_COLON, _COMMA = ord(":"), ord(",")
+_QUOTE, _BACKSLASH = ord('"'), ord("\\")
+_WHITESPACE = {ord(" "), ord("\t"), ord("\n"), ord("\r")}
+
+# PATHS INTO THE CHART RESPONSE - ARRAY ELEMENTS ARE DENOTED BY "*"
+_RESULT = ("chart", "result", "*")
+_OBJECTS = {
+    (),
+    ("chart",),
+    _RESULT,
+    _RESULT + ("indicators",),
+    _RESULT + ("indicators", "quote", "*"),
+    _RESULT + ("indicators", "adjclose", "*"),
+}
+_ARRAYS = {
+    ("chart", "result"),
+    _RESULT + ("indicators", "quote"),
+    _RESULT + ("indicators", "adjclose"),
+}
+_NUMERIC_ARRAYS = {
+    _RESULT + ("timestamp",),
+    _RESULT + ("indicators", "adjclose", "*", "adjclose"),
+    *(
+        _RESULT + ("indicators", "quote", "*", k)
+        for k in ["open", "high", "low", "close", "volume"]
+    ),
+}
+
+
+class _ArrayBuffer:
+    """
+    Growable float64 buffer filled from comma separated JSON numbers.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._data = np.empty(max(capacity, 1), dtype=np.float64)
+        self._size = 0
+
+    def extend(self, raw: bytes) -> None:
+        """
+        Append the comma separated numbers in raw, null becomes NaN.
+
+        Args:
+            - raw (bytes): complete JSON array elements without brackets
+        """
+        # NONE (null) BECOMES NAN, MALFORMED ELEMENTS RAISE A ValueError
+        values = np.array(json.loads(b"[" + bytes(raw) + b"]"), dtype=np.float64)
+        n = len(values)
+        if self._size + n > len(self._data):
+            data = np.empty(max(2 * len(self._data), self._size + n), dtype=np.float64)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+
+        self._data[self._size : self._size + n] = values
+        self._size += n
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._size]
+
+
+class _AsyncByteReader:
+    """
+    Buffered reader over an async iterator of byte chunks. Consumed
+    bytes are dropped whenever a new chunk is read.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks.__aiter__()
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    async def _fill(self) -> bool:
+        if self._eof:
+            return False
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+
+        if self._pos:
+            del self._buf[: self._pos]
+            self._pos = 0
+        self._buf.extend(chunk)
+        return True
+
+    async def peek(self) -> int:
+        """Return the next non-whitespace byte without consuming it."""
+        while True:
+            while self._pos < len(self._buf):
+                c = self._buf[self._pos]
+                if c in _WHITESPACE:
+                    self._pos += 1
+                else:
+                    return c
+            if not await self._fill():
+                raise ValueError("Unexpected end of chart stream")
+
+    async def next(self) -> int:
+        """Consume and return the next non-whitespace byte."""
+        c = await self.peek()
+        self._pos += 1
+        return c
+
+    async def expect(self, expected: int) -> None:
+        c = await self.next()
+        if c != expected:
+            raise ValueError(f"Expected {chr(expected)!r} in chart stream, got {chr(c)!r}")
+
+    async def read_raw(self) -> bytes:
+        """Consume a complete JSON value and return its raw bytes."""
+        await self.peek()
+        i = self._pos
+        depth = 0
+        in_str = False
+        escape = False
+        while True:
+            if i >= len(self._buf):
+                offset = i - self._pos
+                if not await self._fill():
+                    # END OF STREAM TERMINATES A BARE SCALAR
+                    break
+                i = self._pos + offset
+                continue
+
+            c = self._buf[i]
+            if in_str:
+                if escape:
+                    escape = False
+                elif c == _BACKSLASH:
+                    escape = True
+                elif c == _QUOTE:
+                    in_str = False
+                    if depth == 0:
+                        i += 1
+                        break
+            elif c == _QUOTE:
+                in_str = True
+            elif c in (_LBRACE, _LBRACKET):
+                depth += 1
+            elif c in (_RBRACE, _RBRACKET):
+                if depth == 0:
+                    break
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            elif depth == 0 and (c == _COMMA or c in _WHITESPACE):
+                break
+            i += 1
+
+        raw = bytes(self._buf[self._pos : i])
+        self._pos = i
+        return raw
+
+    async def read_numeric_array(self, out: _ArrayBuffer) -> None:
+        """Consume a flat JSON array of numbers into out."""
+        await self.expect(_LBRACKET)
+        while True:
+            end = self._buf.find(b"]", self._pos)
+            if end >= 0:
+                out.extend(self._buf[self._pos : end])
+                self._pos = end + 1
+                return
+
+            # CONVERT ALL COMPLETE ELEMENTS, KEEP THE TRAILING PARTIAL ONE
+            cut = self._buf.rfind(b",", self._pos)
+            if cut >= 0:
+                out.extend(self._buf[self._pos : cut])
+                self._pos = cut + 1
+
+            if not await self._fill():
+                raise ValueError("Unexpected end of chart stream")
+
+
+class ChartStreamParser:
+    """
+    Incremental parser for yahoo chart responses.
+
+    The result has the same layout as the decoded JSON, but the
+    timestamp and OHLCV arrays are NumPy arrays (int64 timestamps,
+    float64 values with NaN for null).
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], capacity: int = 1024):
+        self._reader = _AsyncByteReader(chunks)
+
+        # INITIAL BUFFER SIZE - SET TO THE NUMBER OF TIMESTAMPS ONCE KNOWN
+        self._capacity = capacity
+
+    async def parse(self) -> dict:
+        return await self._parse_value(())
+
+    async def _parse_value(self, path: Tuple[str, ...]):
+        c = await self._reader.peek()
+        if c == _LBRACE and path in _OBJECTS:
+            return await self._parse_object(path)
+        if c == _LBRACKET and path in _ARRAYS:
+            return await self._parse_array(path)
+        if c == _LBRACKET and path in _NUMERIC_ARRAYS:
+            buffer = _ArrayBuffer(self._capacity)
+            await self._reader.read_numeric_array(buffer)
+            if path[-1] == "timestamp":
+                # PREALLOCATE THE OHLCV BUFFERS TO THE EXACT LENGTH
+                self._capacity = len(buffer.values)
+                return buffer.values.astype(np.int64)
+            return buffer.values
+
+        return json.loads(await self._reader.read_raw())
+
+    async def _parse_object(self, path: Tuple[str, ...]) -> dict:
+        out: dict = {}
+        await self._reader.expect(_LBRACE)
+        if await self._reader.peek() == _RBRACE:
+            await self._reader.next()
+            return out
+
+        while True:
+            key = json.loads(await self._reader.read_raw())
+            await self._reader.expect(_COLON)
+            out[key] = await self._parse_value(path + (key,))
+
+            c = await self._reader.next()
+            if c == _RBRACE:
+                return out
+            if c != _COMMA:
+                raise ValueError(f"Unexpected {chr(c)!r} in chart stream object")
+
+    async def _parse_array(self, path: Tuple[str, ...]) -> list:
+        out: list = []
+        await self._reader.expect(_LBRACKET)
+        if await self._reader.peek() == _RBRACKET:
+            await self._reader.next()
+            return out
+
+        while True:
+            out.append(await self._parse_value(path + ("*",)))
+
+            c = await self._reader.next()
+            if c == _RBRACKET:
+                return out
+            if c != _COMMA:
+                raise ValueError(f"Unexpected {chr(c)!r} in chart stream array")
+
+
+async def parse_chart_stream(chunks: AsyncIterator[bytes], capacity: int = 1024) -> dict:
+    """
+    Method to incrementally parse a yahoo chart response.
+
+    Args:
+        - chunks (AsyncIterator[bytes]): response body chunks
+        - capacity (int): initial size of the timestamp buffer
+
+    Returns:
+        dict: decoded response with NumPy arrays for timestamp and OHLCV
+    """
+    return await ChartStreamParser(chunks, capacity).parse()
@@ -9,8 +9,10 @@ A module containing methods for download url generation.
 """
 
 import itertools
+import re
+import time
 from datetime import datetime as dt
-from typing import List, Optional, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 from ..constants import base_url, query_url, valid_intervals, valid_periods
 from .DateTimeUtils import clean_start_end_period
@@ -153,3 +155,100 @@ def generate_combinations(urls: List[str], params: List[dict]) -> List[tuple]:
     """
     # assert len(urls) == len(params)
     return list(itertools.product(urls, params))
+
+
+# PRIORITIES OF THE REQUEST PLANNER
+PLAN_PRIORITIES = ["watchlist", "stalest", "largest"]
+
+# SECONDS PER UNIT OF THE PERIOD AND INTERVAL CODES
+_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400, "wk": 604800, "mo": 2629746, "y": 31556952}
+
+
+def _code_seconds(code: str) -> float:
+    """
+    Private method to get the length in seconds of a period or interval code (1m, 1wk, 1y, ...).
+    """
+    if code == "max":
+        return time.time()
+    if code == "ytd":
+        return time.time() - time.mktime(dt(dt.today().year, 1, 1).timetuple())
+    n, unit = re.fullmatch(r"(\d+)([a-z]+)", code).groups()
+    return int(n) * _UNIT_SECONDS[unit]
+
+
+def estimate_rows(params: dict) -> float:
+    """
+    Method to estimate the number of bars a price request returns, the
+    payload size, from its time span and interval.
+
+    Args:
+        - params (dict): price parameter dictionary
+
+    Returns:
+        float: estimated number of bars
+    """
+    if "period1" in params:
+        span = float(params["period2"]) - float(params["period1"])
+    else:
+        span = _code_seconds(params.get("range", "max"))
+    return span / _code_seconds(params.get("interval", "1d"))
+
+
+def plan_combinations(
+    symbols: Iterable[str],
+    params: List[dict],
+    priority: Sequence[str] = ("watchlist",),
+    watchlist: Iterable[str] = (),
+    last_dates: Optional[Dict[str, str]] = None,
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Method to lazily yield the (url, params) price work units in priority
+    order, the same units as generate_combinations.
+
+    Args:
+        - symbols (Iterable[str]): yahoo symbols
+        - params (List[dict]): parameter dictionaries
+        - priority (Sequence[str]): criteria of PLAN_PRIORITIES, the first
+            decides first:
+                - "watchlist": symbols of the watchlist first
+                - "stalest": symbols with the oldest last stored date first,
+                    symbols without stored data before all others
+                - "largest": requests with the largest estimated payload first,
+                    symbols are taken per parameter dictionary when it comes
+                    before the symbol criteria
+        - watchlist (Iterable[str]): symbols for the "watchlist" priority
+        - last_dates (Optional[Dict[str, str]]): last stored date per symbol
+            for the "stalest" priority, e.g. from DataBrokerMongoDb.get_catalog
+
+    Returns:
+        Iterator[Tuple[str, dict]]: (url, params) tuples
+    """
+    for p in priority:
+        if p not in PLAN_PRIORITIES:
+            raise ValueError(f"Invalid priority {p}")
+
+    watch = set(watchlist)
+    last = last_dates or {}
+
+    def _symbol_key(symbol: str) -> tuple:
+        key: list = []
+        for p in priority:
+            if p == "watchlist":
+                key.append(symbol not in watch)
+            elif p == "stalest":
+                key.append((symbol in last, str(last.get(symbol, ""))))
+        return tuple(key)
+
+    # ONLY THE SYMBOLS ARE SORTED, THE COMBINATIONS ARE NEVER MATERIALIZED
+    ordered = sorted(symbols, key=_symbol_key) if set(priority) - {"largest"} else list(symbols)
+    if "largest" in priority:
+        params = sorted(params, key=estimate_rows, reverse=True)
+
+    if priority and priority[0] == "largest":
+        for prm in params:
+            for symbol in ordered:
+                yield f"{base_url}chart/{symbol}", prm
+    else:
+        for symbol in ordered:
+            for prm in params:
+                yield f"{base_url}chart/{symbol}", prm
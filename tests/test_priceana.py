@@ -4,8 +4,11 @@
 
 import mongomock
 import pytest
+from asynctest import CoroutineMock, patch
 from priceana import InvalidIntervalError, InvalidPeriodError, YahooPrices
 from priceana.utils.DataBroker import DataBrokerMongoDb
+from priceana.utils.DataBrokerParquet import DataBrokerParquet
+from pymongo.errors import AutoReconnect
 from pytest import raises
 
 
@@ -122,6 +125,12 @@ async def test___input_validation_pass(ikwargs, databroker):
     YahooPrices(databroker=databroker, **ikwargs)
 
 
+@pytest.mark.asyncio
+async def test___input_validation_databroker_protocol_pass(tmp_path):
+    pytest.importorskip("pyarrow")
+    YahooPrices(["XYZ"], DataBrokerParquet(str(tmp_path)))
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("ikwargs, res", test_input_validation_obj_pass)
 async def test___input_validation_obj_pass(ikwargs, res, databroker):
@@ -129,6 +138,128 @@ async def test___input_validation_obj_pass(ikwargs, res, databroker):
     assert pa._tickers == res
 
 
+def chart(symbol: str) -> dict:
+    result = {
+        "meta": {
+            "symbol": symbol,
+            "dataGranularity": "1d",
+            "priceHint": 2,
+            "currency": "USD",
+            "exchangeName": "F",
+            "exchangeTimezoneName": "America/New_York",
+        },
+        "timestamp": [1583038800],
+        "indicators": {
+            "quote": [{"volume": [10], "close": [1.0], "open": [1.0], "high": [1.0], "low": [1.0]}],
+            "adjclose": [{"adjclose": [1.0]}],
+        },
+    }
+    return {"chart": {"result": [result]}}
+
+
+@patch("aiohttp.ClientSession.get")
+def test___download_checkpoint_resume___pass(mock_get, databroker, tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[chart("ABC"), {}, chart("XYZ")]
+    )
+
+    # THE FAILED COMBINATION IS NOT CHECKPOINTED
+    kwargs = {"interval": "1d", "dbname": "FinDataTest", "save": True}
+    YahooPrices(["ABC", "XYZ"], databroker, checkpoint=path, **kwargs).download()
+    assert databroker.load("FinDataTest", "1d", {}, {"symbol": 1}) == [{"symbol": "ABC"}]
+
+    # THE RESUMED RUN ONLY REQUESTS THE REST, THE CHECKPOINT IS CLOSED AFTERWARDS
+    pa = YahooPrices(["ABC", "XYZ"], databroker, checkpoint=path, resume=True, **kwargs)
+    assert len(pa._checkpoint) == 1
+    pa.download()
+    assert mock_get.call_count == 3
+    assert len(pa.data) == 1 and len(pa._checkpoint) == 2
+    assert pa._checkpoint.closed
+
+    # WITHOUT RESUME (THE DEFAULT) THE CHECKPOINT STARTS EMPTY
+    assert len(YahooPrices(["ABC"], databroker, checkpoint=path, save=True)._checkpoint) == 0
+
+    # CHECKPOINTS TRACK SAVES, DOWNLOADS ONLY SAVE WHEN ASKED TO
+    with raises(ValueError):
+        YahooPrices(["ABC"], databroker, checkpoint=path)
+
+
+@pytest.mark.parametrize("error", [ValueError, AutoReconnect])
+@patch("aiohttp.ClientSession.get")
+def test___download_checkpoint_failed_save___pass(mock_get, databroker, tmp_path, error):
+    path = str(tmp_path / "checkpoint.jsonl")
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[chart("ABC"), chart("ABC")]
+    )
+
+    def failing_save(*args, **kwargs):
+        raise error("save failed")
+
+    # A FAILED SAVE, ALSO A DATABASE ERROR, IS NOT CHECKPOINTED, A FURTHER DOWNLOAD
+    # OF THE RUN RETRIES IT
+    save = databroker.save
+    databroker.save = failing_save
+    pa = YahooPrices(
+        ["ABC"], databroker, interval="1d", dbname="FinDataTest", checkpoint=path, save=True
+    )
+    pa.download()
+    assert len(pa._checkpoint) == 0
+
+    databroker.save = save
+    pa.download()
+    assert len(pa._checkpoint) == 1 and mock_get.call_count == 2
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 1
+
+
+@patch("aiohttp.ClientSession.get")
+def test___download_spool___pass(mock_get, databroker, tmp_path):
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[chart("ABC"), chart("XYZ")]
+    )
+
+    # CHECKPOINTED SAVES GO THROUGH THE SPOOL, DRAINED BY THE END OF THE DOWNLOAD
+    pa = YahooPrices(
+        ["ABC", "XYZ"],
+        databroker,
+        interval="1d",
+        dbname="FinDataTest",
+        checkpoint=str(tmp_path / "checkpoint.jsonl"),
+        spool=str(tmp_path / "spool"),
+        save=True,
+    )
+    pa.download()
+    assert len(pa._checkpoint) == 2
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+    assert pa._spool.segments() == []
+
+    with raises(ValueError):
+        YahooPrices(["ABC"], databroker, spool=str(tmp_path / "spool"))
+
+
+@patch("aiohttp.ClientSession.get")
+def test___download_save___pass(mock_get, databroker, tmp_path):
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[chart("ABC"), chart("ABC"), chart("XYZ")]
+    )
+
+    # A PLAIN DOWNLOAD DOES NOT SAVE
+    kwargs = {"interval": "1d", "dbname": "FinDataTest"}
+    YahooPrices(["ABC"], databroker, **kwargs).download()
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 0
+
+    # SAVES WITHOUT A CHECKPOINT, ALSO THROUGH A SPOOL
+    YahooPrices(["ABC"], databroker, save=True, **kwargs).download()
+    pa = YahooPrices(["XYZ"], databroker, save=True, spool=str(tmp_path / "spool"), **kwargs)
+    pa.download()
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+    assert pa._spool.segments() == []
+
+
 # ==============================================================================
 # The code below is for debugging a particular test in eclipse/pydev.
 # (otherwise all tests are normally run with pytest)
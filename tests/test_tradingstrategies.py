@@ -3,9 +3,29 @@
 
 """Tests for `priceana` package."""
 
+import mongomock
+import numpy as np
+import pandas as pd
 import pytest
+from scipy.optimize import curve_fit
 
 import priceana.tradingstrategies
+from priceana.tradingstrategies.Screener import SCREEN_STAGES, screen_mean_reverting
+from priceana.tradingstrategies.StatisticalTrading import (
+    MR_LEVELS,
+    _mr_positions_loop,
+    hurst,
+    hurst_batch,
+    linear_fit_batch,
+    mr_indicator,
+    mr_indicator_batch,
+    mr_positions,
+    rolling_hurst,
+    strategy_mean_reverting,
+    strategy_mean_reverting_batch,
+)
+from priceana.utils.DataBroker import DataBrokerMongoDb
+
 
 def test_greet():
     expected = "Hello John!"
@@ -13,6 +33,163 @@ def test_greet():
     assert greeting==expected
 
 
+@pytest.fixture
+def walks():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((4, 200)).cumsum(axis=1) + 100.0
+
+
+def test___hurst_batch___pass(walks):
+    expected = np.array([hurst(w) for w in walks])
+    assert np.allclose(hurst_batch(walks), expected)
+    assert np.allclose(hurst_batch(walks[0]), expected[:1])
+
+    # RAGGED BATCH AND CUSTOM LAGS
+    ragged = [walks[0], walks[1][:120]]
+    assert np.allclose(hurst_batch(ragged), [expected[0], hurst(walks[1][:120])])
+    lags = [2, 4, 8, 16]
+    assert np.isclose(hurst_batch(walks[:1], lags)[0], hurst(walks[0], lags))
+
+    # NAN HANDLING
+    walks[2, 50] = np.nan
+    assert np.isnan(hurst_batch(walks)[2])
+    assert np.isfinite(hurst_batch(walks, nan_policy="omit")[2])
+    assert np.allclose(hurst_batch(walks, nan_policy="omit")[[0, 1, 3]], expected[[0, 1, 3]])
+    assert np.isnan(hurst_batch([np.ones(50), walks[0][:10]])).all()
+
+
+def test___hurst_batch___fail(walks):
+    walks[0, 0] = np.nan
+    with pytest.raises(ValueError):
+        hurst_batch(walks, nan_policy="raise")
+    with pytest.raises(ValueError):
+        hurst_batch(walks, nan_policy="x")
+
+
+def test___rolling_hurst___pass(walks):
+    window = 60
+    res = rolling_hurst(walks, window)
+    assert res.shape == walks.shape
+    assert np.isnan(res[:, : window - 1]).all()
+
+    expected = [[hurst(w[t - window + 1 : t + 1]) for t in range(window - 1, 200)] for w in walks]
+    assert np.allclose(res[:, window - 1 :], expected)
+
+    # WINDOWS CONTAINING A NAN ARE NAN
+    walks[1, 100] = np.nan
+    res = rolling_hurst(walks[1], window)[0]
+    assert np.isnan(res[100 : 100 + window]).all()
+    assert np.isfinite(res[100 + window :]).all() and np.isfinite(res[window - 1 : 100]).all()
+
+    with pytest.raises(ValueError):
+        rolling_hurst(walks, 10)
+
+
+def test___mr_positions___pass():
+    rng = np.random.default_rng(0)
+    signals = rng.choice([-1, -0.5, 0, 1], p=[0.1, 0.1, 0.7, 0.1], size=(50, 300))
+    expected = np.array([_mr_positions_loop(s) for s in signals])
+    assert np.array_equal(mr_positions(signals), expected)
+
+    # AT A HALF POSITION A -1 SIGNAL IS IGNORED
+    assert mr_positions([1, -0.5, -1, -0.5, 1]).tolist() == [[1, -0.5, 0, -0.5, 1]]
+
+    with pytest.raises(ValueError):
+        mr_positions([0.25])
+
+
+def test___mr_indicator_batch___pass(walks):
+    days = np.arange(walks.shape[1], dtype=float)
+    A = np.array([[0.05, 100.0], [-0.05, 100.0], [0.0, 101.0], [0.02, 99.0]])
+    B = np.zeros((4, 2, 2))
+    B[:, 0, 0], B[:, 1, 1] = 1e-4, 4.0
+
+    expected = [
+        mr_indicator(pd.DataFrame({"close": w, "days_since": days}), a, b)["mr_ind"]
+        for w, a, b in zip(walks, A, B)
+    ]
+    res = mr_indicator_batch(walks, days, A, B)
+    assert np.array_equal(res, np.array(expected))
+    assert np.abs(res).sum() > 0
+
+
+def test___linear_fit_batch___pass(walks):
+    x = np.arange(walks.shape[1], dtype=float)
+    A, B = linear_fit_batch(x, walks)
+    for a, b, y in zip(A, B, walks):
+        popt, pcov = curve_fit(lambda x, A, B: A * x + B, x, y)
+        assert np.allclose(a, popt) and np.allclose(b, pcov, rtol=1e-4)
+
+    # NAN POINTS ARE LEFT OUT
+    walks[1, 10] = np.nan
+    A2, B2 = linear_fit_batch([x, x[:150]], [walks[1], walks[2][:150]])
+    keep = ~np.isnan(walks[1])
+    assert np.allclose(A2[0], linear_fit_batch(x[keep], walks[1][keep])[0][0])
+    assert np.allclose(A2[1], linear_fit_batch(x[:150], walks[2][:150])[0][0])
+    assert np.isnan(linear_fit_batch(np.array([0.0, 1.0]), np.array([1.0, 2.0]))[1]).all()
+
+
+def test___strategy_mean_reverting_batch___pass(walks):
+    dates = pd.date_range("2021-01-01 15:30", periods=walks.shape[1], freq="D")
+    noise = np.random.default_rng(1).standard_normal(walks.shape[1])
+    ohlcvs = {
+        "WALK": pd.DataFrame({"date": dates, "close": walks[0]}).set_index("date"),
+        "LINE": pd.DataFrame({"date": dates, "close": 100.0 + 0.1 * np.arange(200) + noise}),
+    }
+
+    res = strategy_mean_reverting_batch(ohlcvs, months=3)
+    assert list(res.index) == ["WALK", "LINE"]
+    assert list(res["mean_reverting"]) == list(res["hurst"] < 0.5)
+    n = (dates > dates.max() - pd.offsets.DateOffset(months=3)).sum()
+    assert np.isclose(res.loc["WALK", "hurst"], hurst(walks[0][-n:]))
+    assert res.loc["LINE", "mean_reverting"]
+
+    expected = strategy_mean_reverting(ohlcvs["LINE"], months=3, verbose=False)
+    assert np.allclose(res.loc["LINE", ["slope", "intercept"]].astype(float), expected[2])
+    assert np.allclose(res.loc["LINE", list(MR_LEVELS)].astype(float), expected[5:])
+    assert res.loc["LINE", "days"] == expected[4]["days_since"].max()
+    assert strategy_mean_reverting_batch({}).empty
+
+
+@pytest.fixture
+def databroker():
+    client = mongomock.MongoClient()
+    broker = DataBrokerMongoDb(client)
+    return broker
+
+
+def test___screen_mean_reverting___pass(databroker):
+    rng = np.random.default_rng(2)
+    dates = pd.date_range("2021-01-01", periods=300, freq="D").strftime("%Y-%m-%d")
+    closes = {
+        "NOISE1": 100.0 + rng.standard_normal(300),
+        "NOISE2": 50.0 + 0.01 * np.arange(300) + rng.standard_normal(300),
+        "NOISE3": 20.0 + 0.5 * rng.standard_normal(300),
+        "TREND": 100.0 + 0.01 * rng.standard_normal(300).cumsum().cumsum(),
+    }
+    index = [("symbol", 1), ("date", 1)]
+    for symbol, close in closes.items():
+        recs = [{"symbol": symbol, "date": d, "close": c} for d, c in zip(dates, close)]
+        databroker.client["FinData"]["1d"].insert_many(recs)
+        databroker.update_catalog("FinData", "1d", recs, index, len(recs))
+
+    universe = [*closes, "MISSING"]
+    candidates, timings = screen_mean_reverting(universe, databroker, batch_size=2, processes=1)
+    assert set(timings) == set(SCREEN_STAGES)
+    assert sorted(candidates.index) == ["NOISE1", "NOISE2", "NOISE3"]
+    assert list(candidates["rank"]) == [1, 2, 3]
+    assert candidates["hurst"].is_monotonic_increasing
+
+    for symbol in candidates.index:
+        ohlcv = pd.DataFrame({"date": dates, "close": closes[symbol]})
+        expected = strategy_mean_reverting(ohlcv, verbose=False)
+        assert np.isclose(candidates.loc[symbol, "hurst"], expected[1])
+        assert np.allclose(candidates.loc[symbol, list(MR_LEVELS)].astype(float), expected[5:])
+
+    parallel, _ = screen_mean_reverting(universe, databroker, batch_size=2, processes=2)
+    pd.testing.assert_frame_equal(parallel, candidates)
+
+
 # ==============================================================================
 # The code below is for debugging a particular test in eclipse/pydev.
 # (normally all tests are run with pytest)
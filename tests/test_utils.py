@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `priceana` package."""
+import asyncio
 import itertools
+import json
+import os
 import time
 from asyncio import Semaphore
 from datetime import datetime as dt
@@ -15,6 +18,7 @@ from aiohttp import ClientSession
 from asynctest import CoroutineMock, patch
 from pandas.testing import assert_frame_equal
 from priceana.constants import base_url, query_url
+from priceana.utils.ArchiveUtils import ResponseArchive
 from priceana.utils.AsyncUtils import (
     aparse_multiindex_yahoo_financial_data,
     aparse_raw_yahoo_financial_data,
@@ -22,12 +26,27 @@ from priceana.utils.AsyncUtils import (
     aparse_yahoo_prices,
     bound_fetch,
     fetch,
+    save_yahoo_financial_data,
+    save_yahoo_prices,
     store_yahoo_financial_data,
     store_yahoo_prices,
 )
-from priceana.utils.DataBroker import DataBrokerMongoDb
-from priceana.utils.DateTimeUtils import clean_start_end_period, validate_date
+from priceana.utils.CheckpointUtils import Checkpoint
+import priceana.utils.DataBroker as DataBroker_module
+from priceana.utils.DataBroker import BufferedDataBroker, DataBroker, DataBrokerMongoDb
+from priceana.utils.DataBrokerParquet import DataBrokerParquet, _group_records, _merge_records
+from priceana.utils.DataBrokerSql import MAX_ATTACHED, DataBrokerSql
+from priceana.utils.MigrationUtils import migrate_datetimes
+from priceana.utils.IngestUtils import RateLimiter, run_sharded_ingest
+from priceana.utils.DateTimeUtils import (
+    clean_start_end_period,
+    native_collection,
+    native_query,
+    to_utc_datetime,
+    validate_date,
+)
 from priceana.utils.ParseUtils import (
+    align_records,
     generate_database_indices_dict,
     parse_from_multiindex,
     parse_prices,
@@ -35,13 +54,22 @@ from priceana.utils.ParseUtils import (
     parse_raw_fmt,
     parse_to_multiindex,
 )
+from priceana.utils.PriceStoreUtils import PriceStore
+from priceana.utils.QueueUtils import WorkQueue, run_queue_worker
+from priceana.utils.ReprocessUtils import reprocess_archive
+from priceana.utils.SchemaUtils import QuoteSummarySchemaRegistry
+from priceana.utils.SpoolUtils import CorruptSegmentError, Spool, SpoolFlusher
+from priceana.utils.StreamUtils import parse_chart_stream
 from priceana.utils.UrlUtils import (
+    estimate_rows,
     generate_combinations,
     generate_price_params,
     generate_price_urls,
     generate_yahoo_financial_data_params,
     generate_yahoo_financial_data_urls,
+    plan_combinations,
 )
+from pymongo.errors import AutoReconnect
 from pytest import raises
 
 
@@ -397,6 +425,36 @@ def test__generate_combinations___pass():
     assert expected == actual
 
 
+def test___plan_combinations___pass():
+    params = [
+        {"range": "5d", "interval": "1m"},
+        {"period1": 0, "period2": 86400 * 10, "interval": "1d"},
+    ]
+    assert estimate_rows(params[0]) == 7200
+    assert estimate_rows(params[1]) == 10
+
+    # SAME UNITS AS generate_combinations
+    plan = plan_combinations(["a", "b"], params, priority=())
+    assert list(plan) == generate_combinations(generate_price_urls(["a", "b"]), params)
+
+    symbols = ["a", "b", "c", "d"]
+    last = {"a": "2020-01-03", "b": "2020-01-01", "d": "2020-01-02"}
+    plan = plan_combinations(symbols, params[1:], ("watchlist", "stalest"), ["d"], last)
+    assert not isinstance(plan, list)
+    assert [u.split("/")[-1] for u, _ in plan] == ["d", "c", "b", "a"]
+
+    plan = list(plan_combinations(["a", "b"], params[::-1], ("largest", "stalest"), [], last))
+    assert [(u.split("/")[-1], p["interval"]) for u, p in plan] == [
+        ("b", "1m"),
+        ("a", "1m"),
+        ("b", "1d"),
+        ("a", "1d"),
+    ]
+
+    with raises(ValueError):
+        list(plan_combinations(["a"], params, ("newest",)))
+
+
 ################################################################################
 # TESTS FOR DATETIMEUTILS
 ################################################################################
@@ -468,6 +526,24 @@ def test___validate_date___typeerror___fail():
         validate_date({})
 
 
+def test___native_query___pass():
+    assert to_utc_datetime("2020-01-02") == dt(2020, 1, 2)
+    assert to_utc_datetime("2020-01-02T09:30:00-05:00") == dt(2020, 1, 2, 14, 30)
+
+    query = {"symbol": "2020", "date": {"$gte": "2020-01-01", "$in": ["2020-01-02"]}}
+    assert native_query(query) == {
+        "symbol": "2020",
+        "date": {"$gte": dt(2020, 1, 1), "$in": [dt(2020, 1, 2)]},
+    }
+    query = {"date": {"$regex": "^2021", "$exists": True}, "datetime": {"$nin": ["2020-01-02"]}}
+    assert native_query(query) == {
+        "date": {"$regex": "^2021", "$exists": True},
+        "datetime": {"$nin": [dt(2020, 1, 2)]},
+    }
+    assert native_collection("1d") and native_collection("15m") and native_collection("Splits")
+    assert not native_collection("earnings_earningsChart_quarterly")
+
+
 ################################################################################
 # TESTS FOR PARSEUTILS
 ################################################################################
@@ -741,6 +817,33 @@ test_generate_database_indices_dict___pass: list = [
 ]
 
 
+test_align_records_pass: list = [
+    [],
+    [{}],
+    [{"a": 1, "b": 2}],
+    [{"a": 1}, {"b": 2}],
+    [{"a": 1}, {"a": 2.5}],
+    [{"a": 1}, {"a": None}],
+    [{"a": "x"}, {"a": None}, {"b": 1}],
+    [{"a": True}, {"a": False}],
+    [{"a": True}, {}],
+    [{"a": 1, "b": "x"}, {"b": "y", "c": 3.0, "a": 2}],
+    [1, 2],
+]
+
+
+@pytest.mark.parametrize("records", test_align_records_pass)
+def test___align_records___pass(records):
+    expected = pd.DataFrame(records).to_dict(orient="records")
+    actual = align_records(records)
+
+    assert [list(r.keys()) for r in actual] == [list(r.keys()) for r in expected]
+    for ra, re in zip(actual, expected):
+        for k in re:
+            assert type(ra[k]) == type(re[k])
+            assert (ra[k] == re[k]) or (ra[k] != ra[k] and re[k] != re[k])
+
+
 @pytest.mark.parametrize("datadc,expected", test_parse_raw_fmt_pass)
 def test___parse_raw_fmt___pass(datadc, expected):
     assert expected == parse_raw_fmt(datadc)
@@ -783,6 +886,925 @@ def test___generate_database_indices_dict___pass(dc, expected):
     assert expected == generate_database_indices_dict(dc)
 
 
+################################################################################
+# TESTS FOR DATABROKER
+################################################################################
+
+
+def test___databroker_ensure_index___pass(databroker, monkeypatch):
+    calls = []
+    create_index = mongomock.collection.Collection.create_index
+
+    def counting_create_index(self, *args, **kwargs):
+        calls.append(self.name)
+        return create_index(self, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, "create_index", counting_create_index)
+
+    index = [("symbol", 1), ("date", 1)]
+    for i in range(3):
+        databroker.save({"symbol": "abc", "date": f"2020-01-0{i + 1}"}, "FinDataTest", "1d", index)
+    assert calls == ["1d"]
+
+    # A DIFFERENT SPEC IS CREATED ONCE
+    databroker.save({"symbol": "abc", "date": "2020-01-04"}, "FinDataTest", "1d", [("date", 1)])
+    assert calls == ["1d", "1d"]
+
+    # A NEW BROKER READS THE EXISTING INDEXES INSTEAD OF CREATING THEM
+    broker = DataBrokerMongoDb(databroker.client)
+    broker.save({"symbol": "abc", "date": "2020-01-05"}, "FinDataTest", "1d", index)
+    assert calls == ["1d", "1d"]
+
+    # DROPPING THROUGH THE BROKER FORGETS THE INDEXES
+    broker.drop_collection("FinDataTest", "1d")
+    broker.save({"symbol": "abc", "date": "2020-01-05"}, "FinDataTest", "1d", index)
+    assert calls == ["1d", "1d", "1d"]
+    assert "symbol_1_date_1" in databroker.client["FinDataTest"]["1d"].index_information()
+
+    broker.drop_database("FinDataTest")
+
+
+def test___databroker_save_modes___pass(databroker):
+    index = [("symbol", 1), ("date", 1)]
+    docs = [{"symbol": "abc", "date": f"2020-01-0{i}", "close": float(i)} for i in range(1, 4)]
+
+    res = databroker.save([dict(d) for d in docs], "FinDataTest", "1d", index)
+    assert res == {"inserted": 3, "updated": 0, "unchanged": 0}
+
+    # INSERT MODE SKIPS EXISTING KEYS, ALSO THE CHANGED ONES
+    docs[0]["close"] = 10.0
+    res = databroker.save([dict(d) for d in docs], "FinDataTest", "1d", index)
+    assert res == {"inserted": 0, "updated": 0, "unchanged": 3}
+
+    # UPSERT MODE UPDATES THE CHANGED DOCUMENT AND INSERTS THE NEW ONE
+    docs.append({"symbol": "abc", "date": "2020-01-04", "close": 4.0})
+    res = databroker.save(docs, "FinDataTest", "1d", index, mode="upsert", batch_size=2)
+    assert res == {"inserted": 1, "updated": 1, "unchanged": 2}
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 4
+    assert databroker.load("FinDataTest", "1d", {"date": "2020-01-01"})[0]["close"] == 10.0
+
+    databroker.drop_database("FinDataTest")
+
+
+def test___databroker_save_modes___inserted_docs___pass(databroker):
+    index = [("symbol", 1), ("date", 1)]
+    docs = [{"symbol": "abc", "date": f"2020-01-0{i}", "close": float(i)} for i in range(1, 4)]
+
+    # INSERT_MANY SETS THE _ID OF THE DICTS
+    databroker.save(docs, "FinDataTest", "1d", index)
+    assert all("_id" in doc for doc in docs)
+
+    # A FRESH COPY OF THE COLLECTION STORES OTHER _IDS UNDER THE SAME KEYS
+    databroker.drop_collection("FinDataTest", "1d")
+    databroker.save(
+        [{k: v for k, v in d.items() if k != "_id"} for d in docs], "FinDataTest", "1d", index
+    )
+
+    docs[0]["close"] = 10.0
+    res = databroker.save(docs, "FinDataTest", "1d", index, mode="upsert")
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 2}
+    assert databroker.load("FinDataTest", "1d", {"date": "2020-01-01"})[0]["close"] == 10.0
+
+    databroker.drop_database("FinDataTest")
+
+
+def test___databroker_save_modes___fail(databroker):
+    with raises(ValueError):
+        databroker.save({"symbol": "abc"}, "FinDataTest", "1d", [("symbol", 1)], mode="x")
+    with raises(ValueError):
+        DataBrokerMongoDb(databroker.client, write_mode="x")
+
+
+def test___databroker_buckets___pass(monkeypatch):
+    client = mongomock.MongoClient()
+    broker = DataBrokerMongoDb(client, bucket_collections=["1d", "1h"])
+
+    daily = [
+        {"symbol": s, "date": d, "close": c, "currency": "USD"}
+        for s in ["abc", "xyz"]
+        for d, c in [("2019-12-31", 1.0), ("2020-01-02", 2.0), ("2020-01-03", 3.0)]
+    ]
+    res = broker.save(daily, "FinDataTest", "1d", [("symbol", 1), ("date", 1)])
+    assert res == {"inserted": 6, "updated": 0, "unchanged": 0}
+
+    # ONE BUCKET PER SYMBOL AND YEAR, CONSTANT FIELDS STORED ONCE
+    assert client["FinDataTest"]["1d"].count_documents({}) == 4
+    bucket = client["FinDataTest"]["1d"].find_one({"symbol": "abc", "bucket": "2020"})
+    assert bucket["count"] == 2 and bucket["const"] == {"currency": "USD"}
+    assert broker.get_number_of_documents("FinDataTest", "1d") == 6
+
+    query = {"symbol": "abc", "date": {"$gte": "2020-01-01"}}
+    assert broker.load("FinDataTest", "1d", query) == daily[1:3]
+    assert broker.load("FinDataTest", "1d", {"date": "2019-12-31"}, {"close": 1}) == [
+        {"close": 1.0},
+        {"close": 1.0},
+    ]
+
+    # UPSERT MERGES INTO THE EXISTING BUCKET
+    new = [dict(daily[2], close=30.0), {"symbol": "abc", "date": "2020-01-06", "close": 6.0}]
+    res = broker.save(new, "FinDataTest", "1d", [("symbol", 1), ("date", 1)], mode="upsert")
+    assert res == {"inserted": 1, "updated": 1, "unchanged": 0}
+    closes = [r["close"] for r in broker.load("FinDataTest", "1d", query)]
+    assert closes == [2.0, 30.0, 6.0]
+
+    # INTRADAY BARS ARE BUCKETED PER DAY
+    hourly = [
+        {"symbol": "abc", "datetime": f"2020-01-0{d}T1{h}:00:00", "close": float(h)}
+        for d in [2, 3]
+        for h in range(3)
+    ]
+    broker.save(hourly, "FinDataTest", "1h", [("symbol", 1), ("datetime", 1)])
+    assert client["FinDataTest"]["1h"].count_documents({}) == 2
+    assert broker.load("FinDataTest", "1h", {"datetime": {"$lt": "2020-01-03"}}) == hourly[:3]
+
+    # $SET UPDATES OF BUCKETED RECORDS
+    broker.update(
+        "FinDataTest", "1h", {"datetime": {"$gte": "2020-01-03"}}, {"$set": {"close": 0.0}}
+    )
+    closes = [r["close"] for r in broker.load("FinDataTest", "1h", {"symbol": "abc"})]
+    assert closes == [0.0, 1.0, 2.0, 0.0, 0.0, 0.0]
+    with raises(ValueError):
+        broker.update("FinDataTest", "1h", {}, {"$inc": {"close": 1.0}})
+    with raises(ValueError):
+        broker.update("FinDataTest", "1h", {}, {"$set": {"datetime": "x"}})
+
+    # FIELDS MISSING IN A RECORD ARE NOT LOADED AS NONE
+    broker.save(
+        [{"symbol": "abc", "date": "2021-01-04"}], "FinDataTest", "1d", [("symbol", 1), ("date", 1)]
+    )
+    broker.save(
+        [{"symbol": "abc", "date": "2021-01-05", "close": 1.0, "volume": None}],
+        "FinDataTest",
+        "1d",
+        [("symbol", 1), ("date", 1)],
+    )
+    assert broker.load("FinDataTest", "1d", {"date": {"$gte": "2021-01-01"}}) == [
+        {"symbol": "abc", "date": "2021-01-04"},
+        {"symbol": "abc", "date": "2021-01-05", "close": 1.0},
+    ]
+
+    # SORTED STREAMING, ONLY THE BUCKETS OF ONE BUCKET KEY ARE UNPACKED AT A TIME
+    unpacked = []
+    unpack_bucket = DataBroker_module.unpack_bucket
+    monkeypatch.setattr(
+        DataBroker_module,
+        "unpack_bucket",
+        lambda doc, keyfields: unpacked.append(doc["bucket"]) or unpack_bucket(doc, keyfields),
+    )
+    sort = [("date", -1), ("symbol", 1)]
+    loaded = broker.iter_load("FinDataTest", "1d", {}, {"_id": 0, "close": 0}, sort)
+    assert next(loaded) == {"symbol": "abc", "date": "2021-01-05"}
+    assert unpacked == ["2021"]
+    assert [(r["date"][-2:], r["symbol"]) for r in loaded] == [
+        ("04", "abc"),
+        ("06", "abc"),
+        ("03", "abc"),
+        ("03", "xyz"),
+        ("02", "abc"),
+        ("02", "xyz"),
+        ("31", "abc"),
+        ("31", "xyz"),
+    ]
+    loaded = broker.iter_load("FinDataTest", "1d", {"date": {"$lt": "2021"}}, sort=[("close", -1)])
+    assert [r["close"] for r in loaded] == [30.0, 6.0, 3.0, 2.0, 2.0, 1.0, 1.0]
+
+
+def test___databroker_buckets___concurrent___pass():
+    client = mongomock.MongoClient()
+    broker = DataBrokerMongoDb(client, bucket_collections=["1d"])
+    index = [("symbol", 1), ("date", 1)]
+    colm = client["FinDataTest"]["1d"]
+    broker.save([{"symbol": "abc", "date": "2020-01-02", "close": 2.0}], "FinDataTest", "1d", index)
+
+    # ANOTHER WRITER REPLACES THE BUCKET BETWEEN THE READ AND THE WRITE OF THIS ONE
+    find = colm.find
+
+    def racing_find(*args, **kwargs):
+        docs = list(find(*args, **kwargs))
+        if racing_find.first:
+            racing_find.first = False
+            other = DataBrokerMongoDb(client, bucket_collections=["1d"])
+            rec = {"symbol": "abc", "date": "2020-01-03", "close": 3.0}
+            other.save([rec], "FinDataTest", "1d", index)
+        return iter(docs)
+
+    racing_find.first = True
+    colm.find = racing_find
+    rec = {"symbol": "abc", "date": "2020-01-06", "close": 6.0}
+    res = broker.save([rec], "FinDataTest", "1d", index)
+    del colm.find
+
+    # BOTH BARS ARE KEPT, THE CONFLICTING WRITE WAS MERGED AGAIN
+    assert res == {"inserted": 1, "updated": 0, "unchanged": 0}
+    dates = [r["date"] for r in broker.load("FinDataTest", "1d", {"symbol": "abc"})]
+    assert dates == ["2020-01-02", "2020-01-03", "2020-01-06"]
+    assert colm.find_one({"symbol": "abc"})["version"] == 3
+
+
+def test___databroker_iter_load___pass(databroker):
+    index = [("symbol", 1), ("date", 1)]
+    docs = [
+        {"symbol": "abc", "date": f"2020-01-{i:02d}", "close": float(i), "volume": i}
+        for i in range(1, 11)
+    ]
+    docs[3]["extra"] = "x"
+    docs[5]["close"] = None
+    databroker.save([dict(d) for d in docs], "FinDataTest", "1d", index)
+
+    loaded = databroker.iter_load("FinDataTest", "1d", {}, batch_size=3)
+    assert not isinstance(loaded, list)
+    assert list(loaded) == docs
+
+    loaded = databroker.iter_load(
+        "FinDataTest", "1d", {"close": {"$gt": 5}}, {"date": 1}, [("date", -1)], limit=2
+    )
+    assert list(loaded) == [{"date": "2020-01-10"}, {"date": "2020-01-09"}]
+
+    # TYPED COLUMNS, FIELDS MISSING IN SOME BATCHES ARE FILLED
+    frame = databroker.load_frame("FinDataTest", "1d", {}, batch_size=3)
+    assert list(frame.columns) == ["symbol", "date", "close", "volume", "extra"]
+    assert frame["close"].dtype == np.float64 and np.isnan(frame["close"][5])
+    assert frame["volume"].dtype == np.int64
+    assert frame["extra"][3] == "x" and frame["extra"].isna().sum() == 9
+    databroker.update("FinDataTest", "1d", {}, {"$set": {"flag": True, "at": dt(2020, 1, 1)}})
+    frame = databroker.load_frame("FinDataTest", "1d", {}, batch_size=3)
+    assert frame["flag"].dtype == bool and frame["flag"].all()
+    assert frame["at"].dtype == "datetime64[ns]" and (frame["at"] == "2020-01-01").all()
+
+    frame = databroker.load_frame(
+        "FinDataTest", "1d", {}, {"close": 1}, [("date", -1)], limit=3, batch_size=2
+    )
+    assert frame["close"].tolist() == [10.0, 9.0, 8.0]
+    assert databroker.load_frame("FinDataTest", "missing", {}).empty
+
+    databroker.drop_database("FinDataTest")
+
+
+def test___databroker_cache___pass():
+    client = mongomock.MongoClient()
+    broker = DataBrokerMongoDb(client, cache_records=5)
+    index = [("symbol", 1), ("date", 1)]
+    broker.save(
+        [{"symbol": s, "date": "2020-01-01", "close": 1.0} for s in "abc"],
+        "FinDataTest",
+        "1d",
+        index,
+    )
+
+    query = {"symbol": {"$in": ["a", "b"]}, "date": "2020-01-01"}
+    first = broker.load("FinDataTest", "1d", query)
+    first[0]["close"] = 0.0
+    # SAME QUERY WITH A DIFFERENT KEY ORDER IS A HIT, RESULTS ARE COPIES
+    second = broker.load("FinDataTest", "1d", dict(reversed(list(query.items()))))
+    assert second[0]["close"] == 1.0
+    assert broker.cache.stats == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "invalidations": 0,
+        "entries": 1,
+        "records": 2,
+    }
+
+    # WRITES INVALIDATE THE COLLECTION
+    broker.update("FinDataTest", "1d", {"symbol": "a"}, {"$set": {"close": 2.0}})
+    assert broker.load("FinDataTest", "1d", query)[0]["close"] == 2.0
+    broker.save({"symbol": "a", "date": "2020-01-02"}, "FinDataTest", "1d", index)
+    assert len(broker.load("FinDataTest", "1d", {"symbol": "a"})) == 2
+
+    # LRU EVICTION BEYOND cache_records RECORDS
+    broker.load("FinDataTest", "1d", {})
+    assert broker.cache.stats["evictions"] == 1
+    assert broker.cache.stats["records"] == 4
+    assert broker.cache.stats["invalidations"] == 2
+
+    broker.drop_database("FinDataTest")
+    assert broker.cache.stats["entries"] == 0
+
+
+def test___databroker_native_datetimes___pass(tmp_path):
+    client = mongomock.MongoClient()
+    index = [("symbol", 1), ("datetime", 1)]
+    bars = [
+        {"symbol": "abc", "datetime": "2020-01-02T09:30:00-05:00", "close": 1.0},
+        {"symbol": "abc", "datetime": "2020-01-02T15:00:00+01:00", "close": 2.0},
+    ]
+
+    # CROSS-TIMEZONE ORDERING IS CORRECT ON NATIVE DATETIMES
+    broker = DataBrokerMongoDb(client, datetime_mode="native")
+    broker.save(bars, "FinDataTest", "1h", index)
+    loaded = broker.load("FinDataTest", "1h", {"datetime": {"$gt": "2020-01-02T14:00:00Z"}})
+    assert loaded == [{"symbol": "abc", "datetime": dt(2020, 1, 2, 14, 30), "close": 1.0}]
+    assert [r["close"] for r in broker.iter_load("FinDataTest", "1h", {}, sort=index)] == [2.0, 1.0]
+
+    # MIGRATION OF A STRING COLLECTION
+    DataBrokerMongoDb(client).save(bars, "FinDataTest", "1m", index)
+    assert migrate_datetimes(broker, "FinDataTest", batch_size=1) == {"1h": 0, "1m": 2}
+    assert broker.load("FinDataTest", "1m", {"datetime": "2020-01-02T14:00:00Z"}) == [
+        {"symbol": "abc", "datetime": dt(2020, 1, 2, 14), "close": 2.0}
+    ]
+
+    # THE EXCHANGE TIMEZONE IS STORED ONCE PER SYMBOL
+    interval, prices, div, split = parse_prices(pricedc)
+    save_yahoo_prices(broker, "FinDataTest", "abc", interval, prices, None, None)
+    save_yahoo_prices(broker, "FinDataTest", "abc", interval, prices, None, None)
+    assert broker.load("FinDataTest", "1d", {"date": "2020-03-01"})[0]["date"] == dt(2020, 3, 1)
+    assert broker.load("FinDataTest", "ExchangeTimezones", {}) == [
+        {"symbol": "abc", "exchangeTimezoneName": "America/New_York"}
+    ]
+
+    # THE EXCHANGE TIMEZONE GOES THROUGH THE SPOOL AS WELL
+    spool = Spool(str(tmp_path / "spool"))
+    save_yahoo_prices(broker, "FinDataTest", "xyz", interval, prices, None, None, spool=spool)
+    spool.seal()
+    batches = [b for p in spool.segments() for _, b, _ in Spool.iter_batches(p)]
+    assert [b["col"] for b in batches] == [interval, "ExchangeTimezones"]
+
+    # THE PERIODS OF THE FUNDAMENTALS ARE NO DATES AND STAY STRINGS
+    findata = {"earnings_earningsChart_quarterly": [{"symbol": "abc", "date": "2Q2021"}]}
+    save_yahoo_financial_data(broker, "FinDataTest", "abc", findata)
+    assert broker.load("FinDataTest", "earnings_earningsChart_quarterly", {"date": "2Q2021"})
+    client["FinDataTest"]["Splits"].insert_many(
+        [{"symbol": "abc", "date": "2020-01-02"}, {"symbol": "abc", "date": "n/a"}]
+    )
+    assert migrate_datetimes(broker, "FinDataTest") == {"1d": 0, "1h": 0, "1m": 0, "Splits": 1}
+    assert [r["date"] for r in broker.load("FinDataTest", "Splits", {"symbol": "abc"})] == [
+        dt(2020, 1, 2),
+        "n/a",
+    ]
+
+    with raises(ValueError):
+        DataBrokerMongoDb(client, datetime_mode="x")
+
+
+def test___databroker_catalog___pass(databroker):
+    index = [("symbol", 1), ("date", 1)]
+    docs = [{"symbol": "abc", "date": d} for d in ["2020-01-02", "2020-01-03"]]
+    databroker.save(docs, "FinDataTest", "1d", index)
+    databroker.update_catalog("FinDataTest", "1d", docs, index, 2)
+
+    # A SECOND SAVE EXTENDS THE RANGE AND COUNTS THE INSERTED RECORDS
+    docs = [{"symbol": "abc", "date": "2020-01-06"}, {"symbol": "xyz", "date": "2020-01-01"}]
+    databroker.save(docs, "FinDataTest", "1d", index)
+    databroker.update_catalog("FinDataTest", "1d", docs, index, 2)
+
+    catalog = databroker.get_catalog("FinDataTest", "1d")
+    assert [{k: c[k] for k in ["symbol", "first", "last", "count"]} for c in catalog] == [
+        {"symbol": "abc", "first": "2020-01-02", "last": "2020-01-06", "count": 3},
+        {"symbol": "xyz", "first": "2020-01-01", "last": "2020-01-01", "count": 1},
+    ]
+    assert all(isinstance(c["updated"], dt) for c in catalog)
+    assert databroker.get_catalog("FinDataTest", symbols=["xyz"])[0]["collection"] == "1d"
+    assert databroker.get_stale_symbols("FinDataTest", "1d", "2020-01-06") == ["xyz"]
+
+    # THE STORE COROUTINES KEEP THE CATALOG
+    databroker.client.drop_database("FinDataTest")
+    interval, prices, div, split = parse_prices(pricedc)
+    save_yahoo_prices(databroker, "FinDataTest", "abc", interval, prices, div, split)
+    catalog = databroker.get_catalog("FinDataTest", interval, [prices["symbol"].iloc[0]])
+    assert catalog[0]["count"] == len(prices)
+
+    # BUFFERED WRITES UPDATE THE CATALOG ON FLUSH
+    client = mongomock.MongoClient()
+    with BufferedDataBroker(client, max_delay=None, workers=1) as broker:
+        broker.save(docs, "FinDataTest", "1d", index)
+        broker.update_catalog("FinDataTest", "1d", docs, index)
+        assert broker.get_catalog("FinDataTest") == []
+    assert [c["count"] for c in broker.get_catalog("FinDataTest")] == [1, 1]
+
+    # A FLUSH TRIGGERED BY THE SAVE ITSELF IS CATALOGED, ONE CATALOG UPDATE PER FLUSH
+    client = mongomock.MongoClient()
+    with BufferedDataBroker(client, max_records=2, max_delay=None, workers=1) as broker:
+        broker.save_cataloged(docs, "FinDataTest", "Dividends", index)
+        broker._executor.submit(lambda: None).result()
+        assert [c["symbol"] for c in broker.get_catalog("FinDataTest")] == ["abc", "xyz"]
+        broker.save_cataloged(docs[:1], "FinDataTest", "Splits", index)
+        broker.save(docs[1:], "FinDataTest", "Splits", index)
+    assert [c["collection"] for c in broker.get_catalog("FinDataTest")] == ["Dividends"] * 2 + [
+        "Splits"
+    ]
+
+    databroker.client.drop_database("FinDataTest")
+
+
+def test___databroker_protocol___pass(databroker):
+    class ListBroker:
+        def save(self, data, db, col, indexTupleList, unique=True):
+            pass
+
+        def load(self, db, col, searchdict, selectiondict={}):
+            pass
+
+        def update(self, db, col, myquery, newvalues):
+            pass
+
+        def get_number_of_documents(self, db, col):
+            pass
+
+    assert isinstance(databroker, DataBroker)
+    assert isinstance(ListBroker(), DataBroker)
+    assert not isinstance(databroker.client, DataBroker)
+
+
+def test___databroker_parquet___pass(tmp_path):
+    pytest.importorskip("pyarrow")
+    broker = DataBrokerParquet(str(tmp_path))
+    index = [("symbol", 1), ("date", 1)]
+
+    daily = [
+        {"symbol": s, "date": d, "close": c, "volume": 10}
+        for s in ["EURUSD=X", "abc"]
+        for d, c in [("2019-12-31", 1.0), ("2020-01-02", 2.0), ("2020-01-03", 3.0)]
+    ]
+    res = broker.save(daily, "FinDataTest", "1d", index)
+    assert res == {"inserted": 6, "updated": 0, "unchanged": 0}
+    assert broker.save(daily, "FinDataTest", "1d", index)["unchanged"] == 6
+    assert broker.get_number_of_documents("FinDataTest", "1d") == 6
+    assert (tmp_path / "FinDataTest" / "1d" / "symbol=abc" / "year=2019").is_dir()
+
+    # PREDICATE AND COLUMN PUSHDOWN
+    query = {"symbol": "EURUSD=X", "date": {"$gte": "2020-01-01"}}
+    assert broker.load("FinDataTest", "1d", query) == [
+        {"date": d["date"], "close": d["close"], "volume": 10, "symbol": "EURUSD=X"}
+        for d in daily[1:3]
+    ]
+    table = broker.load_table("FinDataTest", "1d", {"close": {"$lt": 2.0}}, {"close": 1})
+    assert table.column_names == ["close"] and table.num_rows == 2
+    assert broker.load("FinDataTest", "1d", {"unknown": 1}) == []
+
+    # UPSERT AND UPDATE
+    new = {"symbol": "abc", "date": "2020-01-02", "close": 20.0, "volume": 10}
+    res = broker.save(new, "FinDataTest", "1d", ["symbol", "date"], mode="upsert")
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 0}
+    gap = {"symbol": "xyz", "date": "2020-01-06", "close": float("nan"), "volume": 10}
+    assert broker.save(gap, "FinDataTest", "1d", index)["inserted"] == 1
+    assert broker.save(gap, "FinDataTest", "1d", index, mode="upsert")["unchanged"] == 1
+    broker.update("FinDataTest", "1d", {"date": "2019-12-31"}, {"$set": {"volume": 5}})
+    loaded = broker.load("FinDataTest", "1d", {"symbol": "abc"}, {"close": 1, "volume": 1})
+    assert loaded == [
+        {"close": 1.0, "volume": 5},
+        {"close": 20.0, "volume": 10},
+        {"close": 3.0, "volume": 10},
+    ]
+
+    with raises(ValueError):
+        broker.update("FinDataTest", "1d", {}, {"$set": {"date": "2020-01-01"}})
+    with raises(ValueError):
+        broker.load("FinDataTest", "1d", {"close": {"$regex": "1"}})
+
+
+def test___databroker_parquet___merge___pass():
+    fields = ["symbol", "date"]
+    records = [
+        {"symbol": "abc", "date": "2019-12-31", "close": 1.0},
+        {"symbol": "abc", "date": "2020-01-02", "close": float("nan")},
+        {"symbol": "abc", "date": "2020-01-03", "close": 3.0, "_id": 1},
+        {"symbol": "xyz", "close": 4.0},
+    ]
+    groups = _group_records(records, fields)
+    assert {k: len(v) for k, v in groups.items()} == {
+        ("abc", "2019"): 1,
+        ("abc", "2020"): 2,
+        ("xyz", "all"): 1,
+    }
+
+    merged: dict = {}
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    assert _merge_records(merged, groups[("abc", "2020")], fields, "upsert", counts)
+    assert counts == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert "_id" not in merged[("abc", "2020-01-03")]
+
+    # GAPS ARE EQUAL: NAN, NONE (NAN STORED AS NULL) AND MISSING FIELDS
+    merged[("abc", "2020-01-02")]["close"] = None
+    merged[("abc", "2020-01-03")]["volume"] = None
+    counts = dict.fromkeys(counts, 0)
+    assert not _merge_records(merged, groups[("abc", "2020")], fields, "upsert", counts)
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 2}
+
+    new = [{"symbol": "abc", "date": "2020-01-02", "close": 2.0}]
+    assert not _merge_records(merged, new, fields, "insert", counts)
+    assert _merge_records(merged, new, fields, "upsert", counts)
+    assert counts == {"inserted": 0, "updated": 1, "unchanged": 3}
+    assert merged[("abc", "2020-01-02")]["close"] == 2.0
+
+    with raises(ValueError):
+        _group_records([{"date": "2020-01-02"}], fields)
+
+
+def test___databroker_parquet___financial_data___pass(tmp_path):
+    pytest.importorskip("pyarrow")
+    broker = DataBrokerParquet(str(tmp_path))
+
+    # ALIGNED RECORDS HAVE NAN GAPS, ALSO IN STRING COLUMNS
+    quarterly = [
+        {"date": "1Q2021", "actual": 1.1, "estimate": 1.0, "note": "beat"},
+        {"date": "2Q2021", "actual": 0.9},
+    ]
+    findata = {"earnings_earningsChart_quarterly": align_records(quarterly)}
+    for record in findata["earnings_earningsChart_quarterly"]:
+        record["symbol"] = "abc"
+    save_yahoo_financial_data(broker, "FinDataTest", "abc", findata)
+
+    loaded = broker.load("FinDataTest", "earnings_earningsChart_quarterly", {"symbol": "abc"})
+    assert [r["date"] for r in loaded] == ["1Q2021", "2Q2021"]
+    assert loaded[0]["note"] == "beat" and loaded[1].get("note") is None
+    assert loaded[1].get("estimate") is None and loaded[1]["actual"] == 0.9
+
+
+def test___databroker_sql___pass(tmp_path):
+    broker = DataBrokerSql(str(tmp_path))
+    index = [("symbol", 1), ("date", 1)]
+
+    daily = [
+        {"symbol": s, "date": d, "close": c, "volume": np.int64(10)}
+        for s in ["abc", "xyz"]
+        for d, c in [("2019-12-31", 1.0), ("2020-01-02", 2.0), ("2020-01-03", 4.0)]
+    ]
+    res = broker.save(daily, "FinDataTest", "1d", index)
+    assert res == {"inserted": 6, "updated": 0, "unchanged": 0}
+
+    # UPSERT BY DEFAULT, ONLY CHANGED ROWS COUNT AS UPDATED
+    new = [dict(daily[0], close=9.0, extra=[1, 2]), daily[1]]
+    res = broker.save(new, "FinDataTest", "1d", index)
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 1}
+    res = broker.save(dict(daily[1], close=0.0), "FinDataTest", "1d", index, mode="insert")
+    assert res == {"inserted": 0, "updated": 0, "unchanged": 1}
+    broker.save(daily[:2], "FinDataTest", "1dmixed", index)
+    mixed = [dict(daily[1], close=8.0), daily[2]]
+    res = broker.save(mixed, "FinDataTest", "1dmixed", index)
+    assert res == {"inserted": 1, "updated": 1, "unchanged": 0}
+    res = broker.save(mixed, "FinDataTest", "1dmixed", index)
+    assert res == {"inserted": 0, "updated": 0, "unchanged": 2}
+
+    assert broker.load("FinDataTest", "1d", {"symbol": "abc", "date": {"$lt": "2020"}}) == [
+        {"symbol": "abc", "date": "2019-12-31", "close": 9.0, "volume": 10, "extra": "[1, 2]"}
+    ]
+    cols = broker.load_columns("FinDataTest", "1d", {"symbol": "xyz"}, {"close": 1, "volume": 1})
+    np.testing.assert_array_equal(cols["close"], [1.0, 2.0, 4.0])
+    assert cols["volume"].dtype == np.int64
+
+    # IN-ENGINE AGGREGATIONS AND JOINS, ALSO FROM A NEW BROKER ON THE SAME FILES
+    broker.save({"symbol": "xyz", "date": "2020-01-01", "beta": 1.5}, "FinDataTest", "price", index)
+    broker = DataBrokerSql(str(tmp_path))
+    assert broker.get_number_of_documents("FinDataTest", "1d") == 6
+    res = broker.query(
+        "SELECT p.symbol, close / LAG(close) OVER (ORDER BY p.date) - 1 AS ret, beta FROM "
+        'FinDataTest."1d" p JOIN FinDataTest.price f ON p.symbol = f.symbol ORDER BY p.date',
+        dbs=["FinDataTest"],
+    )
+    np.testing.assert_array_equal(res["ret"], [np.nan, 1.0, 1.0])
+    np.testing.assert_array_equal(res["beta"], [1.5, 1.5, 1.5])
+
+    broker.update("FinDataTest", "1d", {"date": {"$in": ["2019-12-31"]}}, {"$set": {"volume": 5}})
+    assert broker.load("FinDataTest", "1d", {"volume": 5}, {"symbol": 1}) == [
+        {"symbol": "abc"},
+        {"symbol": "xyz"},
+    ]
+    with raises(ValueError):
+        broker.update("FinDataTest", "1d", {}, {"$inc": {"volume": 1}})
+
+
+@pytest.mark.parametrize("memory", [False, True])
+def test___databroker_sql___databases___pass(tmp_path, memory):
+    broker = DataBrokerSql(None if memory else str(tmp_path))
+    index = [("symbol", 1), ("date", 1)]
+
+    # MORE DATABASES THAN CAN BE ATTACHED, DETACHED ONES KEEP THEIR DATA
+    dbs = [f"FinDataTest{i}" for i in range(MAX_ATTACHED + 3)]
+    for i, db in enumerate(dbs):
+        broker.save({"symbol": "abc", "date": "2020-01-02", "close": float(i)}, db, "1d", index)
+    for i, db in enumerate(dbs):
+        assert broker.load(db, "1d", {})[0]["close"] == float(i)
+        assert broker.get_number_of_documents(db, "1d") == 1
+
+    res = broker.query(
+        f'SELECT a.close + b.close AS close FROM {dbs[0]}."1d" a JOIN {dbs[-1]}."1d" b',
+        dbs=[dbs[0], dbs[-1]],
+    )
+    np.testing.assert_array_equal(res["close"], [float(len(dbs) - 1)])
+    with raises(ValueError):
+        broker.query("SELECT 1", dbs=dbs)
+
+    broker.close()
+
+
+def test___buffered_databroker___pass():
+    client = mongomock.MongoClient()
+    index = [("symbol", 1), ("date", 1)]
+
+    with BufferedDataBroker(client, max_records=4, max_delay=None, workers=1) as broker:
+        for symbol in ["a", "b", "c"]:
+            docs = [{"symbol": symbol, "date": d} for d in ["2020-01-01", "2020-01-02"]]
+            res = broker.save(docs, "FinDataTest", "1d", index)
+            assert res == {"buffered": 2}
+        broker.save({"symbol": "a", "date": "2020-01-01"}, "FinDataTest", "Dividends", index)
+
+        # THE SIZE LIMIT FLUSHED THE FIRST FOUR PRICE RECORDS
+        broker._executor.submit(lambda: None).result()
+        assert client["FinDataTest"]["1d"].count_documents({}) == 4
+        assert "Dividends" not in client["FinDataTest"].list_collection_names()
+
+    # CLOSE FLUSHES THE REST
+    assert client["FinDataTest"]["1d"].count_documents({}) == 6
+    assert client["FinDataTest"]["Dividends"].count_documents({}) == 1
+    assert broker.counts["inserted"] == 7
+    assert broker.counts["flushes"] == 3
+
+    with raises(ValueError):
+        broker.save({"symbol": "a"}, "FinDataTest", "1d", index)
+
+
+def test___buffered_databroker___delay___pass():
+    client = mongomock.MongoClient()
+    broker = BufferedDataBroker(client, max_records=100, max_delay=0.05, workers=1)
+    broker.save({"symbol": "a", "date": "2020-01-01"}, "FinDataTest", "1d", [("symbol", 1)])
+
+    for _ in range(100):
+        if broker.counts["flushes"]:
+            break
+        time.sleep(0.01)
+
+    assert client["FinDataTest"]["1d"].count_documents({}) == 1
+    broker.close()
+
+
+################################################################################
+# TESTS FOR PRICESTOREUTILS
+################################################################################
+
+
+def test___price_store___pass(tmp_path):
+    store = PriceStore(str(tmp_path))
+    prices = pd.DataFrame(
+        {"open": [1.0, 2.0, 3.0], "close": [1.5, 2.5, 3.5], "volume": [10, 20, 30]},
+        index=pd.Index(["2020-01-02", "2020-01-03", "2020-01-06"], name="date"),
+    )
+    assert store.append_frame("EURUSD=X", "1d", prices) == 3
+
+    series = store.open("EURUSD=X", "1d")
+    assert isinstance(series.close, np.memmap)
+    np.testing.assert_array_equal(series.epoch, [1577923200, 1578009600, 1578268800])
+    assert np.isnan(series.high).all()
+
+    # INCREMENTAL APPEND IN PLACE, THE OPEN SERIES KEEPS ITS LENGTH
+    new = pd.DataFrame({"close": [4.5]}, index=pd.Index(["2020-01-07"], name="date"))
+    assert store.append_frame("EURUSD=X", "1d", new) == 4
+    assert len(series.close) == 3
+
+    # OVERLAPPING ROWS ARE MERGED, NEW VALUES WIN
+    new = pd.DataFrame(
+        {"close": [9.0, 0.5]}, index=pd.Index(["2020-01-03", "2020-01-01"], name="date")
+    )
+    assert store.append_frame("EURUSD=X", "1d", new) == 5
+    np.testing.assert_array_equal(series.close, [1.5, 2.5, 3.5])
+
+    # A NEW STORE READS THE OFFSET INDEX
+    series = PriceStore(str(tmp_path)).open_many("1d")["EURUSD=X"]
+    np.testing.assert_array_equal(series.close, [0.5, 1.5, 9.0, 3.5, 4.5])
+    np.testing.assert_array_equal(series.volume, [0, 10, 0, 30, 0])
+    np.testing.assert_array_equal(series.close[series.window(1578009600, 1578355200)], [9.0, 3.5])
+
+    assert len(store.open("abc", "1d").close) == 0
+    assert store.symbols("1d") == ["EURUSD=X"]
+
+
+def test___price_store___writers___pass(tmp_path):
+    # TWO STORES ON THE SAME ROOT, AS IN TWO PROCESSES, DO NOT LOSE EACH OTHERS SYMBOLS
+    first, second = PriceStore(str(tmp_path)), PriceStore(str(tmp_path))
+    first.symbols("1d")
+    second.symbols("1d")
+    first.append("abc", "1d", {"epoch": [1, 2], "close": [1.0, 2.0]})
+    second.append("x/y", "1d", {"epoch": [1], "close": [5.0]})
+    second.append("abc", "1d", {"epoch": [3], "close": [3.0]})
+    assert first.append("abc", "1d", {"epoch": [4], "close": [4.0]}) == 4
+
+    assert not (tmp_path / "1d" / "_index.json").exists()
+    store = PriceStore(str(tmp_path))
+    assert store.symbols("1d") == ["abc", "x/y"]
+    np.testing.assert_array_equal(store.open("abc", "1d").close, [1.0, 2.0, 3.0, 4.0])
+
+
+def test___price_store___interrupted_merge___pass(tmp_path, monkeypatch):
+    store = PriceStore(str(tmp_path))
+    store.append("abc", "1d", {"epoch": [1, 2], "close": [1.0, 2.0], "volume": [10, 20]})
+
+    # A MERGE INTERRUPTED BEFORE ITS COMMIT LEAVES THE STORED SERIES UNTOUCHED
+    def crash(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(PriceStore, "_write_meta", crash)
+    with raises(OSError):
+        store.append("abc", "1d", {"epoch": [0, 2], "close": [0.5, 9.0]})
+    monkeypatch.undo()
+
+    series = PriceStore(str(tmp_path)).open("abc", "1d")
+    np.testing.assert_array_equal(series.close, [1.0, 2.0])
+    np.testing.assert_array_equal(series.volume, [10, 20])
+
+    assert store.append("abc", "1d", {"epoch": [0, 2], "close": [0.5, 9.0]}) == 3
+    series = PriceStore(str(tmp_path)).open("abc", "1d")
+    np.testing.assert_array_equal(series.close, [0.5, 1.0, 9.0])
+    np.testing.assert_array_equal(series.volume, [0, 10, 0])
+    assert sorted(p.name for p in (tmp_path / "1d").iterdir() if p.suffix == ".close") == [
+        "abc@1.close"
+    ]
+
+
+################################################################################
+# TESTS FOR SPOOLUTILS
+################################################################################
+
+
+def test___spool___pass(tmp_path, databroker):
+    spool = Spool(str(tmp_path / "spool"))
+    index = [("symbol", 1), ("date", 1)]
+    interval, prices, div, split = parse_prices(pricedc)
+    save_yahoo_prices(databroker, "FinDataTest", "abc", interval, prices, None, None, spool=spool)
+    spool.save({"symbol": "xyz", "date": "2020-01-01"}, "FinDataTest", "1d", index)
+    assert "FinDataTest" not in databroker.client.list_database_names()
+
+    # A TORN FRAME OF A CRASHED APPEND ENDS THE SEGMENT
+    spool.seal()
+    segment = spool.segments()[-1]
+    with open(segment, "ab") as fh:
+        fh.write(b"\x00\x00\x10\x00xx")
+    assert len(list(Spool.iter_batches(segment))) == 2
+
+    # THE FLUSHER RETRIES A FAILED SAVE AND MERGES BATCHES OF ONE COLLECTION
+    save = databroker.save
+    calls = []
+
+    def flaky_save(*args, **kwargs):
+        calls.append(len(args[0]))
+        if len(calls) == 1:
+            raise ConnectionError
+        return save(*args, **kwargs)
+
+    databroker.save = flaky_save
+    flusher = SpoolFlusher(Spool(str(tmp_path / "spool")), databroker, backoff=0)
+    assert flusher.drain() == len(prices) + 1
+    assert calls == [len(prices) + 1] * 2
+    assert flusher.counts["retries"] == 1 and flusher.counts["batches"] == 2
+    assert flusher.counts["failed"] == 0
+    assert databroker.get_number_of_documents("FinDataTest", interval) == len(prices) + 1
+    assert databroker.get_catalog("FinDataTest", interval)
+    assert flusher.spool.segments() == [] and flusher.spool.pending_bytes() == 0
+
+    # THE BACKGROUND THREAD DRAINS NEW APPENDS
+    databroker.save = save
+    with SpoolFlusher(spool, databroker, interval=0.01) as flusher:
+        spool.save({"symbol": "xyz", "date": "2020-01-02"}, "FinDataTest", "1d", index)
+    assert flusher.counts["records"] == 1
+
+    # A SAVE GIVEN UP ON COUNTS AS FAILED ONCE, THE SEGMENT STAYS
+    spool.save({"symbol": "xyz", "date": "2020-01-03"}, "FinDataTest", "1d", index)
+    databroker.save = flaky_save
+    calls.clear()
+    flusher = SpoolFlusher(spool, databroker, retries=0)
+    with raises(ConnectionError):
+        flusher.drain()
+    assert flusher.counts["failed"] == 1 and flusher.counts["retries"] == 0
+    assert len(spool.segments()) == 1
+    databroker.save = save
+
+    databroker.client.drop_database("FinDataTest")
+
+
+def test___spool___corrupt___pass(tmp_path, databroker):
+    spool = Spool(str(tmp_path / "spool"))
+    index = [("symbol", 1), ("date", 1)]
+    for date in ["2020-01-01", "2020-01-02", "2020-01-03"]:
+        spool.save({"symbol": "xyz", "date": date}, "FinDataTest", "1d", index)
+    spool.seal()
+    segment = spool.segments()[0]
+    ends = [end for end, _, _ in Spool.iter_batches(segment)]
+
+    # A CORRUPT FRAME IN THE MIDDLE OF A SEGMENT IS NOT A TORN FRAME
+    with open(segment, "r+b") as fh:
+        fh.seek(ends[0] + 12)
+        fh.write(b"xx")
+    with raises(CorruptSegmentError):
+        list(Spool.iter_batches(segment))
+
+    # THE BATCHES BEFORE IT ARE SAVED, THE SEGMENT IS KEPT ASIDE WITH ITS OFFSET
+    flusher = SpoolFlusher(spool, databroker)
+    assert flusher.drain() == 1 and flusher.counts["corrupt"] == 1
+    assert spool.segments() == []
+    corrupt = segment.replace(".spool", ".corrupt")
+    assert os.path.exists(corrupt) and Spool.get_offset(segment) == ends[0]
+
+    # NEW SEGMENTS DO NOT REUSE ITS NUMBER
+    spool = Spool(str(tmp_path / "spool"))
+    spool.save({"symbol": "xyz", "date": "2020-01-04"}, "FinDataTest", "1d", index)
+    assert SpoolFlusher(spool, databroker).drain() == 1
+    assert os.path.exists(corrupt)
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+
+    databroker.client.drop_database("FinDataTest")
+
+
+################################################################################
+# TESTS FOR CHECKPOINTUTILS
+################################################################################
+
+
+def test___checkpoint___pass(tmp_path):
+    path = str(tmp_path / "run" / "checkpoint.jsonl")
+    with Checkpoint(path) as checkpoint:
+        checkpoint.mark(("u1", {"interval": "1d", "period1": 0, "period2": 1}))
+        checkpoint.mark(("u1", {"interval": "1d", "period1": 0, "period2": 1}))
+
+    # A TORN LINE OF A CRASHED RUN IS IGNORED
+    with open(path, "a") as fh:
+        fh.write('["u2", {"inter')
+
+    with Checkpoint(path) as checkpoint:
+        assert len(checkpoint) == 1
+        # period2 (THE TIME OF THE RUN) IS NOT PART OF THE KEY
+        assert ("u1", {"period2": 2, "period1": 0, "interval": "1d"}) in checkpoint
+        combinations = [("u1", {"interval": "1d", "period1": 0}), ("u2", {"interval": "1d"})]
+        assert checkpoint.pending(combinations) == combinations[1:]
+        checkpoint.mark(combinations[1])
+
+    assert len(Checkpoint(path)) == 2
+    assert len(Checkpoint(path, resume=False)) == 0
+
+
+################################################################################
+# TESTS FOR SCHEMAUTILS
+################################################################################
+
+quote_summary_payload = {
+    "price": {
+        "maxAge": 1,
+        "regularMarketPrice": {"raw": 10.5, "fmt": "10.50"},
+        "regularMarketChangePercent": {"raw": 0.01, "fmt": "1.00%"},
+        "postMarketTime": {},
+        "exchange": "NMS",
+        "currency": None,
+    },
+    "calendarEvents": {
+        "maxAge": 1,
+        "earnings": {
+            "earningsDate": [{"raw": 1609459200, "fmt": "2021-01-01"}],
+            "earningsAverage": {"raw": 1.0, "fmt": "1"},
+        },
+        "exDividendDate": {"raw": 1609459200, "fmt": "2021-01-01"},
+    },
+    "balanceSheetHistory": {
+        "balanceSheetStatements": [
+            {"endDate": {"raw": 1609372800, "fmt": "2020-12-31"}, "cash": {"raw": 5, "fmt": "5"}},
+            {"endDate": {"raw": 1577750400, "fmt": "2019-12-31"}, "cash": {}},
+        ],
+        "maxAge": 86400,
+    },
+    "unknownModule": {"a": {"raw": 1, "fmt": "1"}},
+    "test": 100,
+}
+
+quote_summary_payload_drift = {
+    "price": {
+        "maxAge": 1,
+        "regularMarketPrice": {"raw": 11.5, "fmt": "11.50"},
+        "newField": {"raw": 3, "fmt": "3"},
+        "exchange": "NMS",
+    },
+}
+
+
+@pytest.mark.parametrize("resp", [quote_summary_payload, quote_summary_payload_drift])
+def test___schema_registry_parse___pass(resp):
+    registry = QuoteSummarySchemaRegistry()
+    expected = list(parse_to_multiindex(parse_raw_fmt(resp)))
+
+    # FIRST CALL LEARNS THE SCHEMA, SECOND CALL USES THE COMPILED PARSERS
+    assert registry.parse(resp) == expected
+    assert registry.parse(resp) == expected
+    assert "price" in registry.stats["compiled"]
+
+
+def test___schema_registry_counters___pass():
+    registry = QuoteSummarySchemaRegistry()
+    registry.parse(quote_summary_payload)
+
+    assert registry.stats["generic"] == {"unknownModule": 1, "test": 1}
+    assert registry.stats["drift"] == {}
+
+    expected = list(parse_to_multiindex(parse_raw_fmt(quote_summary_payload_drift)))
+    assert registry.parse(quote_summary_payload_drift) == expected
+    assert registry.stats["drift"] == {"price": 1}
+
+    # THE NEW FIELD IS LEARNED AFTER THE FIRST DRIFT
+    registry.parse(quote_summary_payload_drift)
+    assert registry.stats["drift"] == {"price": 1}
+
+
+def test___schema_registry_parse___fail():
+    registry = QuoteSummarySchemaRegistry()
+    with raises(TypeError):
+        registry.parse([{"a": 1}])
+
+
 ################################################################################
 # TESTS FOR ASYNCUTILS
 ################################################################################
@@ -1213,12 +2235,273 @@ async def test___store_yahoo_prices___pass(mock_get, dc, interval, quotes, div,
         )
 
     assert databroker.client.list_database_names() == ["FinDataTest"]
-    assert databroker.client["FinDataTest"].list_collection_names() == ["1d"]
+    assert databroker.client["FinDataTest"].list_collection_names() == ["1d", "Catalog"]
+
+    # clean up
+    databroker.client.drop_database("FinDataTest")
+
+
+async def achunks(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+pricedc_nulls = {
+    **pricedc,
+    "timestamp": [1583038800, 1585339201, 1585425601],
+    "events": {"dividends": {"1583038800": {"amount": 0.5, "date": 1583038800}}},
+    "indicators": {
+        "quote": [
+            {
+                "volume": [1478726800, None, 51054153],
+                "close": [247.74000549316406, None, 247.74000549316406],
+                "open": [282.2799987792969, None, 252.75],
+                "high": [304.0, None, 255.8699951171875],
+                "low": [212.61000061035156, None, 247.0500030517578],
+            }
+        ],
+        "adjclose": [{"adjclose": [247.74000549316406, None, 247.74000549316406]}],
+    },
+}
+
+
+@pytest.mark.parametrize("dc", [pricedc, pricedc_nulls])
+@pytest.mark.parametrize("size", [1, 7, 65536])
+@pytest.mark.asyncio
+async def test___parse_chart_stream___pass(dc, size):
+    body = json.dumps({"chart": {"result": [dc], "error": None}}, indent=1).encode()
+    res = await parse_chart_stream(achunks(body, size), capacity=1)
+
+    assert res["chart"]["error"] is None
+    result = res["chart"]["result"][0]
+    assert result["meta"] == dc["meta"]
+    assert result.get("events") == dc.get("events")
+    assert result["timestamp"].dtype == np.int64
+    np.testing.assert_array_equal(result["timestamp"], dc["timestamp"])
+    for k, v in dc["indicators"]["quote"][0].items():
+        np.testing.assert_array_equal(
+            result["indicators"]["quote"][0][k], np.array(v, dtype=np.float64)
+        )
+    assert_frame_equal(parse_quotes_as_frame(result), parse_quotes_as_frame(dc))
+
+
+@pytest.mark.asyncio
+async def test___parse_chart_stream___fail():
+    body = json.dumps({"chart": {"result": [pricedc], "error": None}}).encode()
+    with raises(ValueError):
+        await parse_chart_stream(achunks(body[:-20], 16))
+
+    # A MALFORMED ELEMENT IS AN ERROR, NOT A SHORTER ARRAY
+    body = body.replace(b"247.74000549316406", b"247.74x", 1)
+    with raises(ValueError):
+        await parse_chart_stream(achunks(body, 16))
+
+
+@pytest.mark.asyncio
+@patch("aiohttp.ClientSession.get")
+async def test___fetch___stream___pass(mock_get):
+    body = json.dumps({"chart": {"result": [pricedc], "error": None}}).encode()
+    mock_get.return_value.__aenter__.return_value.content.iter_chunked = lambda n: achunks(body, n)
+
+    async with ClientSession() as session:
+        data = await fetch("http://example.com", {}, session, stream=True)
+
+    assert_frame_equal(parse_quotes_as_frame(data["chart"]["result"][0]), priceframe)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [False, True])
+@patch("aiohttp.ClientSession.get")
+async def test___fetch___archive___pass(mock_get, stream, tmp_path):
+    dc = {"chart": {"result": [pricedc], "error": None}}
+    body = json.dumps(dc).encode()
+    response = mock_get.return_value.__aenter__.return_value
+    response.status = 200
+    response.read = CoroutineMock(return_value=body)
+    response.json = CoroutineMock(return_value=dc)
+    response.content.iter_chunked = lambda n: achunks(body, n)
+
+    archive = ResponseArchive(str(tmp_path))
+    url = f"{base_url}chart/abc"
+    async with ClientSession() as session:
+        await fetch(url, {"interval": "1d"}, session, stream=stream, archive=archive)
+
+    paths = list(archive.iter_paths())
+    assert len(paths) == 1
+    assert paths[0] == archive.path(url, {"interval": "1d"})
+    assert paths[0].split("/")[-4:-2] == ["chart", "abc"]
+
+    header, resp = archive.load(paths[0])
+    assert header["url"] == url
+    assert header["params"] == {"interval": "1d"}
+    assert resp == dc
+
+    # TWO WRITERS OF THE SAME RESPONSE IN ONE PROCESS DO NOT SHARE A TEMPORARY FILE
+    first = archive.open_writer(url, {"interval": "1d"})
+    second = archive.open_writer(url, {"interval": "1d"})
+    first.write(body)
+    second.write(body)
+    first.close()
+    second.close()
+    assert archive.load(paths[0])[1] == dc
+    assert not [fn for fn in os.listdir(os.path.dirname(paths[0])) if fn.endswith(".tmp")]
+
+
+def test___reprocess_archive___pass(tmp_path, databroker):
+    archive = ResponseArchive(str(tmp_path / "archive"))
+    archive.write(
+        f"{base_url}chart/abc",
+        {"interval": "1d"},
+        json.dumps({"chart": {"result": [pricedc], "error": None}}).encode(),
+    )
+    archive.write(
+        f"{query_url}abc",
+        {"modules": "price"},
+        json.dumps(
+            {"quoteSummary": {"result": [{"price": {"a": {"raw": 1, "fmt": "1"}}}]}}
+        ).encode(),
+    )
+    archive.write(f"{query_url}xyz", {"modules": "price"}, b"{}")
+
+    store = PriceStore(str(tmp_path / "store"))
+    counts = reprocess_archive(archive, databroker, "FinDataTest", processes=1, pricestore=store)
+
+    assert counts == {"chart": 1, "quoteSummary": 1, "failed": 1}
+    assert sorted(databroker.client["FinDataTest"].list_collection_names()) == [
+        "1d",
+        "Catalog",
+        "price",
+    ]
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+    assert len(store.open("abc", "1d")) == 2
+
+    # RECORDS ARE STAMPED WITH THE FETCH DATE OF THE ARCHIVED RESPONSE
+    header, _ = archive.load(archive.path(f"{query_url}abc", {"modules": "price"}))
+    price = databroker.load("FinDataTest", "price", {})
+    assert price == [{"a": 1.0, "date": header["date"], "symbol": "abc"}]
 
     # clean up
     databroker.client.drop_database("FinDataTest")
 
 
+@pytest.mark.asyncio
+async def test___rate_limiter___pass():
+    limiter = RateLimiter(rate=50, concurrency=2)
+    t0 = time.perf_counter()
+
+    async def _one():
+        async with limiter:
+            pass
+
+    await asyncio.gather(*[_one() for _ in range(5)])
+    assert time.perf_counter() - t0 >= 0.08
+
+
+@patch("aiohttp.ClientSession.get")
+def test___run_sharded_ingest___pass(mock_get, databroker):
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[{"chart": {"result": [pricedc]}}, {}]
+    )
+
+    report = run_sharded_ingest(
+        ["abc", "xyz"], lambda: databroker, "FinDataTest", processes=1, interval="1d", rate=100
+    )
+
+    assert {k: report[k] for k in ["symbols", "requests", "ok", "failed", "records"]} == {
+        "symbols": 2,
+        "requests": 2,
+        "ok": 1,
+        "failed": 1,
+        "records": 2,
+    }
+    assert len(report["workers"]) == 1 and report["seconds"] >= 0.01
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+
+    databroker.client.drop_database("FinDataTest")
+
+
+@patch("aiohttp.ClientSession.get")
+def test___run_sharded_ingest___errors___pass(mock_get, databroker):
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[{"chart": {"result": [pricedc]}}] * 2
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def failing_save(*args, **kwargs):
+        raise AutoReconnect("connection lost")
+
+    # DATABASE ERRORS FAIL THE UNITS, NOT THE SHARD
+    databroker.save = failing_save
+    report = run_sharded_ingest(
+        ["abc", "xyz"], lambda: databroker, "FinDataTest", processes=1, interval="1d"
+    )
+    assert {k: report[k] for k in ["requests", "ok", "failed"]} == {
+        "requests": 2,
+        "ok": 0,
+        "failed": 2,
+    }
+
+    # THE EVENT LOOP OF THE CALLER IS RESTORED
+    assert asyncio.get_event_loop() is loop and not loop.is_closed()
+    loop.close()
+
+
+def test___work_queue___pass(databroker):
+    queue = WorkQueue(databroker, "FinDataTest", lease_seconds=60, max_attempts=2, retry_delay=0)
+    combinations = [(f"{base_url}chart/{s}", {"interval": "1d"}) for s in ["a", "b", "c"]]
+    assert queue.enqueue(combinations) == 3
+    assert queue.enqueue(combinations) == 0
+
+    # A BATCH IS LEASED TO ONE WORKER ONLY
+    first = queue.claim("w1", 2)
+    assert [i["_id"] for i in first] == ["chart:a:1d", "chart:b:1d"]
+    assert [i["_id"] for i in queue.claim("w2", 5)] == ["chart:c:1d"]
+    assert queue.claim("w3", 5) == []
+    assert queue.heartbeat("w2", ["chart:a:1d"]) == 0
+
+    assert queue.complete("w1", ["chart:a:1d"]) == 1
+    assert queue.fail("w1", ["chart:b:1d"], "timeout") == 1
+    assert [i["attempts"] for i in queue.claim("w3", 5)] == [2]
+
+    # AN EXPIRED LEASE OF A DEAD WORKER IS CLAIMABLE, AFTER max_attempts IT FAILS
+    queue.colm.update_many({"owner": "w2"}, {"$set": {"available_at": dt(2000, 1, 1)}})
+    assert [i["_id"] for i in queue.claim("w4", 5)] == ["chart:c:1d"]
+    queue.colm.update_many({}, {"$set": {"available_at": dt(2000, 1, 1)}})
+    assert queue.claim("w5", 5) == []
+    assert queue.stats() == {"pending": 0, "leased": 0, "done": 1, "failed": 2}
+
+    # ITEMS ARE KEYED WITHOUT THE PERIODS, A RESET RE-ENQUEUES THEM WITH THE NEW ONES
+    refresh = [(url, {**params, "period1": 1}) for url, params in combinations]
+    assert queue.enqueue(refresh) == 0
+    assert queue.stats()["pending"] == 0
+    assert queue.enqueue(refresh, reset=True) == 0
+    assert queue.stats() == {"pending": 3, "leased": 0, "done": 0, "failed": 0}
+    assert [i["params"]["period1"] for i in queue.claim("w6", 5)] == [1, 1, 1]
+
+    databroker.client.drop_database("FinDataTest")
+
+
+@pytest.mark.asyncio
+@patch("aiohttp.ClientSession.get")
+async def test___run_queue_worker___pass(mock_get, databroker):
+    mock_get.return_value.__aenter__.return_value.status = 200
+    mock_get.return_value.__aenter__.return_value.json = CoroutineMock(
+        side_effect=[{"chart": {"result": [pricedc]}}, {}]
+    )
+    queue = WorkQueue(databroker, "FinDataTest", max_attempts=1)
+    queue.enqueue([(f"{base_url}chart/{s}", {"interval": "1d"}) for s in ["abc", "xyz"]])
+
+    counts = await run_queue_worker(queue, databroker, "FinDataTest", "w1")
+    assert counts == {"claimed": 2, "done": 1, "failed": 1}
+    assert queue.stats()["done"] == 1 and queue.stats()["failed"] == 1
+    assert databroker.get_number_of_documents("FinDataTest", "1d") == 2
+
+    databroker.client.drop_database("FinDataTest")
+
+
 @pytest.mark.parametrize("dc, expeceted", test_aparse_raw_yahoo_financial_data_pass)
 @pytest.mark.asyncio
 @patch("aiohttp.ClientSession.get")